@@ -0,0 +1,132 @@
+# Fills a metadata DB using the unversioned, unindexed jobs schema with
+# synthetic jobs, times the listing and retention queries, then upgrades the DB
+# in place with JobsDB.init_db() and times them again on the indexed schema.
+#
+# Usage: python benchmarks/jobs_listing.py [rows]
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+WORKDIR = tempfile.mkdtemp(prefix="ydl-bench-")
+DB_PATH = os.path.join(WORKDIR, "metadata.db")
+with open(os.path.join(WORKDIR, "config.yml"), "w") as config:
+    config.write(
+        "ydl_server:\n  metadata_db_path: {}\n"
+        "ydl_options:\n  output: {}/%(title)s.%(ext)s\n".format(DB_PATH, WORKDIR)
+    )
+os.environ["YDL_CONFIG_PATH"] = os.path.join(WORKDIR, "config.yml")
+
+from ydl_server.logdb import JobsDB, Job  # noqa: E402
+
+RUNS = 20
+# The columns added since are included, unindexed, so that the current queries
+# can run before the upgrade
+LEGACY_SCHEMA = """
+    CREATE TABLE jobs
+        (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            log TEXT,
+            format TEXT,
+            last_update DATETIME DEFAULT CURRENT_TIMESTAMP,
+            type INTEGER NOT NULL,
+            url TEXT,
+            pid INTEGER,
+            priority INTEGER NOT NULL DEFAULT 1,
+            submitter TEXT,
+            parent_id INTEGER,
+            output TEXT
+        );
+    CREATE TABLE job_logs
+        (
+            job_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            log TEXT NOT NULL,
+            PRIMARY KEY (job_id, seq)
+        );
+"""
+
+
+def fill_legacy_db(rows):
+    conn = sqlite3.connect(DB_PATH)
+    conn.executescript(LEGACY_SCHEMA)
+    start = 1500000000
+    statuses = [Job.COMPLETED] * 90 + [Job.FAILED] * 7 + [Job.ABORTED] * 2 + [Job.PENDING]
+    conn.executemany(
+        "INSERT INTO jobs (name, status, log, format, last_update, type, url, pid)"
+        " VALUES (?, ?, ?, ?, datetime(?, 'unixepoch'), 0, ?, 0);",
+        (
+            (
+                "Video %i" % i,
+                random.choice(statuses),
+                "[download] 100% of 10.00MiB",
+                "video/best",
+                start + random.randrange(rows * 60),
+                "https://example.com/watch?v=%i" % i,
+            )
+            for i in range(rows)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+def timed(func):
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def clean_old_jobs_dry_run(db, limit):
+    # Runs the retention queries without keeping their result
+    db.in_transaction = True
+    db.clean_old_jobs(limit)
+    db.conn.rollback()
+    db.in_transaction = False
+
+
+def measure(rows):
+    db = JobsDB(readonly=False)
+    results = {
+        "get_jobs(100)": timed(lambda: db.get_jobs(100)),
+        "get_jobs(100, failed)": timed(lambda: db.get_jobs(100, "failed")),
+        "get_jobs_with_logs(100)": timed(lambda: db.get_jobs_with_logs(100)),
+        # Steady state of the retention: a handful of jobs over the limit
+        "clean_old_jobs(rows - 10)": timed(lambda: clean_old_jobs_dry_run(db, rows - 10)),
+    }
+    db.close()
+    return results
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print("Filling {} jobs in {}".format(rows, DB_PATH))
+    fill_legacy_db(rows)
+
+    before = measure(rows)
+    start = time.perf_counter()
+    JobsDB.init_db()
+    upgrade = time.perf_counter() - start
+    after = measure(rows)
+
+    db = JobsDB(readonly=True)
+    kept = sum(db.count_jobs_by_status().values())
+    db.close()
+    print("Upgrade took {:.1f}s, {} of {} jobs kept".format(upgrade, kept, rows))
+    print("{:<26} {:>12} {:>12}".format("median of %i runs" % RUNS, "before (ms)", "after (ms)"))
+    for name in before:
+        print("{:<26} {:>12.2f} {:>12.2f}".format(name, before[name], after[name]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Feeds a synthetic yt-dlp progress stream through LogNormalizer in pipe-sized
+# chunks and reports the throughput of every slice of the stream: it should
+# stay flat however much output the job already produced.
+#
+# Usage: python benchmarks/log_normalizer.py [size_mb]
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ydl_server.logdb import LogNormalizer  # noqa: E402
+
+CHUNK_SIZE = 64 * 1024
+FLUSH_EVERY = 16
+SLICES = 10
+
+
+def progress_stream(size):
+    # Progress bar updates separated by carriage returns, with a new line
+    # every few updates as yt-dlp does when it moves on to the next fragment
+    block = []
+    for i in range(1000):
+        block.append(
+            "\r[download] %5.1f%% of 100.00MiB at  2.00MiB/s ETA 00:%02i"
+            % (i / 10, i % 60)
+        )
+        if i % 10 == 9:
+            block.append("\n[download] Got fragment %i\n" % i)
+    block = "".join(block).encode()
+    data = block * (size // len(block) + 1)
+    return [data[i:i + CHUNK_SIZE] for i in range(0, size, CHUNK_SIZE)]
+
+
+def legacy_clean_logs(logs):
+    clean = ""
+    for line in logs.split("\n"):
+        line = re.sub(".*\r", "", line)
+        if len(line) > 0:
+            clean = "%s%s\n" % (clean, line)
+    return clean
+
+
+def bench_normalizer(size):
+    normalizer = LogNormalizer()
+    stream = progress_stream(size)
+    slice_size = size // SLICES
+    fed, flushed, next_slice, start = 0, 0, slice_size, time.perf_counter()
+    slice_start = start
+    print("LogNormalizer on a %i MB stream" % (size // 2**20))
+    for i, chunk in enumerate(stream):
+        fed += normalizer.feed(chunk)
+        if i % FLUSH_EVERY == 0:
+            flushed += len(normalizer.pop_lines()) + len(normalizer.current)
+        if fed >= next_slice:
+            now = time.perf_counter()
+            print(
+                "  %6.1f MB: %8.1f MB/s"
+                % (fed / 2**20, slice_size / 2**20 / (now - slice_start))
+            )
+            slice_start, next_slice = now, next_slice + slice_size
+    normalizer.close()
+    print(
+        "  total: %.2fs, %.1f MB of clean log"
+        % (time.perf_counter() - start, flushed / 2**20)
+    )
+
+
+def bench_legacy(size):
+    # The previous implementation re-cleaned the whole output on every tick
+    output, start = "", time.perf_counter()
+    for i, chunk in enumerate(progress_stream(size)):
+        output += chunk.decode()
+        if i % FLUSH_EVERY == 0:
+            legacy_clean_logs(output)
+    print(
+        "Legacy clean_logs on a %i MB stream: %.2fs"
+        % (size // 2**20, time.perf_counter() - start)
+    )
+
+
+if __name__ == "__main__":
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    bench_normalizer(size_mb * 2**20)
+    for legacy_mb in (1, 2, 4):
+        bench_legacy(legacy_mb * 2**20)
@@ -0,0 +1,99 @@
+# Fills a metadata DB with synthetic jobs named after a few thousand channels,
+# indexed for search as they are inserted, then times JobsDB.search_jobs for
+# queries matching a handful of jobs up to a large share of them.
+#
+# Usage: python benchmarks/search.py [rows]
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+WORKDIR = tempfile.mkdtemp(prefix="ydl-bench-")
+DB_PATH = os.path.join(WORKDIR, "metadata.db")
+with open(os.path.join(WORKDIR, "config.yml"), "w") as config:
+    config.write(
+        "ydl_server:\n  metadata_db_path: {}\n"
+        "ydl_options:\n  output: {}/%(title)s.%(ext)s\n".format(DB_PATH, WORKDIR)
+    )
+os.environ["YDL_CONFIG_PATH"] = os.path.join(WORKDIR, "config.yml")
+
+from ydl_server.logdb import JobsDB, Job, get_search_terms  # noqa: E402
+
+RUNS = 20
+CHANNELS = 5000
+WORDS = [
+    "live", "music", "official", "video", "trailer", "review", "tutorial", "news",
+    "highlights", "podcast", "interview", "episode", "remix", "cover", "lyrics", "gameplay",
+    "walkthrough", "documentary", "vlog", "concert", "session", "acoustic", "reaction",
+    "unboxing", "recipe", "travel",
+]
+QUERIES = {
+    "video id": None,
+    "channel (0.02%)": "channel4242",
+    "channel + word": "channel4242 music",
+    "word (4%)": "acoustic",
+    "two words (0.2%)": "acoustic remix",
+    "no match": "nonexistent",
+}
+
+
+def fill_db(rows):
+    JobsDB.init_db()
+    random.seed(0)
+    db = JobsDB(readonly=False)
+    start = 1500000000
+    with db.transaction():
+        db.conn.executemany(
+            "INSERT INTO jobs (name, status, log, format, last_update, type, url, pid)"
+            " VALUES (?, ?, '', 'video/best', datetime(?, 'unixepoch'), 0, ?, 0);",
+            (
+                (
+                    "channel%i - %s" % (
+                        random.randrange(CHANNELS), " ".join(random.sample(WORDS, 3))
+                    ),
+                    Job.COMPLETED,
+                    start + i * 60,
+                    "https://www.youtube.com/watch?v=%011x" % i,
+                )
+                for i in range(rows)
+            ),
+        )
+    db.close()
+
+
+def timed(func):
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print("Filling {} jobs in {}".format(rows, DB_PATH))
+    start = time.perf_counter()
+    fill_db(rows)
+    print("Filled and indexed in {:.1f}s".format(time.perf_counter() - start))
+    QUERIES["video id"] = "%011x" % (rows // 2)
+
+    db = JobsDB(readonly=True)
+    print("{:<20} {:>10} {:>12}".format("median of %i runs" % RUNS, "results", "time (ms)"))
+    for name, text in QUERIES.items():
+        terms = get_search_terms(text)
+        results = len(db.search_jobs(terms, 20))
+        print(
+            "{:<20} {:>10} {:>12.2f}".format(
+                name, results, timed(lambda terms=terms: db.search_jobs(terms, 20))
+            )
+        )
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
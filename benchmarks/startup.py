@@ -0,0 +1,108 @@
+# Starts the youtube-dl-server.py entry point with a scratch configuration and
+# reports the time until it answers /api/info, then until /api/extractors
+# returns the extractors list. Cold runs start without the module cache file,
+# warm runs reuse the one left by the previous run.
+#
+# Usage: python benchmarks/startup.py [runs]
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import yaml
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TIMEOUT = 60
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(workdir, port):
+    with open(os.path.join(ROOT, "config.yml")) as f:
+        config = yaml.safe_load(f.read().replace("/youtube-dl/", workdir + "/"))
+    config["ydl_server"].update({"host": "127.0.0.1", "port": port})
+    path = os.path.join(workdir, "config.yml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path, config
+
+
+def get_json(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return json.load(response)
+    except (OSError, ValueError):
+        return None
+
+
+def wait_for(url, check, start, proc):
+    while time.perf_counter() - start < TIMEOUT:
+        if proc.poll() is not None:
+            raise RuntimeError("youtube-dl-server.py exited with %i" % proc.returncode)
+        data = get_json(url)
+        if data is not None and check(data):
+            return time.perf_counter() - start
+        time.sleep(0.01)
+    raise RuntimeError("%s did not answer within %is" % (url, TIMEOUT))
+
+
+def run(config_path, port):
+    env = dict(os.environ, YDL_CONFIG_PATH=config_path)
+    env.setdefault("YOUTUBE_DL", "yt-dlp")
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "youtube-dl-server.py"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        base = "http://127.0.0.1:%i/api/" % port
+        listening = wait_for(base + "info", lambda data: True, start, proc)
+        extractors = wait_for(base + "extractors", lambda data: len(data) > 0, start, proc)
+    finally:
+        proc.kill()
+        proc.wait()
+    return listening, extractors
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    workdir = tempfile.mkdtemp(prefix="ydl-startup-")
+    try:
+        port = get_free_port()
+        config_path, config = write_config(workdir, port)
+        cache_path = config["ydl_server"].get("module_cache_path")
+        results = {"cold": [], "warm": []}
+        for _ in range(runs):
+            for kind in ("cold", "warm"):
+                if kind == "cold" and cache_path and os.path.exists(cache_path):
+                    os.unlink(cache_path)
+                results[kind].append(run(config_path, port))
+        print("median of %i runs    listening (ms)   extractors (ms)" % runs)
+        for kind, timings in results.items():
+            print(
+                "%-20s %14.0f %17.0f"
+                % (
+                    kind,
+                    statistics.median(t[0] for t in timings) * 1000,
+                    statistics.median(t[1] for t in timings) * 1000,
+                )
+            )
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
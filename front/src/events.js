@@ -0,0 +1,32 @@
+import { getAPIUrl } from './utils';
+
+const EVENT_TYPES = ['reset', 'insert', 'status', 'name', 'progress', 'log', 'delete', 'stats', 'finished'];
+
+let source = null;
+const subscribers = new Set();
+
+function dispatch(type, event) {
+  const data = JSON.parse(event.data);
+  subscribers.forEach(handlers => {
+    if (handlers[type]) {
+      handlers[type](data);
+    }
+  });
+}
+
+// All components share a single event stream, which the browser reconnects
+// and resumes from the last received event id on its own.
+function subscribeEvents(handlers) {
+  if (source === null) {
+    source = new EventSource(getAPIUrl('api/events', import.meta.env));
+    EVENT_TYPES.forEach(type => {
+      source.addEventListener(type, event => dispatch(type, event));
+    });
+  }
+  subscribers.add(handlers);
+  return () => {
+    subscribers.delete(handlers);
+  };
+}
+
+export { subscribeEvents };
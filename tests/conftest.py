@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+WORKDIR = tempfile.mkdtemp(prefix="ydl-tests-")
+with open(os.path.join(WORKDIR, "config.yml"), "w") as config:
+    config.write(
+        "ydl_server:\n  metadata_db_path: {0}/metadata.db\n"
+        "ydl_options:\n  output: {0}/%(title)s.%(ext)s\n".format(WORKDIR)
+    )
+os.environ["YDL_CONFIG_PATH"] = os.path.join(WORKDIR, "config.yml")
+
+from starlette.applications import Starlette  # noqa: E402
+from starlette.routing import Route  # noqa: E402
+from starlette.testclient import TestClient  # noqa: E402
+
+from ydl_server import views  # noqa: E402
+from ydl_server.config import app_config  # noqa: E402
+from ydl_server.dbpool import JobsDBPool  # noqa: E402
+from ydl_server.logdb import JobsDB  # noqa: E402
+
+JobsDB.init_db()
+
+
+# Keeps the actions instead of writing them, the tests check what was asked
+class RecordingJobsHandler:
+    def __init__(self):
+        self.actions = []
+
+    def put(self, obj):
+        self.actions.append(obj)
+
+
+@pytest.fixture
+def db():
+    db = JobsDB(readonly=False)
+    db.conn.execute("DELETE FROM jobs;")
+    db.conn.commit()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def client(db):
+    app = Starlette(
+        routes=[
+            Route("/api/downloads", views.api_logs, methods=["GET"]),
+            Route("/api/downloads", views.api_queue_download, methods=["POST"]),
+            Route("/api/downloads/bulk", views.api_queue_bulk, methods=["POST"]),
+            Route("/api/jobs/{job_id:str}/stop", views.api_jobs_stop, methods=["POST"]),
+        ]
+    )
+    app.state.dbpool = JobsDBPool(app_config)
+    app.state.jobshandler = RecordingJobsHandler()
+    with TestClient(app) as client:
+        yield client
+    app.state.dbpool.close()
@@ -0,0 +1,77 @@
+import sqlite3
+
+from ydl_server import views
+from ydl_server.logdb import Actions, Job, JobType
+
+
+def insert_job(db, status, parent_id=None):
+    job = Job("job", status, "", JobType.YDL_DOWNLOAD, "video/best", ["http://a/b"])
+    job.parent_id = parent_id
+    db.insert_job(job)
+    return job.id
+
+
+def test_stop_pending_job(client, db):
+    job_id = insert_job(db, Job.PENDING)
+    response = client.post("/api/jobs/%i/stop" % job_id)
+    assert response.status_code == 200
+    assert response.json() == {"success": True}
+    assert client.app.state.jobshandler.actions == [
+        (Actions.SET_STATUS, (job_id, Job.ABORTED))
+    ]
+
+
+def test_stop_playlist_stops_its_entries(client, db):
+    parent_id = insert_job(db, Job.RUNNING)
+    pending_id = insert_job(db, Job.PENDING, parent_id)
+    insert_job(db, Job.COMPLETED, parent_id)
+    response = client.post("/api/jobs/%i/stop" % parent_id)
+    assert response.json() == {"success": True}
+    assert client.app.state.jobshandler.actions == [
+        (Actions.SET_STATUS, (pending_id, Job.ABORTED))
+    ]
+
+
+def test_stop_unknown_job(client, db):
+    assert client.post("/api/jobs/12345/stop").status_code == 404
+
+
+def test_bulk_reports_malformed_entries(client, db):
+    response = client.post(
+        "/api/downloads/bulk",
+        json=[
+            {"url": "http://a/1"},
+            {"urls": 5},
+            {"urls": {"a": 1}},
+            {"urls": ["http://a/2", 3]},
+            {"url": "http://a/3", "format": ["video/best"]},
+            {"url": "http://a/4", "profile": "profile/podcast"},
+            "http://a/5",
+        ],
+    )
+    assert response.status_code == 400
+    assert [error["index"] for error in response.json()["errors"]] == [1, 2, 3, 4, 5, 6]
+    assert client.app.state.jobshandler.actions == []
+
+
+def test_queue_download_rejects_malformed_urls(client, db):
+    response = client.post("/api/downloads", json={"urls": {"a": 1}})
+    assert response.status_code == 400
+    assert client.app.state.jobshandler.actions == []
+
+
+def test_jobs_page_limit_is_capped(client, db):
+    for limit in ("0", "abc", str(views.MAX_LOG_PAGE_SIZE + 1)):
+        response = client.get("/api/downloads?limit=" + limit)
+        assert response.status_code == 400
+
+
+def test_children_counts_of_many_jobs(db):
+    parent_id = insert_job(db, Job.RUNNING)
+    insert_job(db, Job.COMPLETED, parent_id)
+    insert_job(db, Job.PENDING, parent_id)
+    db.conn.commit()
+    # Builds of SQLite older than 3.32 accept no more than 999 parameters
+    db.conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    job_ids = list(range(parent_id + 1, parent_id + 2000)) + [parent_id]
+    assert db.get_children_counts(job_ids) == {parent_id: {"completed": 1, "pending": 1}}
@@ -0,0 +1,198 @@
+import io
+import os
+import stat
+import tarfile
+import zipfile
+import zlib
+from bisect import bisect_right
+from time import localtime
+
+CHUNK_SIZE = 64 * 1024
+
+ARCHIVE_MEDIA_TYPES = {
+    "zip": "application/zip",
+    "tar": "application/x-tar",
+}
+
+
+class ArchiveEntry:
+    __slots__ = ("name", "path", "mtime", "mode", "size", "directory")
+
+    def __init__(self, name, path, st):
+        self.name = name
+        self.path = path
+        self.mtime = st.st_mtime
+        self.mode = stat.S_IMODE(st.st_mode)
+        self.directory = stat.S_ISDIR(st.st_mode)
+        self.size = 0 if self.directory else st.st_size
+
+
+def list_entries(path):
+    # The directory and everything below it, depth first in name order.
+    # Hidden files are left out like in the finished listing, symlinks are
+    # never followed.
+    base = os.path.basename(path.rstrip("/"))
+    entries = [ArchiveEntry(base, path, os.stat(path))]
+    add_entries(entries, base, path)
+    return entries
+
+
+def add_entries(entries, name, directory):
+    with os.scandir(directory) as it:
+        children = sorted(it, key=lambda e: e.name)
+    for child in children:
+        if child.name.startswith(".") or child.is_symlink():
+            continue
+        try:
+            st = child.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        if not stat.S_ISDIR(st.st_mode) and not stat.S_ISREG(st.st_mode):
+            continue
+        entry = ArchiveEntry("%s/%s" % (name, child.name), child.path, st)
+        entries.append(entry)
+        if entry.directory:
+            add_entries(entries, entry.name, entry.path)
+
+
+def open_or_empty(path):
+    # A file removed since reads as empty
+    try:
+        return open(path, "rb")
+    except OSError:
+        return io.BytesIO()
+
+
+def read_file(path, start, length):
+    # Exactly the length recorded when the archive was laid out: a file that
+    # changed since is cut or padded with zeros, the offsets must hold
+    with open_or_empty(path) as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                data = bytes(min(CHUNK_SIZE, length))
+            length -= len(data)
+            yield data
+
+
+class ChunkWriter:
+    # Write-only file for zipfile: not seekable, so it streams every entry
+    # with a data descriptor instead of going back to patch the headers
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(entries):
+    out = ChunkWriter()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for entry in entries:
+            if entry.directory:
+                continue
+            zinfo = zipfile.ZipInfo(
+                entry.name, date_time=max(localtime(entry.mtime)[:6], (1980, 1, 1, 0, 0, 0))
+            )
+            zinfo.external_attr = (stat.S_IFREG | entry.mode) << 16
+            # Picks zip64 headers for the large files up front
+            zinfo.file_size = entry.size
+            with zf.open(zinfo, "w") as dest:
+                for data in read_file(entry.path, 0, entry.size):
+                    dest.write(data)
+                    yield out.drain()
+    yield out.drain()
+
+
+# Tar archive of a directory laid out before it is streamed: its size and the
+# offset of every member are known, so any byte range can be served.
+class TarArchive:
+    def __init__(self, entries):
+        self.entries = entries
+        self.offsets = []
+        self.segments = []
+        offset = 0
+        for entry in entries:
+            header_size = len(self.get_header(entry))
+            self.add_segment(offset, header_size, "header", entry)
+            offset += header_size
+            if entry.size:
+                self.add_segment(offset, entry.size, "data", entry)
+                offset += entry.size
+                if entry.size % tarfile.BLOCKSIZE:
+                    padding = tarfile.BLOCKSIZE - entry.size % tarfile.BLOCKSIZE
+                    self.add_segment(offset, padding, "zeros", None)
+                    offset += padding
+        # End of archive blocks, then up to a full record like tarfile does
+        end = offset + 2 * tarfile.BLOCKSIZE
+        end += -end % tarfile.RECORDSIZE
+        self.add_segment(offset, end - offset, "zeros", None)
+        self.size = end
+        self.etag = '"%x-%x"' % (
+            self.size,
+            zlib.crc32(
+                "\n".join(
+                    "%s %i %i" % (entry.name, entry.size, entry.mtime) for entry in entries
+                ).encode("utf-8", "surrogateescape")
+            ),
+        )
+
+    def add_segment(self, offset, length, kind, entry):
+        self.offsets.append(offset)
+        self.segments.append((offset, length, kind, entry))
+
+    def get_header(self, entry):
+        info = tarfile.TarInfo(entry.name)
+        info.mtime = int(entry.mtime)
+        info.mode = entry.mode
+        if entry.directory:
+            info.type = tarfile.DIRTYPE
+        else:
+            info.size = entry.size
+        return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+    def stream(self, start=0, end=None):
+        # Bytes from start to end, both included
+        end = self.size - 1 if end is None else end
+        i = bisect_right(self.offsets, start) - 1
+        while i < len(self.segments) and self.segments[i][0] <= end:
+            offset, length, kind, entry = self.segments[i]
+            first = max(start - offset, 0)
+            last = min(end - offset + 1, length)
+            if kind == "header":
+                yield self.get_header(entry)[first:last]
+            elif kind == "data":
+                yield from read_file(entry.path, first, last - first)
+            else:
+                yield bytes(last - first)
+            i += 1
+
+
+def get_range(header, size):
+    # A single "bytes" range as (start, end), both included. None when the
+    # whole content is to be sent, False when the range is not satisfiable.
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or not (first or last) or not (first + last).isdigit():
+        return None
+    if not first:
+        if not int(last):
+            return False
+        return max(size - int(last), 0), size - 1
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= size:
+        return False
+    return int(first), min(int(last), size - 1) if last else size - 1
@@ -0,0 +1,137 @@
+import os
+from threading import Thread, Event
+from time import monotonic
+
+
+def get_received_bytes():
+    # Bytes received on every network interface but the loopback, None where
+    # /proc is not available
+    try:
+        with open("/proc/net/dev") as f:
+            lines = f.readlines()[2:]
+    except OSError:
+        return None
+    received = 0
+    for line in lines:
+        name, counters = line.split(":", 1)
+        if name.strip() != "lo":
+            received += int(counters.split()[0])
+    return received
+
+
+def get_cpu_load():
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+# Adds a download worker while jobs are waiting for one, as long as each
+# addition raises the aggregate download throughput, and removes workers that
+# sit idle or overload the CPU.
+class WorkerAutoscaler:
+    # Throughput gain under which an added worker is removed again
+    MIN_GAIN = 1.1
+    # Intervals during which no worker is added after a useless one
+    BACKOFF_INTERVALS = 5
+
+    def __init__(self, app_config, ydlhandler):
+        self.ydlhandler = ydlhandler
+        self.thread = None
+        self.done = False
+        self.wakeup = Event()
+
+        self.interval = app_config["ydl_server"].get("autoscale_interval", 30)
+        self.min_workers = app_config["ydl_server"].get("autoscale_min_workers", 1)
+        self.max_workers = app_config["ydl_server"].get("autoscale_max_workers", 8)
+        self.max_load = app_config["ydl_server"].get("autoscale_max_load", 0.9)
+
+        self.last_sample = self.sample()
+        self.added_at = None
+        self.backoff = 0
+        self.last_step = None
+
+    def start(self):
+        self.thread = Thread(target=self.worker)
+        self.thread.start()
+
+    def finish(self):
+        self.done = True
+        self.wakeup.set()
+
+    def join(self):
+        if self.thread is not None:
+            return self.thread.join()
+
+    def clamp(self, count):
+        return min(max(count, self.min_workers), self.max_workers)
+
+    def sample(self):
+        return monotonic(), get_received_bytes(), self.ydlhandler.completed_jobs
+
+    def get_throughput(self):
+        # Bytes received per second since the last call, or jobs completed per
+        # second without network counters
+        sample = self.sample()
+        elapsed = max(sample[0] - self.last_sample[0], 0.001)
+        if sample[1] is not None and self.last_sample[1] is not None:
+            throughput = (sample[1] - self.last_sample[1]) / elapsed
+        else:
+            throughput = (sample[2] - self.last_sample[2]) / elapsed
+        self.last_sample = sample
+        return throughput
+
+    def step(self):
+        throughput = self.get_throughput()
+        load = get_cpu_load()
+        workers = self.ydlhandler.download_workers_count
+        busy = self.ydlhandler.busy_workers
+        waiting = self.ydlhandler.queue.qsize()
+        target, reason = workers, None
+        self.backoff = max(self.backoff - 1, 0)
+
+        if self.added_at is not None and throughput < self.added_at * self.MIN_GAIN:
+            target, reason = workers - 1, "no_throughput_gain"
+            self.backoff = self.BACKOFF_INTERVALS
+        elif load is not None and load > self.max_load:
+            target, reason = workers - 1, "cpu_load"
+        elif not waiting and busy < workers:
+            target, reason = workers - 1, "idle_workers"
+        # Jobs held back by the download limits leave workers idle, another
+        # worker would not start them
+        elif waiting and busy >= workers and not self.backoff:
+            target, reason = workers + 1, "queued_jobs"
+        self.added_at = None
+
+        target = self.clamp(target)
+        if target > workers:
+            self.added_at = throughput
+        if target != workers:
+            print("Autoscaling dl workers from %i to %i (%s)" % (workers, target, reason))
+            self.ydlhandler.resize(target)
+        self.last_step = {
+            "throughput": round(throughput, 2),
+            "cpu_load": round(load, 2) if load is not None else None,
+            "waiting": waiting,
+            "busy": busy,
+            "workers": workers,
+            "target": target,
+            "reason": reason if target != workers else None,
+        }
+
+    def get_status(self):
+        return {
+            "interval": self.interval,
+            "min_workers": self.min_workers,
+            "max_workers": self.max_workers,
+            "max_load": self.max_load,
+            "backoff": self.backoff,
+            "last_step": self.last_step,
+        }
+
+    def worker(self):
+        while not self.done:
+            self.wakeup.wait(self.interval)
+            if self.done:
+                break
+            self.step()
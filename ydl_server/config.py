@@ -1,6 +1,7 @@
 import os
 import yaml
 import shutil
+import multiprocessing
 
 YDL_FORMATS = {
     "Video": {
@@ -55,7 +56,9 @@ def get_config_file_path():
 def load_config():
     config = None
     config_file_path = get_config_file_path()
-    print("Using configuration file {}".format(config_file_path))
+    # yt-dlp worker processes load the configuration again, quietly
+    if multiprocessing.current_process().name == "MainProcess":
+        print("Using configuration file {}".format(config_file_path))
 
     if not os.path.isfile(config_file_path):
         print(
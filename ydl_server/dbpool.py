@@ -0,0 +1,74 @@
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from threading import Lock
+
+from ydl_server.logdb import JobsDB
+
+
+class JobsDBPool:
+    def __init__(self, app_config):
+        self.size = app_config["ydl_server"].get("db_read_pool_size", 4)
+        self.timeout = app_config["ydl_server"].get("db_read_pool_timeout", 10)
+        self.mmap_size = app_config["ydl_server"].get("db_read_mmap_mb", 64) * 2**20
+        self.cache_size = app_config["ydl_server"].get("db_read_cache_mb", 8) * 2**10
+        # Most recently returned connections are reused first, their page
+        # cache being the warmest
+        self.idle = LifoQueue()
+        self.lock = Lock()
+        self.opened = 0
+        self.closed = False
+
+    def open_connection(self):
+        db = JobsDB(readonly=True, shared=True)
+        db.configure_reader(self.mmap_size, self.cache_size)
+        return db
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            if self.opened < self.size:
+                self.opened += 1
+                try:
+                    return self.open_connection()
+                except Exception:
+                    self.opened -= 1
+                    raise
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except Empty:
+            raise Exception(
+                "No metadata DB connection available after {}s".format(self.timeout)
+            ) from None
+
+    def release(self, db):
+        if self.closed:
+            db.close()
+            with self.lock:
+                self.opened -= 1
+            return
+        self.idle.put(db)
+
+    @contextmanager
+    def connection(self):
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def get_stats(self):
+        return {"size": self.size, "opened": self.opened, "idle": self.idle.qsize()}
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                db = self.idle.get_nowait()
+            except Empty:
+                break
+            db.close()
+            with self.lock:
+                self.opened -= 1
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import time
+from collections import deque
+from contextlib import suppress
+from threading import Lock
+
+
+class EventBus:
+    def __init__(self, size=1000, keepalive=15):
+        # Event ids are prefixed with the server start time so that a client
+        # resuming after a restart is told to reload instead of missing events
+        self.boot = int(time.time())
+        self.events = deque(maxlen=size)
+        self.last_id = 0
+        self.keepalive = keepalive
+        self.lock = Lock()
+        self.subscribers = set()
+
+    def publish(self, event, data):
+        with self.lock:
+            self.last_id += 1
+            self.events.append((self.last_id, event, data))
+            subscribers = list(self.subscribers)
+        for loop, ready in subscribers:
+            # The subscriber's event loop may already be closed
+            with suppress(RuntimeError):
+                loop.call_soon_threadsafe(ready.set)
+
+    def parse_event_id(self, event_id):
+        try:
+            boot, last_id = (int(i) for i in event_id.split(":"))
+        except (AttributeError, ValueError):
+            return None
+        if boot != self.boot or last_id > self.last_id:
+            return None
+        return last_id
+
+    def get_events(self, last_id):
+        with self.lock:
+            if self.events and last_id < self.events[0][0] - 1:
+                return None
+            return [e for e in self.events if e[0] > last_id]
+
+    def format_event(self, event_id, event, data):
+        return "id: {}:{}\nevent: {}\ndata: {}\n\n".format(
+            self.boot, event_id, event, json.dumps(data)
+        )
+
+    async def subscribe(self, last_event_id=None):
+        subscriber = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            self.subscribers.add(subscriber)
+        try:
+            last_id = self.parse_event_id(last_event_id)
+            while True:
+                subscriber[1].clear()
+                events = self.get_events(last_id) if last_id is not None else None
+                if events is None:
+                    # Nothing to resume from: the client has to reload its state
+                    last_id = self.last_id
+                    yield self.format_event(last_id, "reset", {})
+                    continue
+                for last_id, event, data in events:
+                    yield self.format_event(last_id, event, data)
+                try:
+                    await asyncio.wait_for(subscriber[1].wait(), self.keepalive)
+                except TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            with self.lock:
+                self.subscribers.discard(subscriber)
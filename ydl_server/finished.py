@@ -0,0 +1,355 @@
+import base64
+import ctypes
+import json
+import os
+import select
+import stat
+import struct
+from bisect import bisect_left, bisect_right
+from contextlib import suppress
+from datetime import datetime
+from threading import Event, Thread, Lock
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+
+SORT_KEYS = {
+    "name": lambda f: f.name,
+    "modified": lambda f: f.mtime,
+    "created": lambda f: f.ctime,
+    "size": lambda f: f.size or 0,
+}
+
+
+# Bare inotify through the C library: no extra dependency, Linux only
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed on %s" % path)
+        return wd
+
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%H:%m %D")
+
+
+class FinishedFile:
+    __slots__ = ("name", "mtime", "ctime", "size", "directory", "children", "json")
+
+    def __init__(self, name, st):
+        self.name = name
+        self.mtime = st.st_mtime
+        self.ctime = st.st_ctime
+        self.directory = stat.S_ISDIR(st.st_mode)
+        self.size = None if self.directory else st.st_size
+        self.children = {} if self.directory else None
+        self.json = None
+
+    def to_json(self):
+        # Files are replaced when they change, only directories are updated
+        # in place and reset it
+        if self.json is None:
+            self.json = self.get_json()
+        return self.json
+
+    def get_json(self):
+        return {
+            "name": self.name,
+            "modified": format_time(self.mtime),
+            "created": format_time(self.ctime),
+            "size": self.size,
+            "directory": self.directory,
+            "children": [
+                {
+                    "name": child.name,
+                    "size": child.size if child.size is not None else 0,
+                    "modified": format_time(child.mtime),
+                    "created": format_time(child.ctime),
+                }
+                for child in sorted(self.children.values(), key=lambda c: c.mtime, reverse=True)
+            ]
+            if self.directory
+            else None,
+        }
+
+
+def scan_dir(path):
+    files = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                files[entry.name] = FinishedFile(entry.name, entry.stat())
+            except OSError:
+                continue
+    return files
+
+
+def encode_cursor(key, name):
+    return base64.urlsafe_b64encode(json.dumps([key, name]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        key, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    return key, name
+
+
+def cursor_matches(cursor, sort):
+    # Keys of other sorts do not compare with the listed ones
+    key, name = cursor
+    if sort == "name":
+        valid_key = isinstance(key, str)
+    else:
+        valid_key = isinstance(key, (int, float)) and not isinstance(key, bool)
+    return valid_key and isinstance(name, str)
+
+
+# In-memory listing of the finished directory, two levels deep like the
+# files page shows it. Built once with scandir, then kept current by inotify,
+# or by checking the directories' mtime where inotify is not available.
+class FinishedIndex:
+    def __init__(self, root, events=None, poll_interval=5):
+        self.root = root
+        self.events = events
+        self.poll_interval = poll_interval
+        self.lock = Lock()
+        self.check_lock = Lock()
+        self.files = {}
+        self.version = 0
+        self.sorted = {}
+        self.inotify = None
+        self.watches = {}
+        self.dir_mtimes = {}
+        self.thread = None
+        self.done = False
+        self.stopped = Event()
+
+    def start(self):
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            print("inotify unavailable, polling the finished directory: %s" % e)
+        self.rebuild()
+        self.thread = Thread(target=self.worker)
+        self.thread.start()
+
+    def finish(self):
+        self.done = True
+        self.stopped.set()
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def get_mtime(self, relative):
+        try:
+            return os.stat(os.path.join(self.root, relative)).st_mtime
+        except OSError:
+            return None
+
+    def watch(self, relative):
+        if self.inotify is None:
+            return
+        try:
+            self.watches[self.inotify.add_watch(os.path.join(self.root, relative), WATCH_MASK)] = relative
+        except OSError as e:
+            # Usually out of watches: the mtime checks take over
+            print("Could not watch %s, polling the finished directory: %s" % (relative, e))
+            self.inotify.close()
+            self.inotify = None
+
+    def scan_children(self, files):
+        for f in files.values():
+            if f.directory:
+                try:
+                    f.children = scan_dir(os.path.join(self.root, f.name))
+                except OSError:
+                    f.children = {}
+                self.dir_mtimes[f.name] = f.mtime
+                self.watch(f.name)
+
+    def rebuild(self):
+        self.dir_mtimes = {"": self.get_mtime("")}
+        self.watch("")
+        files = scan_dir(self.root)
+        self.scan_children(files)
+        with self.lock:
+            self.files = files
+            self.changed()
+
+    def changed(self):
+        # Called with the lock held
+        self.version += 1
+        self.sorted = {}
+
+    def publish(self):
+        if self.events is not None:
+            self.events.publish("finished", {"version": self.version})
+
+    def refresh(self, relative):
+        # Updates a single file or directory of the index from the disk
+        parts = relative.strip("/").split("/")
+        if len(parts) > 2 or not parts[0] or any(p.startswith(".") for p in parts):
+            return False
+        try:
+            f = FinishedFile(parts[-1], os.stat(os.path.join(self.root, relative)))
+        except OSError:
+            f = None
+        if f is not None and f.directory and len(parts) == 1:
+            self.scan_children({f.name: f})
+        parent_stat = None
+        if len(parts) == 2:
+            with suppress(OSError):
+                parent_stat = os.stat(os.path.join(self.root, parts[0]))
+        with self.lock:
+            if len(parts) == 1:
+                if f is None:
+                    self.files.pop(parts[0], None)
+                    self.dir_mtimes.pop(parts[0], None)
+                else:
+                    self.files[parts[0]] = f
+            else:
+                parent = self.files.get(parts[0])
+                if parent is None or not parent.directory:
+                    return False
+                if f is None:
+                    parent.children.pop(parts[1], None)
+                else:
+                    parent.children[parts[1]] = f
+                if parent_stat is not None:
+                    parent.mtime = parent_stat.st_mtime
+                    parent.ctime = parent_stat.st_ctime
+                parent.json = None
+            self.changed()
+        return True
+
+    def check(self):
+        with self.check_lock:
+            updated = self.check_dirs()
+        if updated:
+            self.publish()
+        return updated
+
+    def check_dirs(self):
+        # Rescans the directories whose mtime changed: files were added,
+        # removed or renamed in them
+        updated = False
+        if self.get_mtime("") != self.dir_mtimes.get(""):
+            self.dir_mtimes[""] = self.get_mtime("")
+            files = scan_dir(self.root)
+            with self.lock:
+                current = dict(self.files)
+            for name, f in files.items():
+                if f.directory and name in current and current[name].directory:
+                    f.children = current[name].children
+            self.scan_children(
+                {n: f for n, f in files.items() if f.directory and n not in self.dir_mtimes}
+            )
+            with self.lock:
+                self.files = files
+                self.changed()
+            updated = True
+        for name, mtime in list(self.dir_mtimes.items()):
+            if name and self.get_mtime(name) != mtime:
+                self.dir_mtimes[name] = self.get_mtime(name)
+                updated = self.refresh(name) or updated
+        return updated
+
+    def worker(self):
+        while not self.done:
+            if self.inotify is None:
+                # Without inotify, or out of watches, the directories' mtime
+                # are checked in the background
+                if not self.stopped.wait(self.poll_interval):
+                    self.check()
+                continue
+            try:
+                events = self.inotify.read(1)
+            except (OSError, ValueError):
+                break
+            updated = False
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    self.rebuild()
+                    updated = True
+                elif mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                elif wd in self.watches and name:
+                    updated = self.refresh(os.path.join(self.watches[wd], name)) or updated
+            if updated:
+                self.publish()
+
+    def get_sorted(self, sort, reverse):
+        # Sorted listings are kept until the next change
+        with self.lock:
+            key = (sort, reverse)
+            if key not in self.sorted:
+                self.sorted[key] = sorted(
+                    self.files.values(),
+                    key=lambda f: (SORT_KEYS[sort](f), f.name),
+                    reverse=reverse,
+                )
+            return self.version, self.sorted[key]
+
+    def get_version(self):
+        return self.version
+
+    def get_page(self, sort="name", order="asc", limit=None, cursor=None):
+        reverse = order == "desc"
+        version, files = self.get_sorted(sort, reverse)
+        start = 0
+        if cursor is not None:
+            if not cursor_matches(cursor, sort):
+                raise ValueError("cursor does not match the '%s' sort" % sort)
+            keys = [(SORT_KEYS[sort](f), f.name) for f in files]
+            if reverse:
+                # bisect works on ascending sequences
+                start = len(keys) - bisect_left(keys[::-1], tuple(cursor))
+            else:
+                start = bisect_right(keys, tuple(cursor))
+        page = files[start:start + limit] if limit is not None else files[start:]
+        next_cursor = None
+        if limit is not None and start + limit < len(files):
+            last = page[-1]
+            next_cursor = encode_cursor(SORT_KEYS[sort](last), last.name)
+        return version, [f.to_json() for f in page], next_cursor, len(files)
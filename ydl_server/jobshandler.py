@@ -1,16 +1,149 @@
-from queue import Queue
-from threading import Thread
-from ydl_server.logdb import JobsDB, Actions
+import os
+import sqlite3
+from queue import Queue, Empty
+from threading import Thread, Lock
+from datetime import datetime
+from time import monotonic, time
+from ydl_server.logdb import JobsDB, Job, Actions, STATUS_NAME
+from ydl_server.events import EventBus
+from ydl_server.progress import PROGRESS_KEYS
+
+# Actions only overwriting a job field: when a batch holds several of them for
+# the same job, only the last one has to be written
+COALESCED_FIELDS = {
+    Actions.SET_LOG: ("log",),
+    Actions.SET_STATUS: ("status",),
+    Actions.SET_PID: ("pid",),
+    Actions.SET_NAME: ("name",),
+    Actions.SET_PROGRESS: ("progress",),
+    Actions.SET_TIMINGS: ("timings",),
+}
+WRITTEN_FIELDS = {
+    **COALESCED_FIELDS,
+    Actions.UPDATE: ("status", "log", "timings"),
+    Actions.RESUME: ("status", "log", "timings"),
+}
+
+
+def get_playlist_progress(counts):
+    # Status, progress line and progress of a playlist job, from its entries'
+    # statuses
+    total = sum(counts.values())
+    ended = sum(counts.get(status, 0) for status in (Job.COMPLETED, Job.FAILED, Job.ABORTED))
+    if ended < total:
+        status = Job.RUNNING
+    elif counts.get(Job.FAILED):
+        status = Job.FAILED
+    elif counts.get(Job.ABORTED):
+        status = Job.ABORTED
+    else:
+        status = Job.COMPLETED
+    details = ", ".join(
+        "%i %s" % (counts[s], STATUS_NAME[s].lower())
+        for s in (Job.COMPLETED, Job.RUNNING, Job.PENDING, Job.FAILED, Job.ABORTED)
+        if counts.get(s)
+    )
+    progress = dict.fromkeys(PROGRESS_KEYS)
+    progress.update(percent=round(100 * ended / total, 1), playlist_index=None, playlist_count=total)
+    return (
+        status,
+        "[playlist] %5.1f%% of %i entries: %s" % (100 * ended / total, total, details),
+        progress,
+    )
 
 
 class JobsHandler:
-    def __init__(self, app_config):
+    def __init__(self, app_config, metrics=None):
         self.queue = Queue()
+        self.metrics = metrics
         self.thread = None
         self.done = False
         self.app_config = app_config
+        self.events = EventBus()
+        self.pending_events = []
+        # Signalled once the batch which stored their jobs is committed
+        self.pending_inserts = []
+        self.updated_parents = set()
+        self.downloaded_media = []
+        self.archive_path = app_config["ydl_server"].get("download_archive")
+        self.stats_lock = Lock()
+        self.status_counts = {}
+        self.pending_counts = []
+        # Download progress of the running jobs, only kept in memory
+        self.progress = {}
+        self.flush_interval = app_config["ydl_server"].get("jobs_flush_interval", 0.25)
+        self.max_batch_size = app_config["ydl_server"].get("jobs_batch_size", 500)
+        self.writer_stats = {
+            "batches": 0,
+            "actions": 0,
+            "coalesced": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_lag": 0,
+            "max_lag": 0,
+        }
+
+    def load_stats(self, db=None):
+        conn = db or JobsDB(readonly=True)
+        counts = conn.count_jobs_by_status()
+        if db is None:
+            conn.close()
+        with self.stats_lock:
+            self.status_counts = {
+                status: counts.get(status, 0) for status in range(len(STATUS_NAME))
+            }
+
+    def count_status(self, status, delta=1):
+        # Counted once the write of the action succeeded, see apply_safe
+        if status is not None:
+            self.pending_counts.append((int(status), delta))
+
+    def apply_counts(self):
+        with self.stats_lock:
+            for status, delta in self.pending_counts:
+                self.status_counts[status] += delta
+        self.pending_counts = []
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {
+                STATUS_NAME[status].lower(): count
+                for status, count in self.status_counts.items()
+            }
+
+    def set_progress(self, job_id, progress):
+        with self.stats_lock:
+            if progress is None:
+                self.progress.pop(int(job_id), None)
+            else:
+                self.progress[int(job_id)] = progress
+
+    def get_progress(self, job_ids):
+        with self.stats_lock:
+            return {job_id: self.progress[job_id] for job_id in job_ids if job_id in self.progress}
+
+    def get_writer_stats(self):
+        return {"queue": self.queue.qsize(), **self.writer_stats}
+
+    def import_download_archive(self):
+        if not self.archive_path or not os.path.exists(self.archive_path):
+            return
+        with open(self.archive_path, encoding="utf-8") as archive:
+            archive_ids = [" ".join(line.split()) for line in archive if line.strip()]
+        db = JobsDB(readonly=False)
+        db.import_downloaded_media(archive_ids)
+        db.close()
+        print("Imported {} entries of the download archive".format(len(archive_ids)))
+
+    def write_download_archive(self):
+        if self.archive_path and self.downloaded_media:
+            with open(self.archive_path, "a", encoding="utf-8") as archive:
+                archive.writelines("%s\n" % archive_id for archive_id in self.downloaded_media)
+        self.downloaded_media = []
 
     def start(self, dl_queue):
+        self.load_stats()
+        self.import_download_archive()
         self.thread = Thread(target=self.worker, args=(dl_queue,))
         self.thread.start()
 
@@ -18,47 +151,350 @@ class JobsHandler:
         self.done = True
 
     def put(self, obj):
-        self.queue.put(obj)
+        self.queue.put((monotonic(), obj))
 
     def finish(self):
         self.done = True
 
+    def publish(self, event, job_id=None, **data):
+        if job_id is not None:
+            data["id"] = int(job_id) if str(job_id).isdigit() else job_id
+        data["last_update"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Events are only sent once the batch is committed
+        self.pending_events.append((event, data))
+
+    def publish_stats(self, dl_queue):
+        self.events.publish("stats", {"queue": dl_queue.qsize(), **self.get_stats()})
+
+    def set_status(self, db, job_id, status):
+        # Late updates of a deleted job are dropped, it is no longer counted
+        previous = db.get_job_status(job_id)
+        if previous is None:
+            return False
+        self.count_status(previous, -1)
+        self.count_status(status)
+        # Reported again by the download while the job runs
+        self.set_progress(job_id, None)
+        return True
+
+    def publish_status(self, job_id, status, log=None):
+        self.publish("status", job_id, status=STATUS_NAME[int(status)])
+        if log is not None:
+            self.publish("progress", job_id, current=log)
+
+    def child_updated(self, db, job_id, parent_id=None):
+        if parent_id is None:
+            parent_id = db.get_job_parent(job_id)
+        if parent_id is not None:
+            self.updated_parents.add(parent_id)
+
+    def update_parents(self, db):
+        for parent_id in self.updated_parents:
+            counts = db.count_children_by_status(parent_id)
+            if not counts:
+                # Every entry was dropped, queued by another job meanwhile
+                if db.get_job_status(parent_id) == Job.RUNNING:
+                    log = "[playlist] All entries are already downloaded or queued"
+                    self.set_status(db, parent_id, Job.COMPLETED)
+                    db.set_job_status(parent_id, Job.COMPLETED)
+                    db.set_job_log(parent_id, log)
+                    self.publish_status(parent_id, Job.COMPLETED, log)
+                continue
+            status, log, progress = get_playlist_progress(counts)
+            if db.get_job_status(parent_id) != status:
+                self.set_status(db, parent_id, status)
+                db.set_job_status(parent_id, status)
+            db.set_job_log(parent_id, log)
+            self.publish_status(parent_id, status, log)
+            if status == Job.RUNNING:
+                self.set_progress(parent_id, progress)
+                self.publish("progress", parent_id, progress=progress)
+        self.updated_parents = set()
+
+    def delete_children(self, db, job_id):
+        for status, count in db.delete_children(job_id).items():
+            self.count_status(status, -count)
+
+    def get_batch(self):
+        batch = [self.queue.get()]
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get(timeout=max(deadline - monotonic(), 0)))
+            except Empty:
+                break
+        return batch
+
+    @staticmethod
+    def get_job_id(action, job):
+        if action in (Actions.UPDATE, Actions.RESUME):
+            return job.id
+        return job[0]
+
+    @staticmethod
+    def coalesce(actions):
+        written, kept = set(), []
+        for action, job in reversed(actions):
+            fields = WRITTEN_FIELDS.get(action, ())
+            job_id = JobsHandler.get_job_id(action, job) if fields else None
+            if action in COALESCED_FIELDS and all(
+                (job_id, field) in written for field in fields
+            ):
+                continue
+            written.update((job_id, field) for field in fields)
+            kept.append((action, job))
+        kept.reverse()
+        return kept
+
+    def is_queued(self, db, job):
+        # Requests racing each other for the same media end up here, before
+        # any of them was stored
+        if not job.archive_ids:
+            return False
+        indexed = db.get_indexed_media(job.archive_ids)
+        return all(
+            indexed.get(archive_id, {}).get("queued") for archive_id in job.archive_ids
+        )
+
+    def clean_old_jobs(self, db, count):
+        # Makes room for count new jobs
+        limit = self.app_config["ydl_server"].get("max_log_entries", 100)
+        kept = limit - count if limit <= 1 else max(limit - count, 1)
+        for status, deleted in db.clean_old_jobs(kept).items():
+            self.count_status(status, -deleted)
+
+    def insert_job(self, db, job, dl_jobs):
+        # Queued for download once this batch is committed
+        job.timings = {"enqueued": time()}
+        db.insert_job(job)
+        if job.archive_ids:
+            db.index_media(job.id, job.archive_ids)
+        self.count_status(job.status)
+        self.child_updated(db, job.id, job.parent_id)
+        dl_jobs.append(job)
+
+    def apply(self, db, action, job, dl_jobs):
+        if action == Actions.PURGE_LOGS:
+            db.purge_jobs()
+            self.load_stats(db)
+            self.publish("reset")
+        elif action == Actions.INSERT:
+            if self.is_queued(db, job):
+                print("Dropping duplicate job for " + ", ".join(job.url))
+                if job.parent_id is not None:
+                    self.updated_parents.add(job.parent_id)
+                return
+            self.clean_old_jobs(db, 1)
+            self.insert_job(db, job, dl_jobs)
+            self.publish(
+                "insert",
+                job.id,
+                name=job.name,
+                status=STATUS_NAME[job.status],
+                log=job.log or "",
+                format=job.format,
+                type=job.type,
+                urls=job.url,
+                pid=job.pid,
+                parent_id=job.parent_id,
+            )
+        elif action == Actions.INSERT_MANY:
+            jobs, inserted = job
+            self.pending_inserts.append(inserted)
+            self.clean_old_jobs(db, len(jobs))
+            for new_job in jobs:
+                if self.is_queued(db, new_job):
+                    print("Dropping duplicate job for " + ", ".join(new_job.url))
+                    continue
+                self.insert_job(db, new_job, dl_jobs)
+            # Clients reload the list once rather than handling an event per
+            # job
+            self.publish("reset")
+        elif action == Actions.UPDATE:
+            if not self.set_status(db, job.id, job.status):
+                return
+            if job.status in (Job.COMPLETED, Job.FAILED, Job.ABORTED):
+                job.timings["db_write"] = time()
+            db.update_job(job)
+            if job.status == Job.COMPLETED:
+                self.downloaded_media.extend(db.set_media_downloaded(job.id))
+            self.child_updated(db, job.id, job.parent_id)
+            self.publish_status(job.id, job.status, job.log)
+            # Only playlist jobs split into entries are still running once
+            # their worker is done, their entries may all have been dropped
+            if job.status == Job.RUNNING:
+                self.updated_parents.add(job.id)
+        elif action == Actions.RESUME:
+            if not self.set_status(db, job.id, job.status):
+                return
+            job.timings = {"enqueued": time()}
+            db.delete_job_log(job.id)
+            db.update_job(job)
+            self.child_updated(db, job.id, job.parent_id)
+            dl_jobs.append(job)
+            self.publish_status(job.id, job.status, job.log)
+        elif action == Actions.SET_NAME:
+            job_id, name = job
+            db.set_job_name(job_id, name)
+            self.publish("name", job_id, name=name)
+        elif action == Actions.SET_LOG:
+            job_id, log = job
+            db.set_job_log(job_id, log)
+            self.publish("progress", job_id, current=log)
+        elif action == Actions.SET_PROGRESS:
+            job_id, progress = job
+            self.set_progress(job_id, progress)
+            self.publish("progress", job_id, progress=progress)
+        elif action == Actions.SET_TIMINGS:
+            job_id, timings = job
+            db.set_job_timings(job_id, timings)
+        elif action == Actions.APPEND_LOG:
+            job_id, log = job
+            db.append_job_log(job_id, log)
+            self.publish("log", job_id, log=log)
+        elif action == Actions.SET_STATUS:
+            job_id, status = job
+            if not self.set_status(db, job_id, status):
+                return
+            db.set_job_status(job_id, status)
+            self.child_updated(db, job_id)
+            self.publish_status(job_id, status)
+        elif action == Actions.SET_PID:
+            job_id, pid = job
+            db.set_job_pid(job_id, pid)
+        elif action == Actions.CLEAN_LOGS:
+            for status, count in db.clean_old_jobs().items():
+                self.count_status(status, -count)
+            self.publish("reset")
+        elif action == Actions.CACHE_METADATA:
+            url, profile, info = job
+            db.cache_metadata(
+                url,
+                profile,
+                info,
+                self.app_config["ydl_server"].get("metadata_cache_ttl", 1800),
+                self.app_config["ydl_server"].get("metadata_cache_size", 200),
+            )
+        elif action == Actions.TOUCH_METADATA:
+            url, profile = job
+            db.touch_cached_metadata(url, profile)
+        elif action == Actions.INDEX_MEDIA:
+            job_id, archive_ids = job
+            db.reindex_media(job_id, archive_ids)
+        elif action == Actions.DELETE_LOG_SAFE:
+            status = db.get_job_status(job["id"])
+            self.child_updated(db, job["id"])
+            if db.delete_job_safe(job["id"]):
+                self.count_status(status, -1)
+                self.delete_children(db, job["id"])
+                self.publish("delete", job["id"])
+        elif action == Actions.DELETE_LOG:
+            status = db.get_job_status(job["id"])
+            self.child_updated(db, job["id"])
+            if db.delete_job(job["id"]):
+                self.count_status(status, -1)
+                self.delete_children(db, job["id"])
+            self.publish("delete", job["id"])
+
+    def record_batch(self, batch, actions):
+        lag = monotonic() - batch[0][0]
+        stats = self.writer_stats
+        stats["batches"] += 1
+        stats["actions"] += len(batch)
+        stats["coalesced"] += len(batch) - len(actions)
+        stats["last_batch_size"] = len(batch)
+        stats["max_batch_size"] = max(stats["max_batch_size"], len(batch))
+        stats["last_lag"] = round(lag, 3)
+        stats["max_lag"] = max(stats["max_lag"], stats["last_lag"])
+        if self.metrics is not None:
+            self.metrics.writer_lag.observe(lag)
+
+    def apply_safe(self, db, dl_jobs, description, write, *args):
+        # A failing write is undone on its own, with its events and counters,
+        # the rest of the batch is still committed
+        marks = (len(self.pending_events), len(dl_jobs), len(self.downloaded_media))
+        try:
+            with db.savepoint():
+                write(*args)
+        except Exception as e:
+            print("Error {}:\n{}:\n\t{}".format(description, type(e).__name__, str(e)))
+            self.pending_counts = []
+            del self.pending_events[marks[0]:]
+            del dl_jobs[marks[1]:]
+            del self.downloaded_media[marks[2]:]
+            return False
+        self.apply_counts()
+        return True
+
+    @staticmethod
+    def drop_inserted(action, job):
+        # Reported as not stored to the bulk requests waiting for them
+        if action == Actions.INSERT_MANY:
+            for new_job in job[0]:
+                new_job.id = -1
+
     def worker(self, dl_queue):
         db = JobsDB(readonly=False)
         while not self.done:
-            action, job = self.queue.get()
-            if action == Actions.PURGE_LOGS:
-                db.purge_jobs()
-            elif action == Actions.INSERT:
-                db.clean_old_jobs(
-                    self.app_config["ydl_server"].get("max_log_entries", 100) - 1
+            batch = self.get_batch()
+            actions = JobsHandler.coalesce([obj for _, obj in batch])
+            stats = self.get_stats()
+            dl_jobs = []
+            write_start = monotonic()
+            try:
+                with db.transaction():
+                    for action, job in actions:
+                        if not self.apply_safe(
+                            db,
+                            dl_jobs,
+                            "applying jobs action {}".format(action),
+                            self.apply,
+                            db,
+                            action,
+                            job,
+                            dl_jobs,
+                        ):
+                            self.drop_inserted(action, job)
+                    # Playlist jobs follow the status of their entries
+                    self.apply_safe(
+                        db, dl_jobs, "updating playlist jobs", self.update_parents, db
+                    )
+                    self.updated_parents = set()
+            except Exception as e:
+                # Nothing of the batch was stored
+                print(
+                    "Error committing jobs batch:\n{}:\n\t{}".format(type(e).__name__, str(e))
                 )
-                db.insert_job(job)
-                dl_queue.put(job)
-            elif action == Actions.UPDATE:
-                db.update_job(job)
-            elif action == Actions.RESUME:
-                db.update_job(job)
+                for action, job in actions:
+                    self.drop_inserted(action, job)
+                dl_jobs = []
+                self.downloaded_media = []
+                self.pending_events = []
+                self.pending_counts = []
+                self.updated_parents = set()
+                try:
+                    self.load_stats(db)
+                except sqlite3.Error as e:
+                    print("Error counting jobs:\n{}:\n\t{}".format(type(e).__name__, str(e)))
+                self.publish("reset")
+            if self.metrics is not None:
+                self.metrics.db_write_latency.observe(monotonic() - write_start)
+            # Download workers read jobs from their own connection, so they
+            # can only be queued once the batch is committed
+            for job in dl_jobs:
                 dl_queue.put(job)
-            elif action == Actions.SET_NAME:
-                job_id, name = job
-                db.set_job_name(job_id, name)
-            elif action == Actions.SET_LOG:
-                job_id, log = job
-                db.set_job_log(job_id, log)
-            elif action == Actions.SET_STATUS:
-                job_id, status = job
-                db.set_job_status(job_id, status)
-            elif action == Actions.SET_PID:
-                job_id, pid = job
-                db.set_job_pid(job_id, pid)
-            elif action == Actions.CLEAN_LOGS:
-                db.clean_old_jobs()
-            elif action == Actions.DELETE_LOG_SAFE:
-                db.delete_job_safe(job["id"])
-            elif action == Actions.DELETE_LOG:
-                db.delete_job(job["id"])
-            self.queue.task_done()
+            self.write_download_archive()
+            for event, data in self.pending_events:
+                self.events.publish(event, data)
+            self.pending_events = []
+            for inserted in self.pending_inserts:
+                inserted.set()
+            self.pending_inserts = []
+            if stats != self.get_stats():
+                self.publish_stats(dl_queue)
+            self.record_batch(batch, actions)
+            for _ in batch:
+                self.queue.task_done()
 
     def join(self):
         if self.thread is not None:
@@ -0,0 +1,134 @@
+from time import monotonic
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        self.refill()
+        return self.tokens >= 1
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+    def get_wait_time(self):
+        self.refill()
+        return max((1 - self.tokens) / self.rate, 0)
+
+
+class Limit:
+    def __init__(self, name, max_concurrent=None, rate=None, burst=1):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.active = 0
+        self.started = 0
+
+    def allows(self):
+        if self.max_concurrent is not None and self.active >= self.max_concurrent:
+            return False
+        return self.bucket is None or self.bucket.available()
+
+    def acquire(self):
+        self.active += 1
+        self.started += 1
+        if self.bucket is not None:
+            self.bucket.take()
+
+    def release(self):
+        self.active -= 1
+
+    def get_wait_time(self):
+        # Only a rate limit frees itself over time, a concurrency limit waits
+        # for a job to end
+        if self.bucket is None or self.bucket.available():
+            return None
+        return self.bucket.get_wait_time()
+
+    def get_usage(self):
+        usage = {
+            "name": self.name,
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "started": self.started,
+        }
+        if self.bucket is not None:
+            self.bucket.refill()
+            usage.update(
+                {
+                    "rate": self.bucket.rate,
+                    "burst": self.bucket.burst,
+                    "tokens": round(self.bucket.tokens, 2),
+                }
+            )
+        return usage
+
+
+# Concurrency and start rate limits of the download jobs, per extractor and
+# per host. Not thread safe: the scheduler calls it under its own lock.
+class DownloadLimits:
+    def __init__(self, app_config, get_extractor):
+        self.get_extractor = get_extractor
+        self.extractors = {
+            name.lower(): Limit("extractor:%s" % name, **options)
+            for name, options in (app_config["ydl_server"].get("extractor_limits") or {}).items()
+        }
+        self.hosts = {
+            name.lower(): Limit("host:%s" % name, **options)
+            for name, options in (app_config["ydl_server"].get("host_limits") or {}).items()
+        }
+
+    def get_host_limit(self, host):
+        # A domain limit also applies to its subdomains
+        parts = host.split(".")
+        for i in range(len(parts)):
+            limit = self.hosts.get(".".join(parts[i:]))
+            if limit is not None:
+                return limit
+
+    def get_limits(self, host, url):
+        limits = []
+        if self.hosts:
+            limit = self.get_host_limit(host)
+            if limit is not None:
+                limits.append(limit)
+        if self.extractors:
+            extractor = self.get_extractor(url)
+            if extractor is not None and extractor.lower() in self.extractors:
+                limits.append(self.extractors[extractor.lower()])
+        return limits
+
+    def allows(self, job):
+        return all(limit.allows() for limit in job.limits)
+
+    def acquire(self, job):
+        for limit in job.limits:
+            limit.acquire()
+
+    def release(self, job):
+        for limit in job.limits:
+            limit.release()
+
+    def get_wait_time(self):
+        wait_times = [
+            limit.get_wait_time()
+            for limit in list(self.extractors.values()) + list(self.hosts.values())
+        ]
+        wait_times = [t for t in wait_times if t is not None]
+        return min(wait_times) if wait_times else None
+
+    def get_usage(self):
+        return [
+            limit.get_usage()
+            for limit in list(self.extractors.values()) + list(self.hosts.values())
+        ]
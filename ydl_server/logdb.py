@@ -1,10 +1,86 @@
 import sqlite3
-import re
+import codecs
 import datetime
+import html
+import json
+import re
+import unicodedata
+from contextlib import contextmanager
+from threading import Lock
 
 from ydl_server.config import app_config
+from ydl_server.migrations import migrate, set_log_search
 
 STATUS_NAME = ["Running", "Completed", "Failed", "Pending", "Aborted"]
+PRIORITY_NAME = ["high", "normal", "low"]
+# Below the default limit of the SQLite versions before 3.32
+MAX_QUERY_PARAMS = 900
+# Most recent matches ranked by a search
+SEARCH_CANDIDATES = 1000
+# Words as split by the unicode61 tokenizer of the search index
+SEARCH_TOKEN = re.compile(r"[^\W_]+")
+# Characters of log text shown around the first match
+SNIPPET_CONTEXT = 60
+# Stages of a job as (name, start timing, end timing), the timings recorded by
+# the jobs writer and the download workers
+JOB_STAGES = (
+    ("queue", "enqueued", "dequeued"),
+    ("metadata", "metadata_start", "metadata_end"),
+    ("download", "download_start", "download_end"),
+    ("postprocess", "postprocess_start", "postprocess_end"),
+    ("total", "enqueued", "db_write"),
+)
+
+
+def get_stage_durations(timings):
+    # Seconds spent in each stage the job went through
+    return {
+        name: round(timings[end] - timings[start], 3)
+        for name, start, end in JOB_STAGES
+        if start in timings and end in timings
+    }
+
+
+def fold_token(token):
+    # Case and diacritics insensitive, like the unicode61 tokenizer
+    return "".join(
+        c for c in unicodedata.normalize("NFKD", token.casefold()) if not unicodedata.combining(c)
+    )
+
+
+def get_search_terms(text):
+    # Every whitespace separated word must match, as a phrase of its tokens:
+    # the text is never taken as FTS5 query syntax
+    return [tokens for tokens in (SEARCH_TOKEN.findall(word) for word in text.split()) if tokens]
+
+
+def get_search_query(terms):
+    return " ".join('"%s"' % " ".join(tokens) for tokens in terms)
+
+
+def mark_matches(text, tokens):
+    # Escaped text with the matched tokens in <mark> elements
+    marked, end = [], 0
+    for match in SEARCH_TOKEN.finditer(text):
+        if fold_token(match.group()) in tokens:
+            marked.append(html.escape(text[end:match.start()]))
+            marked.append("<mark>%s</mark>" % html.escape(match.group()))
+            end = match.end()
+    marked.append(html.escape(text[end:]))
+    return "".join(marked)
+
+
+def get_snippet(text, tokens):
+    for match in SEARCH_TOKEN.finditer(text):
+        if fold_token(match.group()) in tokens:
+            start = max(match.start() - SNIPPET_CONTEXT, 0)
+            end = match.end() + SNIPPET_CONTEXT
+            return "%s%s%s" % (
+                "…" if start > 0 else "",
+                mark_matches(text[start:end], tokens),
+                "…" if end < len(text) else "",
+            )
+    return None
 
 
 class Actions:
@@ -20,6 +96,13 @@ class Actions:
     SET_PID = 10
     DELETE_LOG = 11
     DELETE_LOG_SAFE = 12
+    APPEND_LOG = 13
+    CACHE_METADATA = 14
+    TOUCH_METADATA = 15
+    INDEX_MEDIA = 16
+    SET_PROGRESS = 17
+    INSERT_MANY = 18
+    SET_TIMINGS = 19
 
 
 class JobType:
@@ -34,7 +117,25 @@ class Job:
     PENDING = 3
     ABORTED = 4
 
-    def __init__(self, name, status, log, jobtype, format=None, url=None, id=-1, pid=0):
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+
+    def __init__(
+        self,
+        name,
+        status,
+        log,
+        jobtype,
+        format=None,
+        url=None,
+        id=-1,
+        pid=0,
+        priority=PRIORITY_NORMAL,
+        submitter=None,
+        parent_id=None,
+        output=None,
+    ):
         self.id = id
         self.name = name
         self.status = status
@@ -44,68 +145,106 @@ class Job:
         self.type = jobtype
         self.url = url
         self.pid = pid
+        self.priority = priority
+        self.submitter = submitter
+        self.parent_id = parent_id
+        self.output = output
+        self.limits = []
+        self.attempts = 0
+        self.archive_ids = []
+        self.force = False
+        self.progress = None
+        self.extractor = None
+        # Epoch timestamps of the job stages, see JOB_STAGES
+        self.timings = {}
+        self.profile = None
 
-    @staticmethod
-    def clean_logs(logs):
-        if not logs:
-            return logs
-        clean = ""
-        for line in logs.split("\n"):
-            line = re.sub(".*\r", "", line)
-            if len(line) > 0:
-                clean = "%s%s\n" % (clean, line)
-        return clean
 
+# Incrementally turns raw youtube-dl output into clean log lines: every chunk
+# is decoded and scanned once, carriage returns only keep the text written
+# after them (collapsing progress bar updates) and empty lines are dropped.
+class LogNormalizer:
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.lock = Lock()
+        self.partial = ""
+        self.lines = []
+        self.new_lines = []
 
-class JobsDB:
     @staticmethod
-    def check_db_latest():
-        conn = sqlite3.connect(
-            "file://%s" % app_config["ydl_server"].get("metadata_db_path"), uri=True
+    def clean(logs):
+        normalizer = LogNormalizer()
+        normalizer.write(logs or "")
+        normalizer.close()
+        return normalizer.getvalue()
+
+    @staticmethod
+    def clean_line(line):
+        if line.endswith("\r"):
+            line = line[:-1]
+        return line[line.rfind("\r") + 1:]
+
+    def feed(self, data):
+        self.write(self.decoder.decode(data))
+        return len(data)
+
+    def write(self, text):
+        if not text:
+            return
+        with self.lock:
+            *complete, partial = (self.partial + text).split("\n")
+            for line in complete:
+                line = LogNormalizer.clean_line(line)
+                if line:
+                    self.new_lines.append(line)
+            # Only keep what the last carriage return has not overwritten so
+            # that the pending line stays short
+            self.partial = partial[partial.rfind("\r", 0, len(partial) - 1) + 1:]
+
+    def close(self):
+        self.write(self.decoder.decode(b"", final=True))
+        with self.lock:
+            line = LogNormalizer.clean_line(self.partial)
+            if line:
+                self.new_lines.append(line)
+            self.partial = ""
+
+    @property
+    def current(self):
+        return LogNormalizer.clean_line(self.partial)
+
+    def pop_lines(self):
+        with self.lock:
+            lines, self.new_lines = self.new_lines, []
+            self.lines.extend(lines)
+        return "".join("%s\n" % line for line in lines)
+
+    def getvalue(self):
+        self.pop_lines()
+        current = self.current
+        return "".join("%s\n" % line for line in self.lines) + (
+            "%s\n" % current if current else ""
         )
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA table_info('jobs')")
-        columns = [row[1] for row in cursor.fetchall()]
-        if set(columns) != set(
-            [
-                "id",
-                "name",
-                "status",
-                "format",
-                "log",
-                "last_update",
-                "type",
-                "url",
-                "pid",
-            ]
-        ):
-            print("Outdated jobs table, cleaning up and recreating")
-            cursor.execute("DROP TABLE if exists jobs;")
-        conn.close()
 
+
+class JobsDB:
     @staticmethod
     def init_db():
         conn = sqlite3.connect(
             "file://%s" % app_config["ydl_server"].get("metadata_db_path"), uri=True
         )
         cursor = conn.cursor()
-        cursor.execute(
-            """
-            CREATE TABLE if not exists jobs
-                (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    status INTEGER NOT NULL,
-                    log TEXT,
-                    format TEXT,
-                    last_update DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    type INTEGER NOT NULL,
-                    url TEXT,
-                    pid INTEGER
-                );
-            """
-        )
-        conn.commit()
+        cursor.execute("PRAGMA auto_vacuum")
+        if cursor.fetchone()[0] != 2:
+            # Switching to incremental auto-vacuum rebuilds the file once, free
+            # pages are then released by the scheduled maintenance
+            print("Enabling incremental auto-vacuum on the metadata DB")
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cursor.execute("VACUUM")
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.close()
+        migrate(conn)
+        set_log_search(conn, app_config["ydl_server"].get("search_logs", False))
         conn.close()
 
     @staticmethod
@@ -113,7 +252,7 @@ class JobsDB:
         dt = datetime.datetime.strptime("{} +0000".format(dt), "%Y-%m-%d %H:%M:%S %z")
         return dt.astimezone().strftime("%Y-%m-%d %H:%M:%S")
 
-    def __init__(self, readonly=True):
+    def __init__(self, readonly=True, shared=False):
         self.conn = sqlite3.connect(
             "file://%s%s"
             % (
@@ -121,19 +260,95 @@ class JobsDB:
                 "?mode=ro" if readonly else "",
             ),
             uri=True,
+            # Shared connections are handed over between threads by a pool,
+            # which makes sure only one of them uses it at a time
+            check_same_thread=not shared,
         )
+        self.in_transaction = False
+        if not readonly:
+            self.conn.execute("PRAGMA synchronous = NORMAL")
+
+    def configure_reader(self, mmap_size, cache_size):
+        # Long-lived readers: map the DB file and keep a larger page cache.
+        # Queries are prepared once per connection by the sqlite3 statement
+        # cache, as long as their SQL text stays constant.
+        self.conn.execute("PRAGMA query_only = ON")
+        self.conn.execute("PRAGMA mmap_size = %i" % mmap_size)
+        self.conn.execute("PRAGMA cache_size = -%i" % cache_size)
 
     def close(self):
         self.conn.close()
 
+    def commit(self):
+        # Inside a transaction() block, changes are committed all at once
+        if not self.in_transaction:
+            self.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        self.in_transaction = True
+        try:
+            # Opened right away, savepoints then nest in it instead of
+            # committing on their release
+            self.conn.execute("BEGIN")
+            yield self
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.in_transaction = False
+
+    @contextmanager
+    def savepoint(self, name="step"):
+        # Undoes the changes of a failed step, the rest of the transaction is
+        # kept
+        self.conn.execute("SAVEPOINT %s" % name)
+        try:
+            yield self
+        except Exception:
+            self.conn.execute("ROLLBACK TO %s" % name)
+            self.conn.execute("RELEASE %s" % name)
+            raise
+        self.conn.execute("RELEASE %s" % name)
+
+    def get_db_stats(self):
+        cursor = self.conn.cursor()
+        stats = {}
+        for pragma in ("page_size", "page_count", "freelist_count"):
+            cursor.execute("PRAGMA %s" % pragma)
+            stats[pragma] = cursor.fetchone()[0]
+        return stats
+
+    def incremental_vacuum(self, pages):
+        # executescript steps the pragma until every requested page is freed
+        self.conn.executescript("PRAGMA incremental_vacuum(%i);" % pages)
+
+    def analyze(self):
+        self.conn.execute("ANALYZE")
+        self.conn.commit()
+
+    def wal_checkpoint(self):
+        cursor = self.conn.cursor()
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        busy, log_pages, checkpointed_pages = cursor.fetchone()
+        return {
+            "busy": bool(busy),
+            "log_pages": log_pages,
+            "checkpointed_pages": checkpointed_pages,
+        }
+
     def insert_job(self, job):
         cursor = self.conn.cursor()
         cursor.execute(
             """
             INSERT INTO jobs
-                (name, status, log, format, type, url, pid)
+                (
+                    name, status, log, format, type, url, pid, priority, submitter, parent_id,
+                    output, timings
+                )
             VALUES
-                (?, ?, ?, ?, ?, ?, ?);
+                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
             """,
             (
                 job.name,
@@ -143,22 +358,34 @@ class JobsDB:
                 str(job.type),
                 "\n".join(job.url),
                 job.pid,
+                job.priority,
+                job.submitter,
+                job.parent_id,
+                job.output,
+                json.dumps(job.timings),
             ),
         )
         job.id = cursor.lastrowid
-        self.conn.commit()
+        self.commit()
 
     def update_job(self, job):
         cursor = self.conn.cursor()
         cursor.execute(
             """
             UPDATE jobs
-            SET status = ?, log = ?, last_update = datetime() \
+            SET status = ?, log = ?, timings = ?, profile = ?, last_update = datetime() \
             WHERE id = ?;
             """,
-            (str(job.status), job.log, str(job.id)),
+            (str(job.status), job.log, json.dumps(job.timings), job.profile, str(job.id)),
         )
-        self.conn.commit()
+        self.commit()
+
+    def set_job_timings(self, job_id, timings):
+        # Left out of last_update, the stages are not a change of the job
+        self.conn.execute(
+            "UPDATE jobs SET timings = ? WHERE id = ?;", (json.dumps(timings), str(job_id))
+        )
+        self.commit()
 
     def set_job_status(self, job_id, status):
         cursor = self.conn.cursor()
@@ -170,7 +397,7 @@ class JobsDB:
             """,
             (str(status), str(job_id)),
         )
-        self.conn.commit()
+        self.commit()
 
     def set_job_pid(self, job_id, pid):
         cursor = self.conn.cursor()
@@ -182,7 +409,7 @@ class JobsDB:
             """,
             (str(pid), str(job_id)),
         )
-        self.conn.commit()
+        self.commit()
 
     def set_job_log(self, job_id, log):
         cursor = self.conn.cursor()
@@ -194,7 +421,64 @@ class JobsDB:
             """,
             (log, str(job_id)),
         )
-        self.conn.commit()
+        self.commit()
+
+    def append_job_log(self, job_id, log):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO job_logs
+                (job_id, seq, log)
+            SELECT ?, COALESCE(MAX(seq), 0) + 1, ?
+            FROM job_logs
+            WHERE job_id = ?;
+            """,
+            (str(job_id), log, str(job_id)),
+        )
+        cursor.execute(
+            "UPDATE jobs SET last_update = datetime() WHERE id = ?;",
+            (str(job_id),),
+        )
+        self.commit()
+
+    def delete_job_log(self, job_id):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM job_logs WHERE job_id = ?;", (str(job_id),))
+        self.commit()
+
+    def get_job_log(self, job_id, after=0):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT seq, log
+            FROM job_logs
+            WHERE job_id = ? AND seq > ?
+            ORDER BY seq;
+            """,
+            (job_id, after),
+        )
+        rows = cursor.fetchall()
+        lines = [line for _, log in rows for line in log.splitlines()]
+        return (rows[-1][0] if rows else after), lines
+
+    def get_job_log_tail(self, job_id, lines=100):
+        if lines <= 0:
+            return ""
+        cursor = self.conn.cursor()
+        # Every chunk holds at least one line, so the last `lines` chunks are
+        # always enough to fill the tail.
+        cursor.execute(
+            """
+            SELECT log
+            FROM job_logs
+            WHERE job_id = ?
+            ORDER BY seq DESC LIMIT ?;
+            """,
+            (job_id, lines),
+        )
+        chunks = [row[0] for row in cursor.fetchall()]
+        tail = "".join(reversed(chunks)).splitlines()[-lines:]
+        return "".join("%s\n" % line for line in tail)
 
     def set_job_name(self, job_id, name):
         cursor = self.conn.cursor()
@@ -206,13 +490,13 @@ class JobsDB:
             """,
             (name, str(job_id)),
         )
-        self.conn.commit()
+        self.commit()
 
     def purge_jobs(self):
         cursor = self.conn.cursor()
         cursor.execute("DELETE FROM jobs;")
-        self.conn.commit()
-        self.conn.execute("VACUUM")
+        cursor.execute("DELETE FROM job_logs;")
+        self.commit()
 
     def delete_job_safe(self, job_id):
         cursor = self.conn.cursor()
@@ -220,8 +504,13 @@ class JobsDB:
             "DELETE FROM jobs WHERE id = ? AND ( status = ? OR status = ? );",
             (str(job_id), Job.ABORTED, Job.FAILED),
         )
-        self.conn.commit()
-        self.conn.execute("VACUUM")
+        deleted = cursor.rowcount
+        cursor.execute(
+            "DELETE FROM job_logs WHERE job_id = ? AND job_id NOT IN (SELECT id FROM jobs);",
+            (str(job_id),),
+        )
+        self.commit()
+        return deleted
 
     def delete_job(self, job_id):
         cursor = self.conn.cursor()
@@ -229,35 +518,320 @@ class JobsDB:
             "DELETE FROM jobs WHERE id = ?;",
             (str(job_id),),
         )
-        self.conn.commit()
-        self.conn.execute("VACUUM")
+        deleted = cursor.rowcount
+        cursor.execute("DELETE FROM job_logs WHERE job_id = ?;", (str(job_id),))
+        self.commit()
+        return deleted
+
+    def delete_children(self, parent_id):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT status, COUNT(*) FROM jobs WHERE parent_id = ? GROUP BY status;",
+            (str(parent_id),),
+        )
+        deleted = dict(cursor.fetchall())
+        cursor.execute(
+            "DELETE FROM job_logs WHERE job_id IN (SELECT id FROM jobs WHERE parent_id = ?);",
+            (str(parent_id),),
+        )
+        cursor.execute("DELETE FROM jobs WHERE parent_id = ?;", (str(parent_id),))
+        self.commit()
+        return deleted
 
     def clean_old_jobs(self, limit=10):
+        if int(limit) <= 0:
+            return {}
         cursor = self.conn.cursor()
+        # Only the oldest job kept is needed: it gives the retention cutoff.
+        # Playlist entries don't count, they go with their playlist job.
         cursor.execute(
             """
             SELECT last_update
             FROM jobs
+            WHERE parent_id IS NULL
             ORDER BY last_update DESC
-            LIMIT ?;
+            LIMIT 1 OFFSET ?;
             """,
-            (str(limit),),
+            (int(limit) - 1,),
         )
         rows = list(cursor.fetchall())
+        deleted = {}
         if len(rows) > 0:
+            old_jobs = """
+                SELECT id FROM jobs
+                WHERE parent_id IS NULL AND last_update < ? AND status != ? and status != ?
+            """
+            params = (rows[-1][0], Job.PENDING, Job.RUNNING)
             cursor.execute(
-                "DELETE FROM jobs WHERE last_update < ? AND status != ? and status != ?;",
-                (rows[-1][0], Job.PENDING, Job.RUNNING),
+                """
+                SELECT status, COUNT(*)
+                FROM jobs
+                WHERE id IN (%s) OR parent_id IN (%s)
+                GROUP BY status;
+                """ % (old_jobs, old_jobs),
+                params * 2,
             )
-        self.conn.commit()
-        self.conn.execute("VACUUM")
+            deleted = dict(cursor.fetchall())
+            cursor.execute(
+                """
+                DELETE FROM job_logs
+                WHERE job_id IN (
+                    SELECT id FROM jobs WHERE id IN (%s) OR parent_id IN (%s)
+                );
+                """ % (old_jobs, old_jobs),
+                params * 2,
+            )
+            cursor.execute("DELETE FROM jobs WHERE parent_id IN (%s);" % old_jobs, params)
+            cursor.execute(
+                """
+                DELETE FROM jobs
+                WHERE parent_id IS NULL AND last_update < ? AND status != ? and status != ?;
+                """,
+                params,
+            )
+        self.commit()
+        return deleted
+
+    def get_cached_metadata(self, url, profile, ttl):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT info
+            FROM metadata_cache
+            WHERE url = ? AND profile = ? AND fetched > datetime('now', ?);
+            """,
+            (url, profile, "-%i seconds" % ttl),
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def cache_metadata(self, url, profile, info, ttl, max_entries):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO metadata_cache
+                (url, profile, info, fetched, last_used)
+            VALUES
+                (?, ?, ?, datetime(), datetime());
+            """,
+            (url, profile, info),
+        )
+        # Expired entries first, then the least recently used ones
+        cursor.execute(
+            "DELETE FROM metadata_cache WHERE fetched <= datetime('now', ?);",
+            ("-%i seconds" % ttl,),
+        )
+        cursor.execute(
+            """
+            DELETE FROM metadata_cache
+            WHERE rowid NOT IN (
+                SELECT rowid FROM metadata_cache ORDER BY last_used DESC LIMIT ?
+            );
+            """,
+            (max_entries,),
+        )
+        self.commit()
+
+    def touch_cached_metadata(self, url, profile):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "UPDATE metadata_cache SET last_used = datetime() WHERE url = ? AND profile = ?;",
+            (url, profile),
+        )
+        self.commit()
+
+    def index_media(self, job_id, archive_ids):
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            """
+            INSERT INTO download_index (archive_id, job_id)
+            VALUES (?, ?)
+            ON CONFLICT (archive_id) DO UPDATE SET job_id = excluded.job_id;
+            """,
+            [(archive_id, job_id) for archive_id in archive_ids],
+        )
+        self.commit()
+
+    def reindex_media(self, job_id, archive_ids):
+        # Replaces the ids guessed from the job URLs by the ones of their
+        # metadata
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "DELETE FROM download_index WHERE job_id = ? AND downloaded IS NULL;",
+            (str(job_id),),
+        )
+        self.index_media(job_id, archive_ids)
+
+    def set_media_downloaded(self, job_id):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT archive_id FROM download_index WHERE job_id = ? AND downloaded IS NULL;",
+            (str(job_id),),
+        )
+        archive_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "UPDATE download_index SET downloaded = datetime() WHERE job_id = ?;",
+            (str(job_id),),
+        )
+        self.commit()
+        return archive_ids
+
+    def import_downloaded_media(self, archive_ids):
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            """
+            INSERT INTO download_index (archive_id, downloaded)
+            VALUES (?, datetime())
+            ON CONFLICT (archive_id) DO UPDATE SET downloaded = COALESCE(downloaded, datetime());
+            """,
+            [(archive_id,) for archive_id in archive_ids],
+        )
+        self.commit()
+
+    def get_indexed_media(self, archive_ids):
+        cursor = self.conn.cursor()
+        indexed = {}
+        # Bulk requests can look up more ids than SQLite accepts parameters
+        for i in range(0, len(archive_ids), MAX_QUERY_PARAMS):
+            chunk = archive_ids[i:i + MAX_QUERY_PARAMS]
+            cursor.execute(
+                """
+                SELECT download_index.archive_id, job_id, downloaded, jobs.status
+                FROM download_index LEFT JOIN jobs ON jobs.id = download_index.job_id
+                WHERE archive_id IN (%s);
+                """ % ", ".join("?" * len(chunk)),
+                chunk,
+            )
+            indexed.update(
+                (
+                    archive_id,
+                    {
+                        "job_id": job_id,
+                        "downloaded": (
+                            JobsDB.convert_datetime_to_tz(downloaded) if downloaded else None
+                        ),
+                        "queued": status in (Job.PENDING, Job.RUNNING),
+                    },
+                )
+                for archive_id, job_id, downloaded, status in cursor.fetchall()
+            )
+        return indexed
+
+    def get_downloaded_media(self):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT archive_id FROM download_index WHERE downloaded IS NOT NULL ORDER BY downloaded;"
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_job_status(self, job_id):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT status FROM jobs WHERE id = ?;", (str(job_id),))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_job_parent(self, job_id):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT parent_id FROM jobs WHERE id = ?;", (str(job_id),))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def count_children_by_status(self, parent_id):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT status, COUNT(*) FROM jobs WHERE parent_id = ? GROUP BY status;",
+            (str(parent_id),),
+        )
+        return dict(cursor.fetchall())
+
+    def get_children_counts(self, job_ids):
+        if not job_ids:
+            return {}
+        cursor = self.conn.cursor()
+        counts = {}
+        for i in range(0, len(job_ids), MAX_QUERY_PARAMS):
+            chunk = job_ids[i:i + MAX_QUERY_PARAMS]
+            cursor.execute(
+                """
+                SELECT parent_id, status, COUNT(*)
+                FROM jobs
+                WHERE parent_id IN (%s)
+                GROUP BY parent_id, status;
+                """ % ", ".join("?" * len(chunk)),
+                chunk,
+            )
+            for parent_id, status, count in cursor.fetchall():
+                counts.setdefault(parent_id, {})[STATUS_NAME[status].lower()] = count
+        return counts
+
+    def get_children(self, parent_id):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT id, name, status, log, last_update, url, pid, output
+            FROM jobs
+            WHERE parent_id = ?
+            ORDER BY id;
+            """,
+            (str(parent_id),),
+        )
+        return [
+            {
+                "id": job_id,
+                "name": name,
+                "status": STATUS_NAME[status],
+                "current": log or "",
+                "last_update": JobsDB.convert_datetime_to_tz(last_update),
+                "urls": url.split("\n"),
+                "pid": pid,
+                "output": output,
+            }
+            for job_id, name, status, log, last_update, url, pid, output in cursor.fetchall()
+        ]
+
+    def get_unfinished_jobs(self):
+        # Playlist jobs already split into entries are resumed through them
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT id, name, type, format, url, priority, submitter, parent_id, output
+            FROM jobs
+            WHERE status IN (?, ?) AND id NOT IN (
+                SELECT parent_id FROM jobs WHERE parent_id IS NOT NULL
+            )
+            ORDER BY last_update, id;
+            """,
+            (Job.PENDING, Job.RUNNING),
+        )
+        return [
+            {
+                "id": job_id,
+                "name": name,
+                "type": jobtype,
+                "format": format,
+                "urls": url.split("\n"),
+                "priority": priority,
+                "submitter": submitter,
+                "parent_id": parent_id,
+                "output": output,
+            }
+            for (
+                job_id, name, jobtype, format, url, priority, submitter, parent_id, output
+            ) in cursor.fetchall()
+        ]
+
+    def count_jobs_by_status(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status;")
+        return dict(cursor.fetchall())
 
     def get_job_by_id(self, job_id):
         cursor = self.conn.cursor()
         cursor.execute(
             """
             SELECT
-                id, name, status, log, last_update, format, type, url, pid
+                id, name, status, log, last_update, format, type, url, pid, priority, submitter,
+                parent_id, output, timings
             FROM
                 jobs
             WHERE id = ?;
@@ -277,6 +851,11 @@ class JobsDB:
             jobtype,
             url,
             pid,
+            priority,
+            submitter,
+            parent_id,
+            output,
+            timings,
         ) = row
         return {
             "id": job_id,
@@ -288,110 +867,173 @@ class JobsDB:
             "type": jobtype,
             "urls": url.split("\n"),
             "pid": pid,
+            "priority": PRIORITY_NAME[priority],
+            "submitter": submitter,
+            "parent_id": parent_id,
+            "output": output,
+            "timings": json.loads(timings) if timings else {},
         }
 
-    def get_jobs_with_logs(self, limit=50, status=None):
+    def get_job_profile(self, job_id):
         cursor = self.conn.cursor()
+        cursor.execute("SELECT profile FROM jobs WHERE id = ?;", (job_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def get_jobs_filter(status=None, jobtype=None, profile=None, since=None, until=None):
+        # Only jobs without a parent are listed, their entries go with them
+        clauses, params = ["parent_id IS NULL"], []
         status = STATUS_NAME.index(status.capitalize()) if status and status.capitalize() in STATUS_NAME else -1
         if status >= 0:
-            cursor.execute(
-                """
-                SELECT
-                    id, name, status, log, last_update, format, type, url, pid
-                FROM
-                    jobs
-                WHERE
-                    status = ?
-                ORDER BY last_update DESC LIMIT ?;
-                """,
-                (status, str(limit),),
-            )
-        else:
-            cursor.execute(
-                """
-                SELECT
-                    id, name, status, log, last_update, format, type, url, pid
-                FROM
-                    jobs
-                ORDER BY last_update DESC LIMIT ?;
-                """,
-                (str(limit),),
-            )
-        rows = []
+            clauses.append("status = ?")
+            params.append(status)
+        if jobtype is not None:
+            clauses.append("type = ?")
+            params.append(int(jobtype))
+        if profile:
+            clauses.append("instr(',' || format || ',', ?) > 0")
+            params.append(",profile/%s," % profile)
+        # UTC timestamps, like last_update
+        if since:
+            clauses.append("last_update >= ?")
+            params.append(since)
+        if until:
+            clauses.append("last_update < ?")
+            params.append(until)
+        return " AND ".join(clauses), params
+
+    def get_jobs_page(self, limit=50, filters=None, after=None, log_lines=None):
+        # Jobs from the most recently updated one, continuing after the
+        # (last_update, id) key of the previous page. Returns the key of the
+        # last job when there are more.
+        cursor = self.conn.cursor()
+        where, params = JobsDB.get_jobs_filter(**(filters or {}))
+        if after is not None:
+            where += " AND (last_update, id) < (?, ?)"
+            params += list(after)
+        cursor.execute(
+            """
+            SELECT
+                id, name, status, last_update, format, type, url, pid, priority, submitter, log
+            FROM
+                jobs
+            WHERE
+                %s
+            ORDER BY last_update DESC, id DESC LIMIT ?;
+            """ % where,
+            params + [int(limit) + 1],
+        )
+        rows = cursor.fetchall()
+        next_key = (rows[limit - 1][3], rows[limit - 1][0]) if len(rows) > limit else None
+        jobs = []
         for (
             job_id,
             name,
             status,
-            log,
             last_update,
             format,
             jobtype,
             url,
             pid,
-        ) in cursor.fetchall():
-            rows.append(
-                {
-                    "id": job_id,
-                    "name": name,
-                    "status": STATUS_NAME[status],
-                    "log": log,
-                    "format": format,
-                    "last_update": JobsDB.convert_datetime_to_tz(last_update),
-                    "type": jobtype,
-                    "urls": url.split("\n"),
-                    "pid": pid,
-                }
-            )
-        return rows
+            priority,
+            submitter,
+            log,
+        ) in rows[:limit]:
+            job = {
+                "id": job_id,
+                "name": name,
+                "status": STATUS_NAME[status],
+                "format": format,
+                "last_update": JobsDB.convert_datetime_to_tz(last_update),
+                "type": jobtype,
+                "urls": url.split("\n"),
+                "pid": pid,
+                "priority": PRIORITY_NAME[priority],
+                "submitter": submitter,
+            }
+            if log_lines is not None:
+                job["log"] = self.get_job_log_tail(job_id, log_lines) + (log or "")
+                job["current"] = log or ""
+            jobs.append(job)
+        children = self.get_children_counts([job["id"] for job in jobs])
+        for job in jobs:
+            job["children"] = children.get(job["id"])
+        return jobs, next_key
 
-    def get_jobs(self, limit=50, status=None):
+    def search_jobs(self, terms, limit=20, search_logs=False):
+        # Only the most recent matches are ranked: FTS5 reads them in rowid
+        # order and stops early, while ranking every match of a common word
+        # takes as long as there are matches. Lower bm25 ranks are better,
+        # name matches weigh more than URL ones.
+        query = get_search_query(terms)
         cursor = self.conn.cursor()
-        status = STATUS_NAME.index(status.capitalize()) if status and status.capitalize() in STATUS_NAME else -1
-        if status >= 0:
-            cursor.execute(
-                """
-                SELECT
-                    id, name, status, last_update, format, type, url, pid
-                FROM
-                    jobs
-                WHERE
-                    status = ?
-                ORDER BY last_update DESC LIMIT ?;
-                """,
-                (status, str(limit),),
-            )
-        else:
+        cursor.execute(
+            """
+            SELECT rowid, bm25(jobs_search, 10.0, 1.0)
+            FROM jobs_search
+            WHERE jobs_search MATCH ?
+            ORDER BY rowid DESC LIMIT ?;
+            """,
+            (query, SEARCH_CANDIDATES),
+        )
+        scores = dict(cursor.fetchall())
+        log_matches = {}
+        if search_logs:
+            # Several chunks of a job log can match, only its best one is kept
             cursor.execute(
                 """
-                SELECT
-                    id, name, status, last_update, format, type, url, pid
-                FROM
-                    jobs
-                ORDER BY last_update DESC LIMIT ?;
+                SELECT job_logs.job_id, job_logs.log, bm25(job_logs_search)
+                FROM job_logs_search JOIN job_logs ON job_logs.rowid = job_logs_search.rowid
+                WHERE job_logs_search MATCH ?
+                ORDER BY job_logs_search.rowid DESC LIMIT ?;
                 """,
-                (str(limit),),
+                (query, SEARCH_CANDIDATES),
             )
-        rows = []
-        for (
-            job_id,
-            name,
-            status,
-            last_update,
-            format,
-            jobtype,
-            url,
-            pid,
-        ) in cursor.fetchall():
-            rows.append(
+            for job_id, log, score in cursor:
+                if job_id not in log_matches or score < log_matches[job_id][1]:
+                    log_matches[job_id] = (log, score)
+                scores[job_id] = min(scores.get(job_id, 0), score)
+        best = sorted(scores, key=scores.get)[:limit]
+        if not best:
+            return []
+
+        cursor.execute(
+            "SELECT id, name, status, last_update, url, parent_id FROM jobs WHERE id IN (%s);"
+            % ", ".join("?" * len(best)),
+            best,
+        )
+        jobs = {row[0]: row for row in cursor}
+        # Matches are only marked in the returned jobs, highlight() would read
+        # every ranked one
+        tokens = {fold_token(token) for phrase in terms for token in phrase}
+        results = []
+        for job_id in best:
+            if job_id not in jobs:
+                continue
+            _, name, status, last_update, url, parent_id = jobs[job_id]
+            results.append(
                 {
                     "id": job_id,
                     "name": name,
                     "status": STATUS_NAME[status],
-                    "format": format,
                     "last_update": JobsDB.convert_datetime_to_tz(last_update),
-                    "type": jobtype,
                     "urls": url.split("\n"),
-                    "pid": pid,
+                    "parent_id": parent_id,
+                    "score": scores[job_id],
+                    "name_match": mark_matches(name, tokens),
+                    "url_match": [mark_matches(u, tokens) for u in url.split("\n")],
+                    "log_match": (
+                        get_snippet(log_matches[job_id][0], tokens)
+                        if job_id in log_matches
+                        else None
+                    ),
                 }
             )
-        return rows
+        return results
+
+    def get_jobs_with_logs(self, limit=50, status=None, log_lines=100):
+        return self.get_jobs_page(limit, {"status": status}, log_lines=log_lines)[0]
+
+    def get_jobs(self, limit=50, status=None):
+        return self.get_jobs_page(limit, {"status": status})[0]
@@ -0,0 +1,134 @@
+import os
+import sqlite3
+from datetime import datetime
+from threading import Thread, Event, Lock
+from time import monotonic
+
+from ydl_server.logdb import JobsDB
+
+
+class DBMaintenance:
+    # Free pages released per transaction, so that the jobs writer never
+    # waits long on the database lock
+    VACUUM_STEP_PAGES = 256
+
+    def __init__(self, app_config):
+        self.app_config = app_config
+        self.thread = None
+        self.done = False
+        self.wakeup = Event()
+        self.lock = Lock()
+        self.requested = None
+        self.running = False
+        self.last_run = None
+        self.last_run_time = monotonic()
+        self.runs = 0
+
+        self.interval = app_config["ydl_server"].get("db_maintenance_interval", 3600)
+        self.freelist_threshold = (
+            app_config["ydl_server"].get("db_maintenance_freelist_mb", 16) * 2**20
+        )
+        self.wal_threshold = app_config["ydl_server"].get("db_maintenance_wal_mb", 64) * 2**20
+        self.wal_path = "%s-wal" % app_config["ydl_server"].get("metadata_db_path")
+
+    def start(self):
+        self.thread = Thread(target=self.worker)
+        self.thread.start()
+
+    def finish(self):
+        self.done = True
+        self.wakeup.set()
+
+    def join(self):
+        if self.thread is not None:
+            return self.thread.join()
+
+    def request_run(self, reason="requested"):
+        with self.lock:
+            if self.requested is None:
+                self.requested = reason
+        self.wakeup.set()
+
+    def get_wal_size(self):
+        try:
+            return os.path.getsize(self.wal_path)
+        except OSError:
+            return 0
+
+    def get_status(self, db):
+        stats = db.get_db_stats()
+        return {
+            "running": self.running,
+            "requested": self.requested,
+            "runs": self.runs,
+            "interval": self.interval,
+            "next_run_in": max(round(self.interval - (monotonic() - self.last_run_time)), 0),
+            "db_size": stats["page_count"] * stats["page_size"],
+            "free_size": stats["freelist_count"] * stats["page_size"],
+            "wal_size": self.get_wal_size(),
+            "last_run": self.last_run,
+        }
+
+    def get_run_reason(self):
+        with self.lock:
+            reason, self.requested = self.requested, None
+        if reason is not None:
+            return reason
+        if monotonic() - self.last_run_time >= self.interval:
+            return "interval"
+        if self.get_wal_size() >= self.wal_threshold:
+            return "wal_size"
+        db = JobsDB(readonly=True)
+        stats = db.get_db_stats()
+        db.close()
+        if stats["freelist_count"] * stats["page_size"] >= self.freelist_threshold:
+            return "freelist_size"
+        return None
+
+    def run(self, reason):
+        self.running = True
+        started_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        start = monotonic()
+        db = JobsDB(readonly=False)
+        try:
+            freed = 0
+            free_pages = db.get_db_stats()["freelist_count"]
+            while free_pages > 0 and not self.done:
+                db.incremental_vacuum(self.VACUUM_STEP_PAGES)
+                remaining = db.get_db_stats()["freelist_count"]
+                if remaining >= free_pages:
+                    break
+                freed, free_pages = freed + free_pages - remaining, remaining
+            db.analyze()
+            checkpoint = db.wal_checkpoint()
+            self.last_run = {
+                "reason": reason,
+                "started": started_at,
+                "duration": round(monotonic() - start, 3),
+                "freed_pages": freed,
+                "checkpoint": checkpoint,
+                "error": None,
+            }
+        except sqlite3.Error as e:
+            print("Error during database maintenance:\n{}:\n\t{}".format(type(e).__name__, str(e)))
+            self.last_run = {
+                "reason": reason,
+                "started": started_at,
+                "duration": round(monotonic() - start, 3),
+                "error": str(e),
+            }
+        finally:
+            db.close()
+            self.runs += 1
+            self.last_run_time = monotonic()
+            self.running = False
+
+    def worker(self):
+        while not self.done:
+            self.wakeup.wait(min(self.interval, 60))
+            self.wakeup.clear()
+            if self.done:
+                break
+            reason = self.get_run_reason()
+            if reason is not None:
+                self.run(reason)
@@ -0,0 +1,214 @@
+import math
+from threading import Lock
+from time import monotonic
+
+from starlette.routing import Match
+
+PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+JOB_DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 10800)
+
+
+def format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+
+
+# Metric families in the Prometheus text format, every sample identified by
+# the values of the family labels, in order
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = Lock()
+        self.values = {}
+
+    def get_samples(self):
+        with self.lock:
+            return [
+                ("", tuple(zip(self.labels, key, strict=True)), value)
+                for key, value in sorted(self.values.items())
+            ]
+
+    def render(self, openmetrics=False):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.type),
+        ]
+        for suffix, labels, value in self.get_samples():
+            lines.append(
+                "%s%s%s %s" % (self.name, suffix, format_labels(labels), format_value(value))
+            )
+        return lines
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def get_samples(self):
+        return [("_total", labels, value) for _, labels, value in super().get_samples()]
+
+    def render(self, openmetrics=False):
+        lines = super().render()
+        # The family is named without the suffix in OpenMetrics only
+        if not openmetrics:
+            lines[:2] = [
+                "# HELP %s_total %s" % (self.name, self.help),
+                "# TYPE %s_total counter" % self.name,
+            ]
+        return lines
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts, total = self.values.get(labels, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[labels] = (counts, total + value)
+
+    def get_samples(self):
+        samples = []
+        for _, labels, (counts, total) in super().get_samples():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts, strict=True):
+                cumulative += count
+                le = ("le", format_value(float(bound)))
+                samples.append(("_bucket", labels + (le,), cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+
+def render(metrics, openmetrics=False):
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render(openmetrics))
+    if openmetrics:
+        lines.append("# EOF")
+    return "".join("%s\n" % line for line in lines)
+
+
+# Measurements taken by the download workers, the jobs writer and the HTTP
+# requests. The queues and workers are read when the metrics are requested.
+class Metrics:
+    def __init__(self):
+        self.job_duration = Histogram(
+            "ydls_job_duration_seconds",
+            "Download jobs run time, by extractor, profile and final status",
+            ("extractor", "profile", "status"),
+            JOB_DURATION_BUCKETS,
+        )
+        self.downloaded_bytes = Counter(
+            "ydls_downloaded_bytes", "Size of the downloaded files", ("extractor",)
+        )
+        self.spawn_latency = Histogram(
+            "ydls_subprocess_spawn_seconds",
+            "Time until the youtube-dl process of a download is running",
+            ("engine",),
+        )
+        self.db_write_latency = Histogram(
+            "ydls_db_write_seconds", "Time to write and commit a batch of the jobs writer"
+        )
+        self.writer_lag = Histogram(
+            "ydls_jobs_writer_lag_seconds",
+            "Time the oldest action of a batch waited for the jobs writer",
+        )
+        self.http_latency = Histogram(
+            "ydls_http_request_duration_seconds",
+            "Time until the response starts, by route",
+            ("method", "route"),
+        )
+        self.http_requests = Counter(
+            "ydls_http_requests",
+            "HTTP requests, by route and status",
+            ("method", "route", "status"),
+        )
+
+    def get_metrics(self):
+        return [
+            self.job_duration,
+            self.downloaded_bytes,
+            self.spawn_latency,
+            self.db_write_latency,
+            self.writer_lag,
+            self.http_latency,
+            self.http_requests,
+        ]
+
+
+def get_route_path(routes, scope):
+    # Path template of the route handling the request, keeping the number of
+    # label values bounded
+    partial = None
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path or "/"
+        if match == Match.PARTIAL and partial is None:
+            # Same path, other method
+            partial = route.path
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app, metrics, routes):
+        self.app = app
+        self.metrics = metrics
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = monotonic()
+        # Matched before the routing updates the scope
+        route = get_route_path(self.routes, scope)
+
+        async def send_wrapper(message):
+            # Event streams never end, only the time to their first byte is
+            # measured
+            if message["type"] == "http.response.start":
+                self.metrics.http_latency.observe(monotonic() - start, scope["method"], route)
+                self.metrics.http_requests.inc(1, scope["method"], route, str(message["status"]))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
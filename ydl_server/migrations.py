@@ -0,0 +1,256 @@
+JOBS_TABLE = """
+    CREATE TABLE {name}
+        (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            log TEXT,
+            format TEXT,
+            last_update DATETIME DEFAULT CURRENT_TIMESTAMP,
+            type INTEGER NOT NULL DEFAULT 0,
+            url TEXT,
+            pid INTEGER
+        );
+"""
+JOBS_COLUMNS = ["id", "name", "status", "log", "format", "last_update", "type", "url", "pid"]
+
+
+def get_columns(cursor, table):
+    cursor.execute("PRAGMA table_info('%s')" % table)
+    return [row[1] for row in cursor.fetchall()]
+
+
+def create_jobs_tables(cursor):
+    columns = get_columns(cursor, "jobs")
+    if not columns:
+        cursor.execute(JOBS_TABLE.format(name="jobs"))
+    elif set(columns) != set(JOBS_COLUMNS):
+        # Tables created by older releases are rebuilt with the current
+        # columns, keeping every job they hold
+        print("Outdated jobs table, upgrading it")
+        kept = ", ".join(c for c in JOBS_COLUMNS if c in columns)
+        cursor.execute(JOBS_TABLE.format(name="jobs_upgrade"))
+        cursor.execute("INSERT INTO jobs_upgrade (%s) SELECT %s FROM jobs;" % (kept, kept))
+        cursor.execute("DROP TABLE jobs;")
+        cursor.execute("ALTER TABLE jobs_upgrade RENAME TO jobs;")
+    cursor.execute(
+        """
+        CREATE TABLE if not exists job_logs
+            (
+                job_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                log TEXT NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            );
+        """
+    )
+
+
+def create_jobs_indexes(cursor):
+    # Listing and retention walk the jobs from the most recently updated one,
+    # optionally for a single status
+    cursor.execute(
+        "CREATE INDEX if not exists jobs_last_update ON jobs (last_update);"
+    )
+    cursor.execute(
+        "CREATE INDEX if not exists jobs_status_last_update ON jobs (status, last_update);"
+    )
+
+
+def create_metadata_cache(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE if not exists metadata_cache
+            (
+                url TEXT NOT NULL,
+                profile TEXT NOT NULL,
+                info TEXT NOT NULL,
+                fetched DATETIME DEFAULT CURRENT_TIMESTAMP,
+                last_used DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (url, profile)
+            );
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX if not exists metadata_cache_last_used ON metadata_cache (last_used);"
+    )
+
+
+def add_jobs_priority(cursor):
+    cursor.execute(
+        "ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 1;"
+    )
+    cursor.execute("ALTER TABLE jobs ADD COLUMN submitter TEXT;")
+
+
+def add_jobs_parent(cursor):
+    # Playlist jobs are split into one child job per entry, downloaded with
+    # the output template of their playlist
+    cursor.execute("ALTER TABLE jobs ADD COLUMN parent_id INTEGER;")
+    cursor.execute("ALTER TABLE jobs ADD COLUMN output TEXT;")
+    # Listing and retention only walk the jobs without a parent
+    cursor.execute(
+        "CREATE INDEX if not exists jobs_parent_last_update ON jobs (parent_id, last_update);"
+    )
+
+
+def create_download_index(cursor):
+    # Media queued or downloaded, keyed like the youtube-dl download archives:
+    # "<extractor> <video id>"
+    cursor.execute(
+        """
+        CREATE TABLE if not exists download_index
+            (
+                archive_id TEXT PRIMARY KEY,
+                job_id INTEGER,
+                downloaded DATETIME
+            );
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX if not exists download_index_job_id ON download_index (job_id);"
+    )
+
+
+def create_jobs_status_index(cursor):
+    # Pages of the jobs history filtered by status, walked from the most
+    # recently updated job
+    cursor.execute(
+        "CREATE INDEX if not exists jobs_parent_status_last_update"
+        " ON jobs (parent_id, status, last_update);"
+    )
+
+
+def create_jobs_search(cursor):
+    # Full-text index of the job names and URLs, kept current by triggers so
+    # every write of the jobs writer updates it in the same transaction.
+    # The log index is filled when enabled, see set_log_search.
+    cursor.execute(
+        """
+        CREATE VIRTUAL TABLE jobs_search
+            USING fts5(name, url, content='jobs', content_rowid='id');
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER jobs_search_insert AFTER INSERT ON jobs BEGIN
+            INSERT INTO jobs_search (rowid, name, url) VALUES (new.id, new.name, new.url);
+        END;
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER jobs_search_delete AFTER DELETE ON jobs BEGIN
+            INSERT INTO jobs_search (jobs_search, rowid, name, url)
+                VALUES ('delete', old.id, old.name, old.url);
+        END;
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER jobs_search_update AFTER UPDATE OF name, url ON jobs BEGIN
+            INSERT INTO jobs_search (jobs_search, rowid, name, url)
+                VALUES ('delete', old.id, old.name, old.url);
+            INSERT INTO jobs_search (rowid, name, url) VALUES (new.id, new.name, new.url);
+        END;
+        """
+    )
+    cursor.execute("INSERT INTO jobs_search (jobs_search) VALUES ('rebuild');")
+    cursor.execute(
+        """
+        CREATE VIRTUAL TABLE job_logs_search
+            USING fts5(log, content='job_logs', content_rowid='rowid');
+        """
+    )
+
+
+def add_jobs_timings(cursor):
+    # JSON object of the job stage timestamps, and the profile taken while the
+    # job ran when profiling is enabled
+    cursor.execute("ALTER TABLE jobs ADD COLUMN timings TEXT;")
+    cursor.execute("ALTER TABLE jobs ADD COLUMN profile TEXT;")
+
+
+# Schema version N is reached by applying the first N migrations, in order.
+# Only ever append to this list.
+MIGRATIONS = [
+    create_jobs_tables,
+    create_jobs_indexes,
+    create_metadata_cache,
+    add_jobs_priority,
+    add_jobs_parent,
+    create_download_index,
+    create_jobs_status_index,
+    create_jobs_search,
+    add_jobs_timings,
+]
+
+
+def get_schema_version(conn):
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA user_version")
+    version = cursor.fetchone()[0]
+    cursor.close()
+    return version
+
+
+def migrate(conn):
+    current = get_schema_version(conn)
+    if current > len(MIGRATIONS):
+        raise Exception(
+            "Metadata DB schema version {} is newer than supported ({})".format(
+                current, len(MIGRATIONS)
+            )
+        )
+    for target, migration in enumerate(MIGRATIONS[current:], current + 1):
+        print("Migrating metadata DB to schema version {}".format(target))
+        # Each migration and its version bump are committed together, an
+        # interrupted upgrade resumes from the last completed step
+        conn.execute("BEGIN")
+        try:
+            migration(conn.cursor())
+            conn.execute("PRAGMA user_version = %i" % target)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def set_log_search(conn, enabled):
+    # Log chunks are only indexed while enabled, the index is rebuilt from
+    # the stored logs when enabling it again
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'job_logs_search_%';"
+    )
+    if bool(cursor.fetchone()[0]) == bool(enabled):
+        return
+    conn.execute("BEGIN")
+    try:
+        if enabled:
+            print("Indexing the job logs for search")
+            cursor.execute(
+                """
+                CREATE TRIGGER job_logs_search_insert AFTER INSERT ON job_logs BEGIN
+                    INSERT INTO job_logs_search (rowid, log) VALUES (new.rowid, new.log);
+                END;
+                """
+            )
+            cursor.execute(
+                """
+                CREATE TRIGGER job_logs_search_delete AFTER DELETE ON job_logs BEGIN
+                    INSERT INTO job_logs_search (job_logs_search, rowid, log)
+                        VALUES ('delete', old.rowid, old.log);
+                END;
+                """
+            )
+            cursor.execute("INSERT INTO job_logs_search (job_logs_search) VALUES ('rebuild');")
+        else:
+            print("Removing the job logs search index")
+            cursor.execute("DROP TRIGGER job_logs_search_insert;")
+            cursor.execute("DROP TRIGGER job_logs_search_delete;")
+            cursor.execute("INSERT INTO job_logs_search (job_logs_search) VALUES ('delete-all');")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
@@ -0,0 +1,54 @@
+import importlib.metadata
+import json
+import os
+
+
+def get_ydl_website(ydl_module_name):
+    try:
+        metadata = importlib.metadata.metadata(ydl_module_name)
+    except importlib.metadata.PackageNotFoundError:
+        return ""
+    if metadata.get("Home-page"):
+        return metadata["Home-page"]
+    # Newer packages only list labelled project URLs
+    urls = dict(
+        url.split(", ", 1) for url in metadata.get_all("Project-URL") or [] if ", " in url
+    )
+    for label in ("Homepage", "Repository", "Source"):
+        if label in urls:
+            return urls[label]
+    return ""
+
+
+def get_ydl_extractors(ydl_module, age_limit):
+    return [ie.IE_NAME for ie in ydl_module.extractor.list_extractors(age_limit) if ie._WORKING]
+
+
+# youtube-dl module information that takes a while to gather, kept on disk
+# for the next starts with the same module, version and settings
+class ModuleInfoCache:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, key):
+        if not self.path:
+            return None
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or cached.get("key") != key:
+            return None
+        return cached.get("info")
+
+    def save(self, key, info):
+        if not self.path:
+            return
+        tmp_path = "%s.tmp" % self.path
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"key": key, "info": info}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print("Could not write the module cache {}: {}".format(self.path, e))
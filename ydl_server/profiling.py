@@ -0,0 +1,83 @@
+import cProfile
+import io
+import pstats
+import tracemalloc
+from threading import Lock
+
+PROFILE_LINES = 30
+ALLOCATION_LINES = 25
+
+# A single cProfile profiler can be enabled at a time since Python 3.12, it
+# then sees every thread: the jobs running alongside a profiled one are left
+# out.
+profiler_lock = Lock()
+
+
+def start_tracing():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def get_allocations(limit=ALLOCATION_LINES):
+    # Memory currently held by the server, by allocation site. Snapshots of
+    # the whole heap take seconds, they are only taken on request.
+    if not tracemalloc.is_tracing():
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    stats = tracemalloc.take_snapshot().statistics("lineno")
+    lines = [
+        "Traced memory: %.1f KiB, peak %.1f KiB" % (current / 1024, peak / 1024),
+        "Top %i allocation sites:" % limit,
+    ]
+    for stat in stats[:limit]:
+        frame = stat.traceback[0]
+        lines.append(
+            "%10.1f KiB %8i blocks  %s:%i"
+            % (stat.size / 1024, stat.count, frame.filename, frame.lineno)
+        )
+    return "\n".join(lines)
+
+
+# Profile of the server thread running a job: the calls made while it ran and
+# the memory allocated meanwhile, as text stored with the job
+class JobProfiler:
+    def __init__(self):
+        self.profile = None
+        self.memory = None
+        self.report = None
+
+    def __enter__(self):
+        if not profiler_lock.acquire(blocking=False):
+            return self
+        self.profile = cProfile.Profile()
+        try:
+            self.profile.enable()
+        except ValueError:
+            # Another profiler is running
+            self.profile = None
+            profiler_lock.release()
+            return self
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self.memory = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profile is None:
+            self.report = "Not profiled, another job was being profiled"
+            return False
+        self.profile.disable()
+        parts = []
+        if self.memory is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            parts.append(
+                "Traced memory: %+.1f KiB, peak %+.1f KiB"
+                % ((current - self.memory) / 1024, (peak - self.memory) / 1024)
+            )
+        profiler_lock.release()
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+        parts.append(stream.getvalue().strip())
+        self.report = "\n\n".join(parts)
+        return False
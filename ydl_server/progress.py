@@ -0,0 +1,252 @@
+import re
+from threading import Lock
+from time import time
+
+# yt-dlp prints the raw progress hook values on this line instead of its
+# progress bar, see ProgressOutput
+PROGRESS_MARKER = b"[ydls-progress]"
+PROGRESS_TEMPLATE_FIELDS = (
+    "status",
+    "downloaded_bytes",
+    "total_bytes",
+    "total_bytes_estimate",
+    "speed",
+    "eta",
+    "playlist_index",
+    "n_entries",
+)
+PROGRESS_TEMPLATE = "download:%s %s" % (
+    PROGRESS_MARKER.decode(),
+    " ".join(
+        "%%(%s.%s)s" % ("info" if field in ("playlist_index", "n_entries") else "progress", field)
+        for field in PROGRESS_TEMPLATE_FIELDS
+    ),
+)
+# Fields of a job's progress, with the playlist_index and playlist_count of
+# the entry being downloaded
+PROGRESS_KEYS = ("percent", "downloaded_bytes", "total_bytes", "speed", "eta")
+# Modules supporting --progress-template, the others print their progress bar
+PROGRESS_TEMPLATE_MODULES = ("yt-dlp",)
+
+# Progress bar of youtube-dl with --newline
+DOWNLOAD_LINE = re.compile(
+    rb"\[download\]\s+(?P<percent>[\d.]+)%\s+of\s+~?\s*(?P<total>[\d.]+\s*[KMGTPEZY]?i?B)"
+    rb"(?:\s+at\s+(?:(?P<speed>[\d.]+\s*[KMGTPEZY]?i?B)/s|Unknown speed))?"
+    rb"(?:\s+ETA\s+(?P<eta>[\d:]+))?"
+)
+PLAYLIST_LINE = re.compile(rb"\[download\] Downloading (?:video|item) (\d+) of (\d+)")
+# Lines of the post-processors run once the files are downloaded
+POSTPROCESS_LINE = re.compile(
+    rb"\[(?:ffmpeg|Merger|ExtractAudio|Fixup\w*|Video\w+|Embed\w+|Metadata|"
+    rb"ThumbnailsConvertor|SponsorBlock|ModifyChapters|SplitChapters)\]"
+)
+SIZE = re.compile(rb"([\d.]+)\s*([KMGTPEZY]?)(i?)B")
+# stderr is merged into the output, its status lines end with a carriage return
+LINE_END = re.compile(rb"\r\n|\r|\n")
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%02i:%02i:%02i" % (hours, minutes, seconds)
+    return "%02i:%02i" % (minutes, seconds)
+
+
+def format_progress(progress, total, format_bytes):
+    percent = (
+        "%5.1f%%" % (100 * (progress.get("downloaded_bytes") or 0) / total)
+        if total
+        else "Unknown %"
+    )
+    speed = progress.get("speed")
+    return "[download] %s of %s at %s ETA %s" % (
+        percent,
+        format_bytes(total),
+        "%s/s" % format_bytes(speed) if speed else "Unknown B/s",
+        format_seconds(progress.get("eta")),
+    )
+
+
+def parse_size(size):
+    match = SIZE.fullmatch(size.replace(b" ", b""))
+    if match is None:
+        return None
+    number, prefix, binary = match.groups()
+    return int(float(number) * (1024 if binary else 1000) ** b" KMGTPEZY".index(prefix or b" "))
+
+
+def parse_seconds(duration):
+    seconds = 0
+    for part in duration.split(b":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def parse_number(value):
+    if value in (b"NA", b"None", b""):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_progress_line(line):
+    # Progress hook fields of a progress line, None for the other lines
+    if line.startswith(PROGRESS_MARKER):
+        values = line[len(PROGRESS_MARKER):].split()
+        return {
+            field: value.decode() if field == "status" else parse_number(value)
+            for field, value in zip(PROGRESS_TEMPLATE_FIELDS, values, strict=False)
+        }
+    match = DOWNLOAD_LINE.match(line)
+    if match is None:
+        return None
+    percent = float(match.group("percent"))
+    total = parse_size(match.group("total"))
+    speed, eta = match.group("speed"), match.group("eta")
+    return {
+        "status": "finished" if percent >= 100 else "downloading",
+        "percent": percent,
+        "downloaded_bytes": total * percent / 100 if total else None,
+        "total_bytes": total,
+        "speed": parse_size(speed) if speed else None,
+        "eta": parse_seconds(eta) if eta else None,
+    }
+
+
+# Latest progress of a download, from the progress hook fields of youtube-dl
+class ProgressTracker:
+    def __init__(self):
+        self.lock = Lock()
+        self.progress = None
+        self.playlist_index = None
+        self.playlist_count = None
+        # Size of the files downloaded so far
+        self.downloaded_bytes = 0
+        self.finished = False
+        # Times of the last download progress and of the first post-processor
+        self.last_download = None
+        self.postprocess_start = None
+
+    def postprocessing(self):
+        with self.lock:
+            if self.postprocess_start is None:
+                self.postprocess_start = time()
+
+    def update(self, hook):
+        if hook.get("status") == "postprocessing":
+            self.postprocessing()
+            return
+        total = hook.get("total_bytes") or hook.get("total_bytes_estimate")
+        downloaded = hook.get("downloaded_bytes")
+        if hook.get("status") == "finished":
+            percent = 100.0
+        elif total and downloaded is not None:
+            percent = min(100 * downloaded / total, 100.0)
+        else:
+            percent = hook.get("percent")
+        progress = {
+            "percent": round(percent, 1) if percent is not None else None,
+            "downloaded_bytes": int(downloaded) if downloaded is not None else None,
+            "total_bytes": int(total) if total else None,
+            "speed": int(hook["speed"]) if hook.get("speed") else None,
+            "eta": int(hook["eta"]) if hook.get("eta") is not None else None,
+        }
+        with self.lock:
+            self.progress = progress
+            # Counted once per file, progress bars repeat their last line
+            finished = hook.get("status") == "finished"
+            if finished and not self.finished:
+                self.downloaded_bytes += progress["total_bytes"] or progress["downloaded_bytes"] or 0
+            self.finished = finished
+            self.last_download = time()
+        if hook.get("playlist_index") is not None:
+            self.set_playlist(hook["playlist_index"], hook.get("n_entries"))
+
+    def set_playlist(self, index, count):
+        with self.lock:
+            self.playlist_index = int(index)
+            self.playlist_count = int(count) if count is not None else None
+
+    def get(self):
+        with self.lock:
+            if self.progress is None and self.playlist_index is None:
+                return None
+            progress = dict(self.progress or dict.fromkeys(PROGRESS_KEYS))
+            progress["playlist_index"] = self.playlist_index
+            progress["playlist_count"] = self.playlist_count
+            return progress
+
+
+# Reads the --newline output of the youtube-dl command: progress lines update
+# the tracker and are passed on as a progress bar overwriting the current
+# line, like the command prints it on a terminal.
+class ProgressOutput:
+    def __init__(self, output, tracker, format_bytes):
+        self.output = output
+        self.tracker = tracker
+        self.format_bytes = format_bytes
+        self.partial = b""
+        self.in_progress = False
+        self.after_cr = False
+
+    def feed(self, data):
+        # Only the text after the last line end is kept for the next read
+        start = 0
+        if self.after_cr and data.startswith(b"\n"):
+            # End of a \r\n split between two reads
+            start = 1
+        self.after_cr = data.endswith(b"\r")
+        for match in LINE_END.finditer(data, start):
+            line = data[start:match.start()]
+            if self.partial:
+                line = self.partial + line
+                self.partial = b""
+            if match.group() == b"\r":
+                self.feed_current(line)
+            else:
+                self.feed_line(line)
+            start = match.end()
+        self.partial += data[start:]
+        return len(data)
+
+    def feed_progress(self, line):
+        hook = parse_progress_line(line)
+        if hook is None:
+            return False
+        self.tracker.update(hook)
+        if line.startswith(PROGRESS_MARKER):
+            total = hook.get("total_bytes") or hook.get("total_bytes_estimate")
+            line = format_progress(hook, total, self.format_bytes).encode()
+        self.output.feed(b"\r" + line)
+        self.in_progress = True
+        return True
+
+    def feed_current(self, line):
+        # Status lines redrawn after a carriage return (ffmpeg, external
+        # downloaders) overwrite the current line, like on a terminal
+        if line and not self.feed_progress(line):
+            self.output.feed(b"\r" + line)
+            self.in_progress = True
+
+    def feed_line(self, line):
+        if self.feed_progress(line):
+            return
+        match = PLAYLIST_LINE.match(line)
+        if match is not None:
+            self.tracker.set_playlist(int(match.group(1)), int(match.group(2)))
+        elif POSTPROCESS_LINE.match(line):
+            self.tracker.postprocessing()
+        # Ends the progress bar line, it stays in the log as it was last drawn
+        self.output.feed((b"\n" if self.in_progress else b"") + line + b"\n")
+        self.in_progress = False
+
+    def close(self):
+        if self.partial:
+            self.feed_line(self.partial)
+            self.partial = b""
+        self.output.close()
@@ -0,0 +1,154 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies are not worth the compressed copies
+MIN_COMPRESSED_SIZE = 256
+# Larger static files are left to FileResponse
+MAX_CACHED_SIZE = 8 * 2**20
+COMPRESSIBLE_TYPE = re.compile(r"text/|application/(json|javascript|xml|manifest\+json)|image/svg\+xml")
+# Vite names the built assets after a hash of their content
+HASHED_ASSET = re.compile(r"(^|/)assets/[^/]+-[\w-]{8,}\.\w+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def render_json(content):
+    # Same serialization as JSONResponse
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def get_accepted_encodings(header):
+    encodings = set()
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+
+def etag_matches(if_none_match, etag):
+    # Weak comparison, as If-None-Match requires
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+# Response body encoded once with every content coding the server supports,
+# each one with its own strong ETag
+class CachedBody:
+    def __init__(self, body, media_type, cache_control="no-cache"):
+        self.body = body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+        self.encoded = {}
+        if len(body) >= MIN_COMPRESSED_SIZE and COMPRESSIBLE_TYPE.match(media_type):
+            # In order of preference
+            if brotli is not None:
+                self.add_encoding("br", brotli.compress(body, quality=11))
+            self.add_encoding("gzip", gzip.compress(body, 9, mtime=0))
+
+    def add_encoding(self, coding, body):
+        if len(body) < len(self.body):
+            self.encoded[coding] = body
+
+    def response(self, request_headers, status_code=200):
+        accepted = get_accepted_encodings(request_headers.get("accept-encoding", ""))
+        coding = next((coding for coding in self.encoded if coding in accepted), None)
+        headers = {
+            "ETag": '"%s%s"' % (self.digest, "-" + coding if coding else ""),
+            "Cache-Control": self.cache_control,
+        }
+        if self.encoded:
+            headers["Vary"] = "Accept-Encoding"
+        if_none_match = request_headers.get("if-none-match")
+        if status_code == 200 and if_none_match and etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        if coding is not None:
+            headers["Content-Encoding"] = coding
+        return Response(
+            self.encoded[coding] if coding else self.body,
+            status_code=status_code,
+            media_type=self.media_type,
+            headers=headers,
+        )
+
+
+# Bodies of the API responses that only change with the configuration or the
+# youtube-dl module, rebuilt when the key they were built for changes
+class ResponseCache:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, name, key, build):
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != key:
+            entry = (key, CachedBody(render_json(build()), "application/json"))
+            self.entries[name] = entry
+        return entry[1]
+
+    def json_response(self, request, name, key, build):
+        return self.get(name, key, build).response(request.headers)
+
+
+# The built frontend, kept in memory with its compressed copies. Hashed asset
+# files never change under the same name and are cached for good by browsers.
+class CachedStaticFiles(StaticFiles):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.files = {}
+
+    def get_cached(self, full_path, stat_result):
+        key = (stat_result.st_mtime_ns, stat_result.st_size)
+        cached = self.files.get(full_path)
+        if cached is None or cached[0] != key:
+            with open(full_path, "rb") as f:
+                body = f.read()
+            relative = os.path.relpath(full_path, os.path.realpath(self.directory))
+            cached = (
+                key,
+                CachedBody(
+                    body,
+                    mimetypes.guess_type(full_path)[0] or "text/plain",
+                    IMMUTABLE if HASHED_ASSET.search(relative) else "no-cache",
+                ),
+            )
+            self.files[full_path] = cached
+        return cached[1]
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        if stat_result.st_size > MAX_CACHED_SIZE:
+            return super().file_response(full_path, stat_result, scope, status_code)
+        return self.get_cached(full_path, stat_result).response(Headers(scope=scope), status_code)
+
+    def warm(self):
+        # Compresses the files before their first request
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                full_path = os.path.realpath(os.path.join(dirpath, filename))
+                try:
+                    stat_result = os.stat(full_path)
+                    if stat_result.st_size <= MAX_CACHED_SIZE:
+                        self.get_cached(full_path, stat_result)
+                except OSError:
+                    continue
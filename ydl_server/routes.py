@@ -5,8 +5,9 @@ from ydl_server.config import get_finished_path
 
 from starlette.routing import Route, Mount
 from starlette.staticfiles import StaticFiles
+from ydl_server.responsecache import CachedStaticFiles
 
-static = StaticFiles(directory=str(Path(__file__).parent / "static"), html=True)
+static = CachedStaticFiles(directory=str(Path(__file__).parent / "static"), html=True)
 
 finished_files = StaticFiles(directory=get_finished_path())
 
@@ -14,8 +15,21 @@ routes = [
     Route("/api/extractors", views.api_list_extractors, name="api_list_extractors"),
     Route("/api/formats", views.api_list_formats, name="api_list_formats"),
     Route("/api/info", views.api_server_info, name="api_server_info"),
+    Route("/metrics", views.api_metrics, name="api_metrics"),
+    Route("/api/profile", views.api_profile, name="api_profile"),
+    Route("/api/workers", views.api_workers, name="api_workers"),
+    Route(
+        "/api/workers",
+        views.api_workers_resize,
+        name="api_workers_resize",
+        methods=["POST"],
+    ),
     Route("/api/downloads/stats", views.api_queue_size, name="api_queue_size"),
+    Route("/api/downloads/limits", views.api_limits, name="api_limits"),
+    Route("/api/downloads/archive", views.api_download_archive, name="api_download_archive"),
+    Route("/api/downloads/search", views.api_logs_search, name="api_logs_search"),
     Route("/api/downloads", views.api_logs, name="api_logs"),
+    Route("/api/events", views.api_events, name="api_events"),
     Route("/api/downloads/clean", views.api_logs_clean, name="api_logs_clean"),
     Route(
         "/api/downloads",
@@ -29,6 +43,19 @@ routes = [
         name="api_queue_download",
         methods=["POST"],
     ),
+    Route(
+        "/api/downloads/bulk",
+        views.api_queue_bulk,
+        name="api_queue_bulk",
+        methods=["POST"],
+    ),
+    Route("/api/maintenance", views.api_maintenance_status, name="api_maintenance_status"),
+    Route(
+        "/api/maintenance",
+        views.api_maintenance_run,
+        name="api_maintenance_run",
+        methods=["POST"],
+    ),
     Route(
         "/api/metadata",
         views.api_metadata_fetch,
@@ -54,12 +81,36 @@ routes = [
         name="api_jobs_retry",
         methods=["POST"],
     ),
+    Route(
+        "/api/jobs/{job_id:str}/children",
+        views.api_jobs_children,
+        name="api_jobs_children",
+        methods=["GET"],
+    ),
+    Route(
+        "/api/jobs/{job_id:str}/log",
+        views.api_jobs_log,
+        name="api_jobs_log",
+        methods=["GET"],
+    ),
+    Route(
+        "/api/jobs/{job_id:str}",
+        views.api_jobs_get,
+        name="api_jobs_get",
+        methods=["GET"],
+    ),
     Route(
         "/api/jobs/{job_id:str}",
         views.api_jobs_delete,
         name="api_jobs_delete",
         methods=["DELETE"],
     ),
+    Route(
+        "/api/archive/{fname:path}",
+        views.api_finished_archive,
+        name="api_finished_archive",
+        methods=["GET"],
+    ),
     Mount("/api/finished/", finished_files, name="api_finished"),
     Mount("/", static, name="static"),
 ]
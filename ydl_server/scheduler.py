@@ -0,0 +1,103 @@
+from collections import OrderedDict, deque
+from threading import Condition
+from urllib.parse import urlsplit
+
+from ydl_server.logdb import PRIORITY_NAME
+
+
+def get_domain(urls):
+    if not urls:
+        return ""
+    return urlsplit(urls[0].strip()).netloc.lower()
+
+
+# Round-robin over the first key, then over the next ones within it: with
+# (submitter, domain) keys, every submitter gets its turn and shares it
+# between the domains it downloads from.
+class FairQueue:
+    def __init__(self, depth):
+        self.depth = depth
+        self.queues = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def put(self, keys, item):
+        queue = self.queues.get(keys[0])
+        if queue is None:
+            queue = FairQueue(self.depth - 1) if self.depth > 1 else deque()
+            self.queues[keys[0]] = queue
+        if self.depth > 1:
+            queue.put(keys[1:], item)
+        else:
+            queue.append(item)
+        self.size += 1
+
+    def get(self, eligible=None):
+        # Keys whose next item is not eligible keep their place in line
+        for key, queue in list(self.queues.items()):
+            if self.depth > 1:
+                item = queue.get(eligible)
+                if item is None:
+                    continue
+            elif eligible is None or eligible(queue[0]):
+                item = queue.popleft()
+            else:
+                continue
+            # Back of the line until every other key had its turn
+            del self.queues[key]
+            if len(queue):
+                self.queues[key] = queue
+            self.size -= 1
+            return item
+
+
+# Download queue with one lane per priority class: a job is only started when
+# no job of a higher priority is waiting, unless the download limits of its
+# extractor or host hold it back.
+class JobScheduler:
+    def __init__(self, limits):
+        self.cond = Condition()
+        self.lanes = [FairQueue(2) for _ in PRIORITY_NAME]
+        self.limits = limits
+
+    def put(self, job):
+        domain = get_domain(job.url)
+        job.limits = self.limits.get_limits(domain, job.url[0] if job.url else "")
+        with self.cond:
+            self.lanes[job.priority].put((job.submitter or "", domain), job)
+            self.cond.notify()
+
+    def get(self, stop=None):
+        # Returns None once stop() is true, see wakeup()
+        with self.cond:
+            while True:
+                if stop is not None and stop():
+                    return None
+                for lane in self.lanes:
+                    job = lane.get(self.limits.allows)
+                    if job is not None:
+                        self.limits.acquire(job)
+                        return job
+                self.cond.wait(self.limits.get_wait_time() if self.qsize() else None)
+
+    def done(self, job):
+        with self.cond:
+            self.limits.release(job)
+            self.cond.notify_all()
+
+    def wakeup(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def qsize(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def get_lanes(self):
+        with self.cond:
+            return {name: len(lane) for name, lane in zip(PRIORITY_NAME, self.lanes, strict=True)}
+
+    def get_limits(self):
+        with self.cond:
+            return self.limits.get_usage()
@@ -1,59 +1,113 @@
-from starlette.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 
-from operator import itemgetter
 from pathlib import Path
 from ydl_server.config import app_config, get_finished_path, get_ydl_formats
-from ydl_server.logdb import JobsDB, Job, Actions, JobType
-from datetime import datetime
+from ydl_server.logdb import (
+    Job,
+    Actions,
+    JobType,
+    PRIORITY_NAME,
+    STATUS_NAME,
+    get_search_terms,
+    get_stage_durations,
+)
+from ydl_server.metrics import (
+    OPENMETRICS_TYPE,
+    PROMETHEUS_TYPE,
+    Counter,
+    Gauge,
+    render,
+)
+from ydl_server.profiling import get_allocations
+from ydl_server.finished import SORT_KEYS, cursor_matches, decode_cursor, encode_cursor
+from ydl_server.archive import (
+    ARCHIVE_MEDIA_TYPES,
+    TarArchive,
+    get_range,
+    list_entries,
+    stream_zip,
+)
+from datetime import datetime, timezone
+from urllib.parse import quote
+from threading import Event
+import json
 import os
 import signal
 import shutil
+import zlib
+
+# Longest wait for the jobs writer to store a bulk request
+BULK_INSERT_TIMEOUT = 60
+MAX_SEARCH_RESULTS = 100
+MAX_LOG_PAGE_SIZE = 1000
 
 
 async def api_finished(request):
-    root_dir = Path(get_finished_path())
-    matches = root_dir.glob("*")
+    sort = request.query_params.get("sort", "name")
+    order = request.query_params.get("order", "asc")
+    if sort not in SORT_KEYS or order not in ("asc", "desc"):
+        return JSONResponse(
+            {
+                "success": False,
+                "error": "'sort' must be one of {} and 'order' asc or desc".format(
+                    ", ".join(SORT_KEYS)
+                ),
+            },
+            status_code=400,
+        )
+    limit, cursor = request.query_params.get("limit"), request.query_params.get("cursor")
+    if limit is not None and (not limit.isdigit() or int(limit) == 0):
+        return JSONResponse(
+            {"success": False, "error": "'limit' must be a positive integer"}, status_code=400
+        )
+    after = decode_cursor(cursor) if cursor is not None else None
+    if cursor is not None and (after is None or not cursor_matches(after, sort)):
+        return JSONResponse({"success": False, "error": "Invalid 'cursor'"}, status_code=400)
+
+    def get_etag(version):
+        return 'W/"%x-%x-%x"' % (
+            request.app.state.jobshandler.events.boot,
+            version,
+            zlib.crc32(request.url.query.encode()),
+        )
+
+    index = request.app.state.finished_index
+    if request.headers.get("If-None-Match") == get_etag(index.get_version()):
+        return Response(
+            status_code=304,
+            headers={"ETag": get_etag(index.version), "Cache-Control": "no-cache"},
+        )
+    version, files, next_cursor, total = index.get_page(
+        sort,
+        order,
+        int(limit) if limit is not None else None,
+        after,
+    )
+    headers = {"ETag": get_etag(version), "Cache-Control": "no-cache"}
+    # Without a page size, the plain list of every file of earlier releases
+    if limit is None and cursor is None:
+        return JSONResponse(files, headers=headers)
+    return JSONResponse(
+        {"success": True, "files": files, "next_cursor": next_cursor, "total": total},
+        headers=headers,
+    )
 
-    files = [
-        {
-            "name": f1.name,
-            "modified": datetime.fromtimestamp(f1.stat().st_mtime).strftime("%H:%m %D"),
-            "created": datetime.fromtimestamp(f1.stat().st_ctime).strftime("%H:%m %D"),
-            "size": f1.stat().st_size if not f1.is_dir() else None,
-            "directory": f1.is_dir(),
-            "children": sorted(
-                [
-                    {
-                        "name": f2.name,
-                        "size": f2.stat().st_size,
-                        "modified": datetime.fromtimestamp(f2.stat().st_mtime).strftime(
-                            "%H:%m %D"
-                        ),
-                        "created": datetime.fromtimestamp(f2.stat().st_ctime).strftime(
-                            "%H:%m %D"
-                        ),
-                    }
-                    for f2 in f1.iterdir()
-                    if not f2.name.startswith(".")
-                ],
-                key=itemgetter("modified"),
-                reverse=True,
-            )
-            if f1.is_dir()
-            else None,
-        }
-        for f1 in matches
-        if not f1.name.startswith(".")
-    ]
-    return JSONResponse(files)
+
+def get_finished_file(fname):
+    # Real path of a file of the finished directory, None outside of it
+    fname = os.path.realpath(os.path.join(get_finished_path(), fname))
+    if os.path.commonprefix((fname, get_finished_path())) != get_finished_path():
+        return None
+    return fname
 
 
 async def api_delete_file(request):
     fname = request.path_params["fname"]
     if not fname:
         return JSONResponse({"success": False, "message": "No filename specified"})
-    fname = os.path.realpath(os.path.join(get_finished_path(), fname))
-    if os.path.commonprefix((fname, get_finished_path())) != get_finished_path():
+    fname = get_finished_file(fname)
+    if fname is None:
         return JSONResponse({"success": False, "message": "Invalid filename"})
     fname = Path(fname)
     try:
@@ -66,67 +120,320 @@ async def api_delete_file(request):
         return JSONResponse(
             {"success": False, "message": "Could not delete the specified file"}
         )
+    request.app.state.finished_index.refresh(
+        os.path.relpath(str(fname), get_finished_path())
+    )
 
     return JSONResponse({"success": True, "message": "File deleted"})
 
 
-async def api_list_extractors(request):
-    return JSONResponse(request.app.state.ydlhandler.ydl_extractors)
-
+async def api_finished_archive(request):
+    archive_format = request.query_params.get("format", "zip")
+    if archive_format not in ARCHIVE_MEDIA_TYPES:
+        return JSONResponse(
+            {
+                "success": False,
+                "message": "'format' must be one of {}".format(", ".join(ARCHIVE_MEDIA_TYPES)),
+            },
+            status_code=400,
+        )
+    path = get_finished_file(request.path_params["fname"])
+    if path is None:
+        return JSONResponse({"success": False, "message": "Invalid filename"}, status_code=400)
+    if not os.path.isdir(path):
+        return JSONResponse({"success": False, "message": "No such directory"}, status_code=404)
+    try:
+        # Lists and stats every file of the directory
+        entries = await run_in_threadpool(list_entries, path)
+    except OSError as e:
+        print(e)
+        return JSONResponse(
+            {"success": False, "message": "Could not read the specified directory"},
+            status_code=500,
+        )
 
-async def api_server_info(request):
-    return JSONResponse(
+    headers = {
+        "Content-Disposition": "attachment; filename*=UTF-8''{}.{}".format(
+            quote(os.path.basename(path)), archive_format
+        ),
+    }
+    media_type = ARCHIVE_MEDIA_TYPES[archive_format]
+    # Stored entries with data descriptors: the size of a zip is only known
+    # once it is sent, so it can not be resumed
+    if archive_format == "zip":
+        return StreamingResponse(stream_zip(entries), media_type=media_type, headers=headers)
+
+    archive = await run_in_threadpool(TarArchive, entries)
+    headers.update({"Accept-Ranges": "bytes", "ETag": archive.etag})
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    if "Range" in request.headers and (if_range is None or if_range == archive.etag):
+        byte_range = get_range(request.headers["Range"], archive.size)
+    if byte_range is False:
+        headers["Content-Range"] = "bytes */%i" % archive.size
+        return Response(status_code=416, headers=headers)
+    if byte_range is None:
+        headers["Content-Length"] = str(archive.size)
+        return StreamingResponse(archive.stream(), media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers.update(
         {
-            "ydl_module_name": request.app.state.ydlhandler.ydl_module_name,
-            "ydl_module_version": request.app.state.ydlhandler.ydl_version,
-            "ydl_module_website": request.app.state.ydlhandler.ydl_website,
-            "ydls_version": request.app.state.ydlhandler.ydls_version,
-            "ydls_release_date": request.app.state.ydlhandler.ydls_release_date,
-            "download_workers_count": request.app.state.ydlhandler.download_workers_count,
+            "Content-Length": str(end - start + 1),
+            "Content-Range": "bytes %i-%i/%i" % (start, end, archive.size),
         }
     )
+    return StreamingResponse(
+        archive.stream(start, end), status_code=206, media_type=media_type, headers=headers
+    )
+
+
+async def api_list_extractors(request):
+    # Listing the extractors and compressing them takes a while the first
+    # time, or waits for the listing started with the server
+    body = await run_in_threadpool(
+        request.app.state.response_cache.get,
+        "extractors",
+        request.app.state.ydlhandler.module_info_key,
+        request.app.state.ydlhandler.get_extractors,
+    )
+    return body.response(request.headers)
+
+
+async def api_server_info(request):
+    # Only compressed again when the workers count changes
+    info = {
+        "ydl_module_name": request.app.state.ydlhandler.ydl_module_name,
+        "ydl_module_version": request.app.state.ydlhandler.ydl_version,
+        "ydl_module_website": request.app.state.ydlhandler.ydl_website,
+        "ydls_version": request.app.state.ydlhandler.ydls_version,
+        "ydls_release_date": request.app.state.ydlhandler.ydls_release_date,
+        "download_workers_count": request.app.state.ydlhandler.get_workers_count(),
+        "download_workers_target": request.app.state.ydlhandler.download_workers_count,
+        "autoscale": request.app.state.ydlhandler.autoscaler is not None,
+    }
+    return request.app.state.response_cache.json_response(request, "info", info, lambda: info)
+
+
+def get_workers_status(ydlhandler):
+    return {
+        "success": True,
+        "workers": ydlhandler.get_workers_count(),
+        "target": ydlhandler.download_workers_count,
+        "busy": ydlhandler.busy_workers,
+        "autoscale": (
+            ydlhandler.autoscaler.get_status() if ydlhandler.autoscaler is not None else None
+        ),
+    }
+
+
+async def api_workers(request):
+    return JSONResponse(get_workers_status(request.app.state.ydlhandler))
+
+
+async def api_workers_resize(request):
+    ydlhandler = request.app.state.ydlhandler
+    data = await request.json()
+    count = data.get("count")
+    low, high = 1, None
+    if ydlhandler.autoscaler is not None:
+        low, high = ydlhandler.autoscaler.min_workers, ydlhandler.autoscaler.max_workers
+    if (
+        not isinstance(count, int)
+        or isinstance(count, bool)
+        or count < low
+        or (high is not None and count > high)
+    ):
+        return JSONResponse(
+            {
+                "success": False,
+                "error": "'count' must be an integer between {} and {}".format(
+                    low, high if high is not None else "any number"
+                ),
+            },
+            status_code=400,
+        )
+    ydlhandler.resize(count)
+    return JSONResponse(get_workers_status(ydlhandler))
 
 
 async def api_list_formats(request):
-    return JSONResponse(
-        {
+    # The configuration is only read at startup
+    return request.app.state.response_cache.json_response(
+        request,
+        "formats",
+        None,
+        lambda: {
             "ydl_formats": get_ydl_formats(app_config),
             "ydl_default_format": app_config["ydl_server"].get(
                 "default_format", "video/best"
             ),
-        }
+        },
     )
 
 
 async def api_queue_size(request):
-    db = JobsDB(readonly=True)
-    jobs = db.get_jobs(app_config["ydl_server"].get("max_log_entries", 100))
     return JSONResponse(
         {
             "success": True,
             "stats": {
                 "queue": request.app.state.ydlhandler.queue.qsize(),
-                "pending": len([job for job in jobs if job["status"] == "Pending"]),
-                "running": len([job for job in jobs if job["status"] == "Running"]),
-                "completed": len([job for job in jobs if job["status"] == "Completed"]),
-                "failed": len([job for job in jobs if job["status"] == "Failed"]),
-                "aborted": len([job for job in jobs if job["status"] == "Aborted"]),
+                **request.app.state.jobshandler.get_stats(),
             },
+            "lanes": request.app.state.ydlhandler.queue.get_lanes(),
+            "writer": request.app.state.jobshandler.get_writer_stats(),
+            "db_pool": request.app.state.dbpool.get_stats(),
         }
     )
 
 
+async def api_metrics(request):
+    ydlhandler = request.app.state.ydlhandler
+    jobshandler = request.app.state.jobshandler
+    download_queue = Gauge(
+        "ydls_download_queue_jobs", "Jobs waiting for a download worker", ("priority",)
+    )
+    for priority, count in ydlhandler.queue.get_lanes().items():
+        download_queue.set(count, priority)
+    writer_queue = Gauge(
+        "ydls_jobs_writer_queue_actions", "Actions waiting for the jobs writer"
+    )
+    writer_queue.set(jobshandler.queue.qsize())
+    workers = Gauge("ydls_download_workers", "Download workers", ("state",))
+    busy = ydlhandler.busy_workers
+    workers.set(busy, "busy")
+    workers.set(max(ydlhandler.get_workers_count() - busy, 0), "idle")
+    jobs = Gauge("ydls_jobs", "Jobs in the history", ("status",))
+    for status, count in jobshandler.get_stats().items():
+        jobs.set(count, status)
+    writer = jobshandler.get_writer_stats()
+    writer_actions = Counter("ydls_jobs_writer_actions", "Actions applied by the jobs writer")
+    writer_actions.inc(writer["actions"] - writer["coalesced"])
+    writer_coalesced = Counter(
+        "ydls_jobs_writer_coalesced_actions",
+        "Actions dropped by the jobs writer, overwritten in the same batch",
+    )
+    writer_coalesced.inc(writer["coalesced"])
+
+    openmetrics = "application/openmetrics-text" in request.headers.get("Accept", "")
+    return Response(
+        render(
+            [download_queue, writer_queue, workers, jobs, writer_actions, writer_coalesced]
+            + request.app.state.metrics.get_metrics(),
+            openmetrics,
+        ),
+        media_type=OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE,
+    )
+
+
+async def api_limits(request):
+    return JSONResponse(
+        {"success": True, "limits": request.app.state.ydlhandler.queue.get_limits()}
+    )
+
+
+def parse_utc_datetime(value):
+    # ISO 8601 date or datetime, in local time unless it has an offset
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return date.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def get_jobs_filters(params):
+    status = params.get("status")
+    jobtype = params.get("type")
+    since, until = params.get("since"), params.get("until")
+    if status and status.capitalize() not in STATUS_NAME:
+        raise ValueError("'status' must be one of {}".format(", ".join(STATUS_NAME)))
+    if jobtype and jobtype not in ("0", "1"):
+        raise ValueError("'type' must be 0 (download) or 1 (update)")
+    filters = {
+        "status": status,
+        "jobtype": int(jobtype) if jobtype else None,
+        "profile": params.get("profile"),
+        "since": parse_utc_datetime(since) if since else None,
+        "until": parse_utc_datetime(until) if until else None,
+    }
+    if (since and filters["since"] is None) or (until and filters["until"] is None):
+        raise ValueError("'since' and 'until' must be ISO 8601 dates")
+    return filters
+
+
 async def api_logs(request):
-    db = JobsDB(readonly=True)
-    if request.query_params.get("show_logs", "1") in ["1", "true"]:
+    params = request.query_params
+    page_size = min(app_config["ydl_server"].get("log_page_size", 100), MAX_LOG_PAGE_SIZE)
+    limit, cursor = params.get("limit"), params.get("cursor")
+    if limit is not None and (not limit.isdigit() or not 0 < int(limit) <= MAX_LOG_PAGE_SIZE):
         return JSONResponse(
-            db.get_jobs_with_logs(
-                app_config["ydl_server"].get("max_log_entries", 100),
-                request.query_params.get("status", None)
-                )
+            {
+                "success": False,
+                "error": "'limit' must be between 1 and {}".format(MAX_LOG_PAGE_SIZE),
+            },
+            status_code=400,
         )
+    after = decode_cursor(cursor) if cursor else None
+    if cursor and (
+        after is None or not isinstance(after[0], str) or not isinstance(after[1], int)
+    ):
+        return JSONResponse({"success": False, "error": "Invalid 'cursor'"}, status_code=400)
+    try:
+        filters = get_jobs_filters(params)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+
+    show_logs = params.get("show_logs", "1") in ["1", "true"]
+    with request.app.state.dbpool.connection() as db:
+        jobs, next_key = db.get_jobs_page(
+            int(limit) if limit is not None else page_size,
+            filters,
+            after,
+            app_config["ydl_server"].get("log_tail_lines", 100) if show_logs else None,
+        )
+    progress = request.app.state.jobshandler.get_progress([job["id"] for job in jobs])
+    for job in jobs:
+        job["progress"] = progress.get(job["id"])
+    # Without a page size, the plain list of the most recent jobs of earlier
+    # releases
+    if limit is None and cursor is None:
+        return JSONResponse(jobs)
     return JSONResponse(
-        db.get_jobs(app_config["ydl_server"].get("max_log_entries", 100))
+        {
+            "success": True,
+            "jobs": jobs,
+            "next_cursor": encode_cursor(*next_key) if next_key else None,
+        }
+    )
+
+
+async def api_logs_search(request):
+    terms = get_search_terms(request.query_params.get("q", ""))
+    limit = request.query_params.get("limit", "20")
+    if not terms:
+        return JSONResponse({"success": False, "error": "'q' has no words"}, status_code=400)
+    if not limit.isdigit() or not 0 < int(limit) <= MAX_SEARCH_RESULTS:
+        return JSONResponse(
+            {
+                "success": False,
+                "error": "'limit' must be between 1 and {}".format(MAX_SEARCH_RESULTS),
+            },
+            status_code=400,
+        )
+    with request.app.state.dbpool.connection() as db:
+        results = db.search_jobs(
+            terms, int(limit), app_config["ydl_server"].get("search_logs", False)
+        )
+    return JSONResponse({"success": True, "results": results})
+
+
+async def api_events(request):
+    last_event_id = request.headers.get(
+        "Last-Event-ID", request.query_params.get("last_event_id")
+    )
+    return StreamingResponse(
+        request.app.state.jobshandler.events.subscribe(last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
@@ -140,47 +447,150 @@ async def api_logs_clean(request):
     return JSONResponse({"success": True})
 
 
-async def api_jobs_stop(request):
-    db = JobsDB(readonly=True)
-    job_id = request.path_params["job_id"]
-    job = db.get_job_by_id(job_id)
+async def api_maintenance_status(request):
+    with request.app.state.dbpool.connection() as db:
+        status = request.app.state.maintenance.get_status(db)
+    return JSONResponse({"success": True, "maintenance": status})
 
-    if not job:
-        return JSONResponse({"success": False}, status_code=404)
+
+async def api_maintenance_run(request):
+    request.app.state.maintenance.request_run()
+    return JSONResponse({"success": True})
+
+
+def stop_job(request, job):
     if job["status"] == "Pending":
         print("Cancelling pending job")
         request.app.state.jobshandler.put(
             (Actions.SET_STATUS, (job["id"], Job.ABORTED))
         )
-        return JSONResponse({"success": True})
+        return True
     if job["status"] == "Running" and int(job["pid"]) != 0:
         print("Stopping running job", job["pid"])
         try:
             print(os.kill(job["pid"], signal.SIGINT))
         except ProcessLookupError:
             print("Process already dead")
-        return JSONResponse({"success": True})
+        return True
     if int(job["pid"]) == 0:
         request.app.state.jobshandler.put(
             (Actions.SET_STATUS, (job["id"], Job.ABORTED))
         )
-        return JSONResponse({"success": True})
-    return JSONResponse({"success": False})
+        return True
+    return False
 
 
-async def api_jobs_retry(request):
-    db = JobsDB(readonly=True)
+async def api_jobs_stop(request):
     job_id = request.path_params["job_id"]
-    job = db.get_job_by_id(job_id)
+    with request.app.state.dbpool.connection() as db:
+        job = db.get_job_by_id(job_id)
+        children = db.get_children(job_id) if job else []
+
     if not job:
         return JSONResponse({"success": False}, status_code=404)
+    if children:
+        # Stopping a playlist stops its entries, the playlist job ends with
+        # them
+        stopped = [
+            stop_job(request, child)
+            for child in children
+            if child["status"] in ("Pending", "Running")
+        ]
+        return JSONResponse({"success": all(stopped)})
+    return JSONResponse({"success": stop_job(request, job)})
+
+
+async def api_jobs_get(request):
+    job_id = request.path_params["job_id"]
+    with request.app.state.dbpool.connection() as db:
+        job = db.get_job_by_id(job_id)
+        if not job:
+            return JSONResponse({"success": False}, status_code=404)
+        profile = db.get_job_profile(job["id"])
+    job["progress"] = request.app.state.jobshandler.get_progress([job["id"]]).get(job["id"])
+    job["durations"] = get_stage_durations(job["timings"])
+    job["profile"] = profile
+    return JSONResponse({"success": True, "job": job})
+
+
+async def api_profile(request):
+    # Memory held by the server, the calls of each job are stored with it
+    allocations = await run_in_threadpool(get_allocations)
+    if allocations is None:
+        return JSONResponse(
+            {"success": False, "error": "Profiling is disabled"}, status_code=404
+        )
+    return PlainTextResponse(allocations)
+
+
+async def api_jobs_children(request):
+    job_id = request.path_params["job_id"]
+    with request.app.state.dbpool.connection() as db:
+        job = db.get_job_by_id(job_id)
+        if not job:
+            return JSONResponse({"success": False}, status_code=404)
+        children = db.get_children(job["id"])
+    progress = request.app.state.jobshandler.get_progress([child["id"] for child in children])
+    for child in children:
+        child["progress"] = progress.get(child["id"])
+    return JSONResponse({"success": True, "id": job["id"], "children": children})
+
+
+async def api_jobs_log(request):
+    job_id = request.path_params["job_id"]
+    try:
+        after = int(request.query_params.get("after", 0))
+    except ValueError:
+        return JSONResponse(
+            {"success": False, "error": "'after' must be an integer"}, status_code=400
+        )
+    with request.app.state.dbpool.connection() as db:
+        job = db.get_job_by_id(job_id)
+        if not job:
+            return JSONResponse({"success": False}, status_code=404)
+        seq, lines = db.get_job_log(job["id"], after)
 
-    new_job = Job(
-        job["name"], Job.PENDING, "", JobType.YDL_DOWNLOAD, job["format"], job["urls"]
+    return JSONResponse(
+        {
+            "success": True,
+            "id": job["id"],
+            "status": job["status"],
+            "seq": seq,
+            "lines": lines,
+            "current": job["log"] or "",
+        }
     )
 
-    request.app.state.jobshandler.put((Actions.DELETE_LOG_SAFE, job))
-    request.app.state.jobshandler.put((Actions.INSERT, new_job))
+
+async def api_jobs_retry(request):
+    job_id = request.path_params["job_id"]
+    with request.app.state.dbpool.connection() as db:
+        job = db.get_job_by_id(job_id)
+        children = db.get_children(job_id) if job else []
+    if not job:
+        return JSONResponse({"success": False}, status_code=404)
+
+    # Retrying a playlist only retries the entries which were not downloaded
+    retried = [
+        dict(child, format=job["format"], parent_id=job["id"])
+        for child in children
+        if child["status"] in ("Failed", "Aborted")
+    ] if children else [job]
+    for retried_job in retried:
+        new_job = Job(
+            retried_job["name"],
+            Job.PENDING,
+            "",
+            JobType.YDL_DOWNLOAD,
+            retried_job["format"],
+            retried_job["urls"],
+            priority=PRIORITY_NAME.index(job["priority"]),
+            submitter=job["submitter"],
+            parent_id=retried_job["parent_id"],
+            output=retried_job["output"],
+        )
+        request.app.state.jobshandler.put((Actions.DELETE_LOG_SAFE, retried_job))
+        request.app.state.jobshandler.put((Actions.INSERT, new_job))
 
     return JSONResponse({"success": True})
 
@@ -191,38 +601,248 @@ async def api_jobs_delete(request):
         return JSONResponse({"success": True})
     return JSONResponse({"success": False})
 
-async def api_queue_download(request):
-    if request.headers.get("Content-Type") == "application/x-www-form-urlencoded":
-        data = await request.form()
-    else:
-        data = await request.json()
+def get_download_request(data):
     url = data.get("url")
     urls = data.get("urls", [])
     profile = data.get("profile")
     audio_format = data.get("audio_format")
     format_str = data.get("format")
-
+    priority = data.get("priority")
+    force = str(data.get("force", "")).lower() in ("1", "true")
+
+    # Values of the wrong type raise ValueError, reported as client errors
+    for name, value in (
+        ("format", format_str), ("profile", profile), ("audio_format", audio_format)
+    ):
+        if value is not None and not isinstance(value, str):
+            raise ValueError("'{}' must be a string".format(name))
+    if (profile or audio_format) and not format_str:
+        raise ValueError("'format' is required with 'profile' and 'audio_format'")
     if profile:
         format_str = ','.join([format_str, profile])
     if audio_format:
         format_str = ',audio/'.join([format_str, audio_format])
-    options = {"format": format_str}
 
+    if isinstance(urls, str):
+        urls = [urls]
+    if not isinstance(urls, list):
+        raise ValueError("'urls' must be a URL string or a list of URL strings")
     if url:
         urls.append(url)
+    return urls, format_str, priority, force
 
+
+def get_download_request_error(urls, priority):
     if len(urls) == 0:
+        return "'url' and 'urls' query parameters omitted"
+    if not all(isinstance(url, str) and url for url in urls):
+        return "'url' and 'urls' must be URL strings"
+    if priority is not None and priority not in PRIORITY_NAME:
+        return "'priority' must be one of {}".format(", ".join(PRIORITY_NAME))
+    return None
+
+
+def get_indexed_media(request, urls):
+    # Archive ids guessed from the URLs, with the media already indexed
+    archive_ids = {}
+    for url in urls:
+        if url not in archive_ids:
+            archive_ids[url] = request.app.state.ydlhandler.get_url_archive_id(url)
+    with request.app.state.dbpool.connection() as db:
+        indexed = db.get_indexed_media([a for a in archive_ids.values() if a])
+    return archive_ids, indexed
+
+
+def filter_indexed_urls(urls, archive_ids, indexed, force):
+    # Media already queued is merged into its job, media already downloaded
+    # is skipped unless forced
+    merged, skipped, kept = [], [], []
+    for url in urls:
+        media = indexed.get(archive_ids[url])
+        if media is not None and media["queued"]:
+            merged.append({"url": url, "job_id": media["job_id"]})
+        elif media is not None and media["downloaded"] and not force:
+            skipped.append(
+                {"url": url, "job_id": media["job_id"], "downloaded": media["downloaded"]}
+            )
+        else:
+            kept.append(url)
+    return kept, merged, skipped
+
+
+def new_download_job(request, urls, format_str, priority, force, archive_ids):
+    job = Job(
+        ", ".join(urls),
+        Job.PENDING,
+        "",
+        JobType.YDL_DOWNLOAD,
+        format_str,
+        urls,
+        priority=request.app.state.ydlhandler.get_priority(format_str, priority),
+        submitter=request.client.host if request.client else None,
+    )
+    job.archive_ids = [archive_ids[url] for url in urls if archive_ids[url]]
+    job.force = force
+    return job
+
+
+async def api_queue_download(request):
+    if request.headers.get("Content-Type") == "application/x-www-form-urlencoded":
+        data = await request.form()
+    else:
+        data = await request.json()
+    try:
+        urls, format_str, priority, force = get_download_request(data)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+    options = {"format": format_str}
+
+    error = get_download_request_error(urls, priority)
+    if error is not None:
+        # A missing URL was never reported as a client error
         return JSONResponse(
-            {"success": False, "error": "'url' and 'urls' query parameters omitted"}
+            {"success": False, "error": error}, status_code=200 if not urls else 400
         )
 
-    job = Job(
-        ", ".join(urls), Job.PENDING, "", JobType.YDL_DOWNLOAD, format_str, urls
+    # Matching the URLs against every extractor blocks for a while
+    archive_ids, indexed = await run_in_threadpool(get_indexed_media, request, urls)
+    urls, merged, skipped = filter_indexed_urls(urls, archive_ids, indexed, force)
+
+    job = new_download_job(request, urls, format_str, priority, force, archive_ids)
+    if urls:
+        request.app.state.jobshandler.put((Actions.INSERT, job))
+        print("Added url " + ",".join(urls) + " to the download queue")
+
+    return JSONResponse(
+        {
+            "success": True,
+            "urls": urls,
+            "options": options,
+            "priority": PRIORITY_NAME[job.priority],
+            "merged": merged,
+            "skipped": skipped,
+        }
+    )
+
+
+async def read_bulk_downloads(request):
+    if "ndjson" not in request.headers.get("Content-Type", ""):
+        downloads = await request.json()
+        if not isinstance(downloads, list):
+            raise ValueError("expected a JSON array of downloads")
+        return downloads
+    # One download per line, parsed as the body is received
+    downloads, partial = [], b""
+    async for chunk in request.stream():
+        *lines, partial = (partial + chunk).split(b"\n")
+        downloads.extend(json.loads(line) for line in lines if line.strip())
+    if partial.strip():
+        downloads.append(json.loads(partial))
+    return downloads
+
+
+def prepare_bulk_downloads(request, downloads):
+    # Validates every download before storing any of them
+    entries, errors = [], []
+    for index, data in enumerate(downloads):
+        if not isinstance(data, dict):
+            errors.append({"index": index, "error": "expected a JSON object"})
+            continue
+        try:
+            urls, format_str, priority, force = get_download_request(data)
+        except ValueError as e:
+            errors.append({"index": index, "error": str(e)})
+            continue
+        error = get_download_request_error(urls, priority)
+        if error is not None:
+            errors.append({"index": index, "error": error})
+            continue
+        entries.append((urls, format_str, priority, force))
+    if errors:
+        return [], [], [], errors
+
+    archive_ids, indexed = get_indexed_media(
+        request, [url for urls, _, _, _ in entries for url in urls]
+    )
+
+    jobs, merged, skipped = [], [], []
+    # Media appearing more than once in the request goes to its first job
+    queued = {}
+    for urls, format_str, priority, force in entries:
+        urls, entry_merged, entry_skipped = filter_indexed_urls(
+            urls, archive_ids, indexed, force
+        )
+        merged.extend(entry_merged)
+        skipped.extend(entry_skipped)
+        kept = []
+        for url in urls:
+            archive_id = archive_ids[url]
+            if archive_id in queued:
+                merged.append({"url": url, "job": queued[archive_id]})
+            elif url not in kept:
+                kept.append(url)
+        if not kept:
+            continue
+        job = new_download_job(request, kept, format_str, priority, force, archive_ids)
+        for archive_id in job.archive_ids:
+            queued[archive_id] = job
+        jobs.append(job)
+    return jobs, merged, skipped, []
+
+
+async def api_queue_bulk(request):
+    try:
+        downloads = await read_bulk_downloads(request)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+    if not downloads:
+        return JSONResponse({"success": False, "error": "no downloads"}, status_code=400)
+
+    jobs, merged, skipped, errors = await run_in_threadpool(
+        prepare_bulk_downloads, request, downloads
+    )
+    if errors:
+        return JSONResponse({"success": False, "errors": errors}, status_code=400)
+
+    # All the jobs are stored in a single transaction, their ids are known
+    # once it is committed
+    if jobs:
+        inserted = Event()
+        request.app.state.jobshandler.put((Actions.INSERT_MANY, (jobs, inserted)))
+        if not await run_in_threadpool(inserted.wait, BULK_INSERT_TIMEOUT):
+            return JSONResponse(
+                {"success": False, "error": "timed out storing the downloads"},
+                status_code=503,
+            )
+        print("Added {} jobs to the download queue".format(len(jobs)))
+
+    for media in merged:
+        if "job" in media:
+            job_id = media.pop("job").id
+            media["job_id"] = job_id if job_id != -1 else None
+    return JSONResponse(
+        {
+            "success": True,
+            # Jobs dropped as duplicates of a concurrent request have no id
+            "jobs": [
+                {
+                    "id": job.id if job.id != -1 else None,
+                    "urls": job.url,
+                    "format": job.format,
+                    "priority": PRIORITY_NAME[job.priority],
+                }
+                for job in jobs
+            ],
+            "merged": merged,
+            "skipped": skipped,
+        }
     )
-    request.app.state.jobshandler.put((Actions.INSERT, job))
 
-    print("Added url " + ",".join(urls) + " to the download queue")
-    return JSONResponse({"success": True, "urls": urls, "options": options})
+
+async def api_download_archive(request):
+    with request.app.state.dbpool.connection() as db:
+        archive_ids = db.get_downloaded_media()
+    return PlainTextResponse("".join("%s\n" % archive_id for archive_id in archive_ids))
 
 
 async def api_metadata_fetch(request):
@@ -231,7 +851,12 @@ async def api_metadata_fetch(request):
     urls = data.get("urls", [])
     if url:
         urls.append(url)
-    rc, stdout = request.app.state.ydlhandler.fetch_metadata(urls)
+    ydlhandler = request.app.state.ydlhandler
+    with request.app.state.dbpool.connection() as db:
+        metadata = ydlhandler.get_cached_metadata(db, urls)
+    # Resolving the URLs takes seconds, the connection is back in the pool
+    # meanwhile
+    rc, stdout = await run_in_threadpool(ydlhandler.fetch_missing_metadata, urls, metadata)
     if rc == 0:
         return JSONResponse(stdout)
     return JSONResponse({"success": False}, status_code=404)
@@ -1,30 +1,89 @@
 import os
-from queue import Queue
-from threading import Thread
-import io
+from threading import Thread, Lock
 import importlib
 import json
-from time import sleep
+import re
+import tempfile
+from contextlib import nullcontext
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from datetime import datetime
-from subprocess import Popen, PIPE, STDOUT
-
-from ydl_server.logdb import JobsDB, Job, Actions, JobType
+from time import monotonic, time
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
+
+from ydl_server.logdb import (
+    JobsDB,
+    Job,
+    Actions,
+    JobType,
+    LogNormalizer,
+    PRIORITY_NAME,
+    STATUS_NAME,
+)
+from ydl_server.scheduler import JobScheduler
+from ydl_server.limits import DownloadLimits
+from ydl_server.ydlpool import YdlProcessPool
+from ydl_server.autoscaler import WorkerAutoscaler
+from ydl_server.progress import (
+    PROGRESS_TEMPLATE,
+    PROGRESS_TEMPLATE_MODULES,
+    ProgressOutput,
+    ProgressTracker,
+)
+from ydl_server.profiling import JobProfiler
+from ydl_server.moduleinfo import ModuleInfoCache, get_ydl_website, get_ydl_extractors
 
 
 YDL_MODULES = ["youtube_dl", "youtube_dlc", "yt_dlp"]
 
 
-def get_ydl_website(ydl_module_name):
-    import pip._internal.commands.show as pipshow
+def normalize_url(url):
+    # Cache key of a URL: scheme and host are case insensitive and the order
+    # of the query parameters does not matter
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path, query, parts.fragment)
+    )
+
+
+PLAYLIST_FIELD = re.compile(
+    r"%\((playlist\w*|n_entries)\)([#0\-+ ]*\d*(?:\.\d+)?)([diouxXeEfFgGcrs])"
+)
+
+
+def render_playlist_fields(template, fields, sanitize):
+    # Fills in the playlist fields of an output template, the entry's own
+    # fields are left to youtube-dl
+    def render(match):
+        key, flags, conversion = match.groups()
+        if key not in fields:
+            return match.group(0)
+        value = fields[key]
+        if value is None:
+            value = "NA"
+        elif key == "playlist_index" and conversion == "s" and not flags:
+            # Padded to the number of entries, like youtube-dl does
+            value = str(value).zfill(len(str(fields["playlist_count"])))
+        try:
+            value = ("%" + flags + conversion) % value
+        except (TypeError, ValueError):
+            value = str(value)
+        return sanitize(value).replace("%", "%%")
+
+    return PLAYLIST_FIELD.sub(render, template)
 
-    info = list(pipshow.search_packages_info([ydl_module_name]))
-    if len(info) < 1:
-        return ""
-    return getattr(info[0], "home-page", getattr(info[0], "homepage", ""))
 
+def get_archive_id(extractor, video_id):
+    # Line format of the youtube-dl download archives
+    if not extractor or not video_id:
+        return None
+    return "%s %s" % (extractor.lower(), video_id)
 
-def read_proc_stdout(proc, strio):
-    strio.write(proc.stdout.read1().decode())
+
+def read_proc_stdout(proc, output):
+    while output.feed(proc.stdout.read1()):
+        pass
+    output.close()
 
 
 class YdlHandler:
@@ -44,8 +103,8 @@ class YdlHandler:
         if ydl_module is None:
             raise ImportError("No youtube_dl implementation found")
 
+        self.ydl_module = ydl_module
         self.ydl_module_name = ydl_module.__name__.replace("_", "-")
-        self.ydl_website = get_ydl_website(self.ydl_module_name)
 
         self.ydls_version = os.environ.get("YDLS_VERSION", "")
         self.ydls_release_date = os.environ.get("YDLS_RELEASE_DATE", "")
@@ -54,23 +113,64 @@ class YdlHandler:
         importlib.reload(ydl_module.extractor)
 
         self.ydl_version = ydl_module.version.__version__
-        self.ydl_extractors = [
-            ie.IE_NAME
-            for ie in ydl_module.extractor.list_extractors(
-                self.app_config["ydl_options"].get("age-limit")
-            )
-            if ie._WORKING
+        self.module_info_key = [
+            self.ydl_module_name,
+            self.ydl_version,
+            self.app_config["ydl_options"].get("age-limit"),
         ]
-
-    def __init__(self, app_config, jobshandler):
-        self.queue = Queue()
-        self.threads = []
+        info = self.module_cache.load(self.module_info_key)
+        if info is not None:
+            self.ydl_website = info["website"]
+            self.ydl_extractors = info["extractors"]
+        else:
+            self.ydl_website = get_ydl_website(self.ydl_module_name)
+            self.ydl_extractors = None
+
+    def get_extractors(self):
+        # Listing the extractors takes a while, it is done once per module
+        # version, see start_extractors()
+        with self.extractors_lock:
+            if self.ydl_extractors is None:
+                extractors = get_ydl_extractors(
+                    self.ydl_module, self.app_config["ydl_options"].get("age-limit")
+                )
+                self.module_cache.save(
+                    self.module_info_key, {"website": self.ydl_website, "extractors": extractors}
+                )
+                self.ydl_extractors = extractors
+            return self.ydl_extractors
+
+    def start_extractors(self):
+        if self.ydl_extractors is None:
+            Thread(target=self.get_extractors).start()
+
+    def __init__(self, app_config, jobshandler, finished_index=None, metrics=None):
+        self.queue = JobScheduler(DownloadLimits(app_config, self.get_extractor))
+        self.threads = {}
+        self.retiring = set()
+        self.workers_lock = Lock()
+        self.next_worker_id = 0
+        self.busy_workers = 0
+        self.completed_jobs = 0
+        self.download_workers_count = 0
+        self.autoscaler = None
         self.done = False
+        self.ydl_module = None
         self.ydl_module_name = None
         self.ydl_version = None
-        self.ydl_extractors = []
+        self.engine = None
+        self.ydl_website = ""
+        self.ydl_extractors = None
+        self.extractors_lock = Lock()
+        self.module_info_key = None
         self.app_config = app_config
         self.jobshandler = jobshandler
+        self.finished_index = finished_index
+        self.metrics = metrics
+        self.profiling = app_config["ydl_server"].get("profiling", False)
+        self.module_cache = ModuleInfoCache(
+            app_config["ydl_server"].get("module_cache_path", "")
+        )
 
         self.app_config["ydl_last_update"] = datetime.now()
 
@@ -78,37 +178,105 @@ class YdlHandler:
 
         print("Using {} module".format(self.ydl_module_name))
 
-    def start(self):
-        self.download_workers_count = self.app_config["ydl_server"].get(
-            "download_workers_count", 2
+    def start_engine(self):
+        engine = self.app_config["ydl_server"].get("download_engine", "subprocess")
+        if engine != "process_pool":
+            return
+        if not hasattr(self.ydl_module, "parse_options"):
+            print(
+                "{} has no options parser, falling back to the subprocess engine".format(
+                    self.ydl_module_name
+                )
+            )
+            return
+        # One process more than download workers, for the metadata requests
+        # of the API
+        self.engine = YdlProcessPool(
+            self.ydl_module.__name__, self.download_workers_count + 1
         )
-        for i in range(self.download_workers_count):
-            thread = Thread(target=self.worker, args=(i,))
-            self.threads.append(thread)
-            thread.start()
-            print("Started dl worker %i" % i)
+        self.engine.start()
+        print("Started %i %s worker processes" % (self.engine.size, self.ydl_module_name))
+
+    def start(self):
+        workers_count = self.app_config["ydl_server"].get("download_workers_count", 2)
+        if self.app_config["ydl_server"].get("autoscale", False):
+            self.autoscaler = WorkerAutoscaler(self.app_config, self)
+            workers_count = self.autoscaler.clamp(workers_count)
+        self.download_workers_count = workers_count
+        self.start_engine()
+        self.resize(workers_count)
+        if self.autoscaler is not None:
+            self.autoscaler.start()
+
+    def resize(self, count):
+        with self.workers_lock:
+            self.download_workers_count = count
+            active = sorted(i for i in self.threads if i not in self.retiring)
+            # Workers started last are the first to go, once done with their
+            # current job
+            for thread_id in active[count:]:
+                self.retiring.add(thread_id)
+            missing = count - len(active)
+            for thread_id in sorted(self.retiring)[:max(missing, 0)]:
+                self.retiring.discard(thread_id)
+                missing -= 1
+            for _ in range(missing):
+                thread = Thread(target=self.worker, args=(self.next_worker_id,))
+                self.threads[self.next_worker_id] = thread
+                thread.start()
+                print("Started dl worker %i" % self.next_worker_id)
+                self.next_worker_id += 1
+        if self.engine is not None:
+            self.engine.resize(count + 1)
+        self.queue.wakeup()
+
+    def get_workers_count(self):
+        return len(self.threads)
+
+    def worker_stopped(self, thread_id):
+        return self.done or thread_id in self.retiring
 
     def put(self, obj):
         self.queue.put(obj)
 
     def finish(self):
         self.done = True
+        self.queue.wakeup()
+        if self.autoscaler is not None:
+            self.autoscaler.finish()
+        if self.engine is not None:
+            self.engine.close()
 
     def worker(self, thread_id):
         db = JobsDB(readonly=True)
-        while not self.done:
-            job = self.queue.get()
+        while True:
+            job = self.queue.get(lambda: self.worker_stopped(thread_id))
+            if job is None:
+                # A resize may have kept this worker in the meantime
+                with self.workers_lock:
+                    if self.worker_stopped(thread_id):
+                        self.retiring.discard(thread_id)
+                        del self.threads[thread_id]
+                        break
+                continue
             job_detail = db.get_job_by_id(job.id)
             if not job_detail or job_detail["status"] == "Aborted":
-                self.queue.task_done()
+                self.queue.done(job)
                 continue
+            with self.workers_lock:
+                self.busy_workers += 1
             job.status = Job.RUNNING
+            job.progress = None
+            job.timings["dequeued"] = time()
             self.jobshandler.put((Actions.SET_STATUS, (job.id, job.status)))
-            self.queue.task_done()
+            self.jobshandler.put((Actions.SET_TIMINGS, (job.id, dict(job.timings))))
+            started = monotonic()
             if job.type == JobType.YDL_DOWNLOAD:
-                output = io.StringIO()
+                output = LogNormalizer()
+                profiler = JobProfiler() if self.profiling else nullcontext()
                 try:
-                    self.download(job, {"format": job.format}, output)
+                    with profiler:
+                        self.download(db, job, {"format": job.format}, output)
                 except Exception as e:
                     job.status = Job.FAILED
                     job.log = "Error during download task:\n{}:\n\t{}".format(
@@ -119,7 +287,104 @@ class YdlHandler:
                             type(e).__name__, str(e)
                         )
                     )
+                if self.profiling:
+                    job.profile = profiler.report
+            self.record_job(job, monotonic() - started)
+            if job.status == Job.COMPLETED and self.finished_index is not None:
+                # Listed before the job shows as completed
+                self.finished_index.check()
+            retry = self.retry_entry(job)
             self.jobshandler.put((Actions.UPDATE, job))
+            self.queue.done(job)
+            if retry:
+                self.queue.put(job)
+            with self.workers_lock:
+                self.busy_workers -= 1
+                self.completed_jobs += 1
+        db.close()
+        print("Stopped dl worker %i" % thread_id)
+
+    def record_job(self, job, duration):
+        # Playlist jobs handing their entries over to other jobs are left out
+        if self.metrics is None or job.status not in (Job.COMPLETED, Job.FAILED):
+            return
+        profile = self.get_format_and_profile(job.format or "")[2] or ""
+        self.metrics.job_duration.observe(
+            duration,
+            job.extractor or "unknown",
+            "/".join(profile.split("/")[1:]),
+            STATUS_NAME[job.status].lower(),
+        )
+
+    def retry_entry(self, job):
+        # A failed playlist entry is retried on its own, the other entries of
+        # the playlist are left alone
+        retries = self.app_config["ydl_server"].get("playlist_entry_retries", 2)
+        if job.status != Job.FAILED or job.parent_id is None or job.attempts >= retries:
+            return False
+        job.attempts += 1
+        job.status = Job.PENDING
+        job.timings = {"enqueued": time()}
+        job.profile = None
+        job.log = "Retrying, attempt %i of %i" % (job.attempts + 1, retries + 1)
+        return True
+
+    def get_playlist_entries(self, playlist):
+        # Entries are only downloaded as jobs of their own when they can be
+        # resolved from their URL alone
+        entries = []
+        for entry in playlist.get("entries") or []:
+            url = entry.get("url") or entry.get("webpage_url") or ""
+            if "://" not in url:
+                return None
+            entries.append((url, entry))
+        return entries
+
+    def fan_out(self, db, job, playlist, entries, output):
+        fields = {
+            "playlist": playlist.get("title") or playlist.get("id"),
+            "playlist_id": playlist.get("id"),
+            "playlist_title": playlist.get("title"),
+            "playlist_uploader": playlist.get("uploader"),
+            "playlist_uploader_id": playlist.get("uploader_id"),
+            "playlist_count": len(entries),
+            "n_entries": len(entries),
+        }
+        # Entries already queued or downloaded by other jobs are skipped
+        archive_ids = [get_archive_id(entry.get("ie_key"), entry.get("id")) for _, entry in entries]
+        indexed = db.get_indexed_media([a for a in archive_ids if a])
+        queued = 0
+        indexed_entries = zip(entries, archive_ids, strict=True)
+        for index, ((url, entry), archive_id) in enumerate(indexed_entries, 1):
+            media = indexed.get(archive_id)
+            if media is not None and (media["queued"] or (media["downloaded"] and not job.force)):
+                continue
+            queued += 1
+            fields["playlist_index"] = fields["playlist_autonumber"] = index
+            child = Job(
+                entry.get("title") or url,
+                Job.PENDING,
+                "",
+                JobType.YDL_DOWNLOAD,
+                job.format,
+                [url],
+                priority=job.priority,
+                submitter=job.submitter,
+                parent_id=job.id,
+                output=render_playlist_fields(
+                    output, fields, self.ydl_module.utils.sanitize_filename
+                ),
+            )
+            child.archive_ids = [archive_id] if archive_id else []
+            self.jobshandler.put((Actions.INSERT, child))
+        if not queued:
+            job.status = Job.COMPLETED
+            job.log = "[playlist] All %i entries are already downloaded or queued" % len(entries)
+            return
+        job.status = Job.RUNNING
+        job.log = "[playlist] Queued %i entries" % queued
+        if queued < len(entries):
+            job.log += ", %i already downloaded or queued" % (len(entries) - queued)
 
     def get_format_and_profile(self, format_string):
         fmt, audio, profile = None, None, None
@@ -141,6 +406,32 @@ class YdlHandler:
             raise Exception("Unknown profile ", profile_str)
         return profile
 
+    def get_extractor(self, url):
+        for ie in self.ydl_module.extractor.gen_extractor_classes():
+            if ie.ie_key() != "Generic" and ie.suitable(url):
+                return ie.ie_key()
+
+    def get_url_archive_id(self, url):
+        # Guessed from the URL alone, like youtube-dl does before extracting
+        # anything to check its download archive
+        for ie in self.ydl_module.extractor.gen_extractor_classes():
+            if ie.ie_key() != "Generic" and ie.suitable(url):
+                try:
+                    return get_archive_id(ie.ie_key(), ie._match_id(url))
+                except (IndexError, AttributeError):
+                    return None
+
+    def get_priority(self, format_string, requested=None):
+        if requested is not None:
+            return PRIORITY_NAME.index(requested)
+        profile_str = self.get_format_and_profile(format_string or "")[2]
+        if profile_str:
+            profile_name = "/".join(profile_str.split("/")[1:])
+            priority = self.app_config.get("profiles", {}).get(profile_name, {}).get("priority")
+            if priority in PRIORITY_NAME:
+                return PRIORITY_NAME.index(priority)
+        return Job.PRIORITY_NORMAL
+
     def get_ydl_options(self, ydl_config, request_options):
         ydl_config = ydl_config.copy()
         req_format, req_audio, req_profile = self.get_format_and_profile(request_options.get("format"))
@@ -172,16 +463,43 @@ class YdlHandler:
             ydl_config.update(profile)
         return ydl_config
 
-    def download_log_update(self, job, proc, strio):
-        while job.status == Job.RUNNING:
-            read_proc_stdout(proc, strio)
-            job.log = Job.clean_logs(strio.getvalue())
+    def flush_log(self, job, output, tracker=None):
+        # Complete lines are appended to the job log once, while the line
+        # still being written (usually the progress bar) is kept in job.log
+        lines = output.pop_lines()
+        if lines:
+            self.jobshandler.put((Actions.APPEND_LOG, (job.id, lines)))
+        current = output.current
+        if current != job.log:
+            job.log = current
             self.jobshandler.put((Actions.SET_LOG, (job.id, job.log)))
-            sleep(3)
+        progress = tracker.get() if tracker is not None else None
+        if progress != job.progress:
+            job.progress = progress
+            self.jobshandler.put((Actions.SET_PROGRESS, (job.id, progress)))
 
-    def fetch_metadata(self, url):
-        ydl_opts = self.app_config.get("ydl_options", {})
+    def download_log_update(self, job, proc, output, tracker):
+        stdout_thread = Thread(
+            target=read_proc_stdout,
+            args=(proc, ProgressOutput(output, tracker, self.ydl_module.utils.format_bytes)),
+        )
+        stdout_thread.start()
+        while True:
+            try:
+                rc = proc.wait(timeout=3)
+                break
+            except TimeoutExpired:
+                self.flush_log(job, output, tracker)
+        stdout_thread.join()
+        self.flush_log(job, output, tracker)
+        return rc
+
+    def fetch_metadata(self, url, ydl_opts=None):
+        if ydl_opts is None:
+            ydl_opts = self.app_config.get("ydl_options", {})
         cmd = self.get_ydl_full_cmd(ydl_opts, url, ["-J", "--flat-playlist"])
+        if self.engine is not None:
+            return self.engine.fetch_metadata(cmd[1:])
 
         proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
         stdout, stderr = proc.communicate()
@@ -190,6 +508,39 @@ class YdlHandler:
 
         return 0, [json.loads(s) for s in stdout.decode().strip().split("\n")]
 
+    def get_cached_metadata(self, db, urls, profile=""):
+        metadata = {}
+        ttl = self.app_config["ydl_server"].get("metadata_cache_ttl", 1800)
+        if ttl <= 0:
+            return metadata
+        for url in urls:
+            info = db.get_cached_metadata(normalize_url(url), profile, ttl)
+            if info is not None:
+                metadata[url] = json.loads(info)
+                self.jobshandler.put((Actions.TOUCH_METADATA, (normalize_url(url), profile)))
+        return metadata
+
+    def fetch_missing_metadata(self, urls, metadata, profile="", ydl_opts=None):
+        # Resolves the URLs missing from the cached metadata, without a DB
+        # connection
+        missing = [url for url in urls if url not in metadata]
+        if missing:
+            rc, fetched = self.fetch_metadata(missing, ydl_opts)
+            if rc != 0:
+                return rc, fetched
+            cached = self.app_config["ydl_server"].get("metadata_cache_ttl", 1800) > 0
+            for url, info in zip(missing, fetched, strict=False):
+                metadata[url] = info
+                if cached:
+                    self.jobshandler.put(
+                        (Actions.CACHE_METADATA, (normalize_url(url), profile, json.dumps(info)))
+                    )
+        return 0, [metadata[url] for url in urls]
+
+    def get_metadata(self, db, urls, profile="", ydl_opts=None):
+        metadata = self.get_cached_metadata(db, urls, profile)
+        return self.fetch_missing_metadata(urls, metadata, profile, ydl_opts)
+
     def get_ydl_full_cmd(self, opt_dict, url, extra_opts=None):
         cmd = [self.ydl_module_name]
         if opt_dict is not None:
@@ -205,15 +556,17 @@ class YdlHandler:
         cmd.extend(url)
         return cmd
 
-    def download(self, job, request_options, output):
+    def download(self, db, job, request_options, output):
         ydl_opts = self.get_ydl_options(
             self.app_config.get("ydl_options", {}), request_options
         )
-        cmd = self.get_ydl_full_cmd(ydl_opts, job.url)
+        profile = self.get_format_and_profile(request_options.get("format"))[2] or ""
 
-        rc, metadata = self.fetch_metadata(job.url)
+        job.timings["metadata_start"] = time()
+        rc, metadata = self.get_metadata(db, job.url, profile, ydl_opts)
+        job.timings["metadata_end"] = time()
         if rc != 0:
-            job.log = Job.clean_logs(metadata)
+            job.log = LogNormalizer.clean(metadata)
             job.status = Job.FAILED
             print("Error in metadata fetching process:\n" + job.log)
             raise Exception(job.log)
@@ -222,8 +575,17 @@ class YdlHandler:
             [md.get("title", job.url[i]) for i, md in enumerate(metadata)]
         )
         self.jobshandler.put((Actions.SET_NAME, (job.id, title)))
+        job.extractor = metadata[0].get("extractor_key")
+        archive_ids = [
+            get_archive_id(info.get("extractor_key"), info.get("id"))
+            for info in metadata
+            if info.get("_type") != "playlist"
+        ]
+        self.jobshandler.put((Actions.INDEX_MEDIA, (job.id, [a for a in archive_ids if a])))
 
-        if metadata[0].get("_type") == "playlist" or len(metadata) > 1:
+        if job.output is not None:
+            ydl_opts.update({"output": job.output})
+        elif metadata[0].get("_type") == "playlist" or len(metadata) > 1:
             ydl_opts.update(
                 {
                     "output": self.app_config["ydl_server"].get(
@@ -232,38 +594,95 @@ class YdlHandler:
                 }
             )
 
-        cmd = self.get_ydl_full_cmd(ydl_opts, job.url)
-
-        proc = Popen(cmd, stdout=PIPE, stderr=STDOUT)
-        self.jobshandler.put((Actions.SET_PID, (job.id, proc.pid)))
-        stdout_thread = Thread(
-            target=self.download_log_update, args=(job, proc, output)
-        )
-        stdout_thread.start()
-
-        rc = proc.wait()
+        # Playlist entries are spread across the download workers
+        if (
+            len(metadata) == 1
+            and metadata[0].get("_type") == "playlist"
+            and job.parent_id is None
+            and self.app_config["ydl_server"].get("playlist_fanout", True)
+        ):
+            entries = self.get_playlist_entries(metadata[0])
+            if entries:
+                self.fan_out(db, job, metadata[0], entries, ydl_opts["output"])
+                return
+
+        extra_opts = []
+        if self.engine is None:
+            # The progress is read back from the command output
+            extra_opts.append("--newline")
+            if self.ydl_module_name in PROGRESS_TEMPLATE_MODULES:
+                extra_opts.extend(["--progress-template", PROGRESS_TEMPLATE])
+        info_file = None
+        if len(metadata) == 1:
+            # The URL was just resolved: hand its info over instead of having
+            # the download extract it again. yt-dlp falls back to the URL
+            # when the info can no longer be downloaded.
+            fd, info_file = tempfile.mkstemp(prefix="ydl-", suffix=".info.json")
+            with os.fdopen(fd, "w") as f:
+                json.dump(metadata[0], f)
+            cmd = self.get_ydl_full_cmd(ydl_opts, [], extra_opts + ["--load-info-json", info_file])
+        else:
+            cmd = self.get_ydl_full_cmd(ydl_opts, job.url, extra_opts)
+
+        tracker = ProgressTracker()
+        job.timings["download_start"] = time()
+        self.jobshandler.put((Actions.SET_TIMINGS, (job.id, dict(job.timings))))
+        spawn_start = monotonic()
+        try:
+            if self.engine is not None:
+
+                def on_start(pid):
+                    self.record_spawn("process_pool", monotonic() - spawn_start)
+                    self.jobshandler.put((Actions.SET_PID, (job.id, pid)))
+
+                rc = self.engine.download(
+                    cmd[1:],
+                    output,
+                    on_start,
+                    lambda: self.flush_log(job, output, tracker),
+                    tracker.update,
+                )
+                self.flush_log(job, output, tracker)
+            else:
+                proc = Popen(cmd, stdout=PIPE, stderr=STDOUT)
+                self.record_spawn("subprocess", monotonic() - spawn_start)
+                self.jobshandler.put((Actions.SET_PID, (job.id, proc.pid)))
+
+                rc = self.download_log_update(job, proc, output, tracker)
+        finally:
+            self.record_stages(job, tracker)
+            if info_file is not None:
+                os.remove(info_file)
+            if self.metrics is not None and tracker.downloaded_bytes:
+                self.metrics.downloaded_bytes.inc(
+                    tracker.downloaded_bytes, job.extractor or "unknown"
+                )
         if rc == 0:
-            read_proc_stdout(proc, output)
-            job.log = Job.clean_logs(output.getvalue())
             job.status = Job.COMPLETED
         else:
-            read_proc_stdout(proc, output)
-            job.log = Job.clean_logs(output.getvalue())
             job.status = Job.FAILED
             print(
                 "Error in download process (RC=" + str(rc) + "):\n" + output.getvalue()
             )
-        stdout_thread.join()
+
+    def record_stages(self, job, tracker):
+        # Post-processors run once the files are downloaded, the download
+        # stage ends with the last progress reported before them
+        end = time()
+        if tracker.postprocess_start is None:
+            job.timings["download_end"] = end
+            return
+        job.timings["download_end"] = tracker.last_download or tracker.postprocess_start
+        job.timings["postprocess_start"] = tracker.postprocess_start
+        job.timings["postprocess_end"] = end
+
+    def record_spawn(self, engine, latency):
+        if self.metrics is not None:
+            self.metrics.spawn_latency.observe(latency, engine)
 
     def resume_pending(self):
         db = JobsDB(readonly=False)
-        jobs = db.get_jobs_with_logs(self.app_config["ydl_server"].get("max_log_entries", 100))
-        not_endeds = [
-            job
-            for job in jobs
-            if job["status"] == "Pending" or job["status"] == "Running"
-        ]
-        for pending in not_endeds:
+        for pending in db.get_unfinished_jobs():
             job = Job(
                 pending["name"],
                 Job.PENDING,
@@ -271,10 +690,16 @@ class YdlHandler:
                 int(pending["type"]),
                 pending["format"],
                 pending["urls"],
+                priority=pending["priority"],
+                submitter=pending["submitter"],
+                parent_id=pending["parent_id"],
+                output=pending["output"],
             )
             job.id = pending["id"]
             self.jobshandler.put((Actions.RESUME, job))
 
     def join(self):
-        for thread in self.threads:
+        for thread in list(self.threads.values()):
             thread.join()
+        if self.autoscaler is not None:
+            self.autoscaler.join()
@@ -0,0 +1,288 @@
+import importlib
+import multiprocessing
+import signal
+from contextlib import contextmanager, suppress
+from queue import Queue, Empty
+from threading import Lock
+from time import monotonic
+
+from ydl_server.progress import POSTPROCESS_LINE, format_progress
+
+# Worker processes are forked from a fork server which has already imported the
+# youtube-dl module: they start warm, without inheriting any of the server
+# threads.
+
+PROGRESS_FIELDS = (
+    "status",
+    "downloaded_bytes",
+    "total_bytes",
+    "total_bytes_estimate",
+    "speed",
+    "eta",
+    "elapsed",
+    "filename",
+    "fragment_index",
+    "fragment_count",
+)
+PROGRESS_INTERVAL = 0.5
+
+
+# Sends the youtube-dl output back to the server the way the command line
+# prints it: messages on their own line, progress updates overwriting the
+# current line.
+class PipeLogger:
+    def __init__(self, conn, format_bytes):
+        self.conn = conn
+        self.format_bytes = format_bytes
+        self.in_progress = False
+        self.last_progress = 0
+
+    def write(self, text):
+        # youtube-dl has no post-processor hooks, their messages tell instead
+        if POSTPROCESS_LINE.match(text.encode()):
+            self.conn.send(("progress", {"status": "postprocessing"}))
+        if self.in_progress:
+            text = "\n" + text
+            self.in_progress = False
+        self.conn.send(("output", text))
+
+    def debug(self, msg):
+        self.write("%s\n" % msg)
+
+    def info(self, msg):
+        self.write("%s\n" % msg)
+
+    def warning(self, msg):
+        self.write("WARNING: %s\n" % msg)
+
+    def error(self, msg):
+        self.write("%s\n" % msg)
+
+    def progress_hook(self, progress):
+        now = monotonic()
+        total = progress.get("total_bytes") or progress.get("total_bytes_estimate")
+        downloading = progress["status"] == "downloading"
+        # The last update of a download is always sent, youtube-dl reports the
+        # download as completed right after it
+        if (
+            downloading
+            and progress.get("downloaded_bytes") != total
+            and now - self.last_progress < PROGRESS_INTERVAL
+        ):
+            return
+        self.last_progress = now
+        hook = {k: progress[k] for k in PROGRESS_FIELDS if k in progress}
+        info = progress.get("info_dict") or {}
+        hook.update(playlist_index=info.get("playlist_index"), n_entries=info.get("n_entries"))
+        self.conn.send(("progress", hook))
+        if downloading:
+            self.conn.send(
+                ("output", "\r" + format_progress(progress, total, self.format_bytes))
+            )
+            self.in_progress = True
+
+    def postprocessor_hook(self, progress):
+        if progress.get("status") == "started":
+            self.conn.send(("progress", {"status": "postprocessing"}))
+
+
+class ErrorLogger:
+    def __init__(self):
+        self.lines = []
+
+    def debug(self, msg):
+        pass
+
+    def info(self, msg):
+        pass
+
+    def warning(self, msg):
+        self.lines.append("WARNING: %s" % msg)
+
+    def error(self, msg):
+        self.lines.append(msg)
+
+
+def worker_fetch_metadata(ydl_module, argv):
+    logger = ErrorLogger()
+    metadata = []
+    try:
+        parsed = ydl_module.parse_options(argv)
+        with ydl_module.YoutubeDL(dict(parsed.ydl_opts, logger=logger)) as ydl:
+            for url in parsed.urls:
+                info = ydl.extract_info(url, download=False)
+                if info is None:
+                    return -1, "\n".join(logger.lines)
+                metadata.append(ydl.sanitize_info(info))
+    except (Exception, SystemExit) as e:
+        return -1, "\n".join(logger.lines) or str(e)
+    return 0, metadata
+
+
+def worker_download(conn, ydl_module, argv):
+    logger = PipeLogger(conn, ydl_module.utils.format_bytes)
+    try:
+        parsed = ydl_module.parse_options(argv)
+        opts = dict(parsed.ydl_opts, logger=logger, noprogress=True)
+        opts["progress_hooks"] = opts.get("progress_hooks", []) + [logger.progress_hook]
+        opts["postprocessor_hooks"] = opts.get("postprocessor_hooks", []) + [
+            logger.postprocessor_hook
+        ]
+        # Stopping a job interrupts its worker process, only while it downloads
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            with ydl_module.YoutubeDL(opts) as ydl:
+                if parsed.options.load_info_filename is not None:
+                    return ydl.download_with_info_file(parsed.options.load_info_filename)
+                return ydl.download(parsed.urls)
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+    except KeyboardInterrupt:
+        logger.error("ERROR: Interrupted by user")
+    except SystemExit as e:
+        logger.error("ERROR: Invalid options: %s" % e)
+    except Exception as e:
+        logger.error("ERROR: %s" % e)
+    return 1
+
+
+def worker(conn, ydl_module_name):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ydl_module = importlib.import_module(ydl_module_name)
+    # Pre-warm: load the extractors list once for every job this process runs
+    list(ydl_module.extractor.gen_extractor_classes())
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        command, argv = request
+        if command == "metadata":
+            conn.send(worker_fetch_metadata(ydl_module, argv))
+        else:
+            conn.send(("done", worker_download(conn, ydl_module, argv)))
+    conn.close()
+
+
+class YdlProcess:
+    def __init__(self, context, ydl_module_name):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=worker, args=(child_conn, ydl_module_name), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.broken = False
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def close(self):
+        with suppress(OSError):
+            self.conn.send(None)
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class YdlProcessPool:
+    def __init__(self, ydl_module_name, size):
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context("forkserver")
+            self.context.set_forkserver_preload([ydl_module_name])
+        else:
+            self.context = multiprocessing.get_context("spawn")
+        self.ydl_module_name = ydl_module_name
+        self.size = size
+        self.idle = Queue()
+        self.processes = []
+        self.lock = Lock()
+
+    def start(self):
+        self.resize(self.size)
+
+    def resize(self, size):
+        with self.lock:
+            self.size = size
+            while len(self.processes) < self.size:
+                self.processes.append(YdlProcess(self.context, self.ydl_module_name))
+                self.idle.put(self.processes[-1])
+            # Busy processes in excess are closed when they are released
+            while len(self.processes) > self.size:
+                try:
+                    ydl_process = self.idle.get_nowait()
+                except Empty:
+                    break
+                self.processes.remove(ydl_process)
+                ydl_process.close()
+
+    def release(self, ydl_process):
+        with self.lock:
+            if len(self.processes) > self.size:
+                self.processes.remove(ydl_process)
+                ydl_process.close()
+                return
+        if ydl_process.broken or not ydl_process.is_alive():
+            print("yt-dlp worker process %i is gone, replacing it" % ydl_process.pid)
+            ydl_process.close()
+            with self.lock:
+                self.processes.remove(ydl_process)
+                ydl_process = YdlProcess(self.context, self.ydl_module_name)
+                self.processes.append(ydl_process)
+        self.idle.put(ydl_process)
+
+    @contextmanager
+    def process(self):
+        ydl_process = self.idle.get()
+        try:
+            yield ydl_process
+        except BaseException:
+            # The process may still be working on the request, never hand it
+            # over again
+            ydl_process.broken = True
+            raise
+        finally:
+            self.release(ydl_process)
+
+    def fetch_metadata(self, argv):
+        with self.process() as ydl_process:
+            try:
+                ydl_process.conn.send(("metadata", argv))
+                return ydl_process.conn.recv()
+            except (EOFError, OSError):
+                ydl_process.broken = True
+                return -1, "yt-dlp worker process exited unexpectedly"
+
+    def download(self, argv, output, on_start, on_flush, on_progress=None, flush_interval=3):
+        with self.process() as ydl_process:
+            ydl_process.conn.send(("download", argv))
+            on_start(ydl_process.pid)
+            next_flush = monotonic() + flush_interval
+            while True:
+                if ydl_process.conn.poll(max(next_flush - monotonic(), 0)):
+                    try:
+                        kind, data = ydl_process.conn.recv()
+                    except (EOFError, OSError):
+                        ydl_process.broken = True
+                        output.write("\nyt-dlp worker process exited unexpectedly\n")
+                        return -1
+                    if kind == "done":
+                        return data
+                    if kind == "output":
+                        output.write(data)
+                    elif kind == "progress" and on_progress is not None:
+                        on_progress(data)
+                if monotonic() >= next_flush:
+                    on_flush()
+                    next_flush = monotonic() + flush_interval
+
+    def close(self):
+        for ydl_process in self.processes:
+            ydl_process.close()
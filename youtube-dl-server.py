@@ -1,36 +1,76 @@
 from __future__ import unicode_literals
+from contextlib import asynccontextmanager
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 import uvicorn
+from threading import Thread
 
 from ydl_server.logdb import JobsDB
 
 from ydl_server.ydlhandler import YdlHandler
 from ydl_server.jobshandler import JobsHandler
-from ydl_server.config import app_config
+from ydl_server.maintenance import DBMaintenance
+from ydl_server.dbpool import JobsDBPool
+from ydl_server.finished import FinishedIndex
+from ydl_server.config import app_config, get_finished_path
 
-from ydl_server.routes import routes
+from ydl_server.responsecache import ResponseCache
+from ydl_server.metrics import Metrics, MetricsMiddleware
+from ydl_server.profiling import start_tracing
+from ydl_server.routes import routes, static
+
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.dbpool = JobsDBPool(app_config)
+    # Built while the server starts listening: the extractors list and the
+    # compressed frontend files
+    app.state.ydlhandler.start_extractors()
+    Thread(target=static.warm).start()
+    yield
+    app.state.dbpool.close()
 
 if __name__ == "__main__":
-    JobsDB.check_db_latest()
+    if app_config["ydl_server"].get("profiling", False):
+        # Allocations are only traced from here on
+        start_tracing()
     JobsDB.init_db()
 
-    middleware = [Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"])]
+    metrics = Metrics()
+    middleware = [
+        Middleware(MetricsMiddleware, metrics=metrics, routes=routes),
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"]),
+    ]
 
     app = Starlette(
         routes=routes,
         debug=app_config["ydl_server"].get("debug", False),
         middleware=middleware,
+        lifespan=lifespan,
     )
 
-    app.state.jobshandler = JobsHandler(app_config)
-    app.state.ydlhandler = YdlHandler(app_config, app.state.jobshandler)
+    app.state.metrics = metrics
+    app.state.response_cache = ResponseCache()
+    app.state.jobshandler = JobsHandler(app_config, metrics)
+    app.state.finished_index = FinishedIndex(
+        get_finished_path(),
+        app.state.jobshandler.events,
+        app_config["ydl_server"].get("finished_poll_interval", 5),
+    )
+    app.state.finished_index.start()
+    print("Indexed the finished directory")
+    app.state.ydlhandler = YdlHandler(
+        app_config, app.state.jobshandler, app.state.finished_index, metrics
+    )
 
     app.state.ydlhandler.start()
     print("Started download threads")
     app.state.jobshandler.start(app.state.ydlhandler.queue)
     print("Started jobs manager thread")
+    app.state.maintenance = DBMaintenance(app_config)
+    app.state.maintenance.start()
+    print("Started database maintenance thread")
 
     app.state.ydlhandler.resume_pending()
 
@@ -41,9 +81,15 @@ if __name__ == "__main__":
         log_level=("debug" if app_config["ydl_server"].get("debug", False) else "info"),
         forwarded_allow_ips=app_config["ydl_server"].get("forwarded_allow_ips", None),
         proxy_headers=app_config["ydl_server"].get("proxy_headers", True),
+        # Event streams never end on their own, don't wait for them forever
+        timeout_graceful_shutdown=5,
     )
 
     app.state.ydlhandler.finish()
     app.state.jobshandler.finish()
+    app.state.maintenance.finish()
+    app.state.finished_index.finish()
     app.state.ydlhandler.join()
     app.state.jobshandler.join()
+    app.state.maintenance.join()
+    app.state.finished_index.join()